@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+"""
+   Copyright 2015 Creare
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+Numba versions of the queue drain functions in cyutils.pyx. These are used
+for the UCA calculation when the Cython functions are not compiled, and give
+the same results as cyutils.drain_connections_queue and
+cyutils.drain_area_queue. As there, every level of the queue is sorted, so
+the contributions are added in the same order as in the sweeping versions
+(see the notes above cyutils.drain_connections_queue). Importing this module
+raises an ImportError if numba is not installed.
+"""
+
+import numpy as np
+import numba
+
+#==============================================================================
+# Topological-order (queue) versions of drain_connections and drain_area
+#==============================================================================
+
+
+def drain_connections_queue(arr, ids, indptr, indices, set_to=0):
+    """
+    Sets arr to set_to for every pixel downstream of the pixels in ids.
+
+    Parameters
+    -----------
+    arr : ndarray (bool)
+        The array that will be changed (in-place)
+    ids : ndarray (bool)
+        The pixels to start draining from
+    indptr, indices : ndarray (int32)
+        Column pointers and row indices of the (CSC) adjacency matrix
+    set_to : bool
+        The value that connected pixels are set to
+    """
+    arr = np.ascontiguousarray(arr, dtype=bool)
+    ids = np.ascontiguousarray(ids, dtype=bool)
+    _drain_connections_queue(arr, ids, indptr, indices, bool(set_to))
+    return arr
+
+
+@numba.njit(cache=True, nogil=True)
+def _drain_connections_queue(arr, ids, indptr, indices, tf):
+    n_ids = ids.size
+    queued = np.zeros(n_ids, np.int32)
+    level = np.empty(n_ids, np.int64)
+    next_level = np.empty(n_ids, np.int64)
+
+    n_level = 0
+    for i in range(n_ids):
+        if ids[i]:
+            level[n_level] = i
+            n_level += 1
+
+    level_id = 0
+    while n_level > 0:
+        level_id += 1
+        n_next = 0
+        for k in range(n_level):
+            i = level[k]
+            for j in range(indptr[i], indptr[i + 1]):
+                row_id = indices[j]
+                if arr[row_id] != tf and queued[row_id] != level_id:
+                    queued[row_id] = level_id
+                    next_level[n_next] = row_id
+                    n_next += 1
+                arr[row_id] = tf
+        next_level[:n_next].sort()
+        # The sweeping version stops when a round is the same as the last
+        if _same_level(level, n_level, next_level, n_next):
+            break
+        level, next_level = next_level, level
+        n_level = n_next
+
+
+def drain_area_queue(area, done, ids, col_indptr, col_indices, col_data,
+                     row_indptr, row_indices, n_rows, n_cols,
+                     edge_todo=None, edge_todo_no_mask=None, skip_edge=0):
+    """
+    Drains the area in topological order through a work queue, starting from
+    the pixels in ids. See cyutils.drain_area_queue.
+
+    Parameters
+    -----------
+    area : ndarray (float64)
+        The upstream contributing area (changed in-place)
+    done : ndarray (bool)
+        The pixels that have been drained (changed in-place)
+    ids : ndarray (bool)
+        The pixels to start draining from
+    col_indptr, col_indices, col_data : ndarray
+        The CSC adjacency matrix
+    row_indptr, row_indices : ndarray
+        The sparsity structure of the same matrix in CSR format
+    n_rows, n_cols : int
+        Shape of the chunk
+    edge_todo, edge_todo_no_mask : ndarray (float64), optional
+        Fractions of the edge that still need to be drained (changed in-place)
+    skip_edge : bool
+        If True, the pixels on the edge of the chunk are never modified
+
+    Returns
+    --------
+    area, done, edge_todo, edge_todo_no_mask
+        The last two are boolean arrays
+    """
+    done = np.ascontiguousarray(done, dtype=bool)
+    ids = np.ascontiguousarray(ids, dtype=bool)
+    if edge_todo is None:
+        edge_todo = np.zeros(1, dtype=float)
+        do_edge_todo = False
+    else:
+        do_edge_todo = True
+    if edge_todo_no_mask is None:
+        edge_todo_no_mask = np.zeros(1, dtype=float)
+        do_edge_todo_no_mask = False
+    else:
+        do_edge_todo_no_mask = True
+
+    _drain_area_queue(area, done, ids, col_indptr, col_indices, col_data,
+                      row_indptr, row_indices, n_rows, n_cols,
+                      edge_todo, do_edge_todo,
+                      edge_todo_no_mask, do_edge_todo_no_mask,
+                      bool(skip_edge))
+    return area, done, edge_todo.astype('bool'), \
+        edge_todo_no_mask.astype('bool')
+
+
+@numba.njit(cache=True, nogil=True)
+def _drain_area_queue(area, done, ids, col_indptr, col_indices, col_data,
+                      row_indptr, row_indices, n_rows, n_cols,
+                      edge_todo, do_edge_todo,
+                      edge_todo_no_mask, do_edge_todo_no_mask, skip_edge):
+    n_ids = ids.size
+    n_waiting = np.zeros(n_ids, np.int32)
+    queued = np.zeros(n_ids, np.int32)
+    level = np.empty(n_ids, np.int64)
+    next_level = np.empty(n_ids, np.int64)
+
+    # The first round is marked as done before anything else happens
+    n_level = 0
+    for i in range(n_ids):
+        if ids[i]:
+            done[i] = True
+            level[n_level] = i
+            n_level += 1
+
+    # Count the upstream pixels that are not yet done (the in-degree)
+    for i in range(n_ids):
+        for j in range(row_indptr[i], row_indptr[i + 1]):
+            if not done[row_indices[j]]:
+                n_waiting[i] += 1
+
+    level_id = 0
+    while n_level > 0:
+        level_id += 1
+        # Set the points that are about to be drained as done. The first
+        # round is already accounted for in n_waiting.
+        if level_id > 1:
+            for k in range(n_level):
+                i = level[k]
+                if done[i]:
+                    continue
+                done[i] = True
+                for j in range(col_indptr[i], col_indptr[i + 1]):
+                    n_waiting[col_indices[j]] -= 1
+
+        n_next = 0
+        for k in range(n_level):
+            i = level[k]
+            for j in range(col_indptr[i], col_indptr[i + 1]):
+                row_id = col_indices[j]
+                factor = col_data[j]
+                # Edge pixels are not modified
+                if (skip_edge or done[row_id]) and \
+                        _check_id_on_edge(row_id, n_rows, n_cols):
+                    continue
+
+                area[row_id] += area[i] * factor
+
+                if do_edge_todo:
+                    edge_todo[row_id] += edge_todo[i] * factor
+                if do_edge_todo_no_mask:
+                    edge_todo_no_mask[row_id] += edge_todo_no_mask[i] * factor
+
+                # If all the points that drain into this one are done, it can
+                # be drained next round
+                if n_waiting[row_id] == 0 and queued[row_id] != level_id:
+                    queued[row_id] = level_id
+                    next_level[n_next] = row_id
+                    n_next += 1
+
+        next_level[:n_next].sort()
+        # The sweeping version stops when a round is the same as the last
+        if _same_level(level, n_level, next_level, n_next):
+            break
+        level, next_level = next_level, level
+        n_level = n_next
+
+
+@numba.njit(cache=True, nogil=True)
+def _same_level(level, n_level, next_level, n_next):
+    if n_level != n_next:
+        return False
+    for k in range(n_level):
+        if level[k] != next_level[k]:
+            return False
+    return True
+
+
+@numba.njit(cache=True, nogil=True)
+def _check_id_on_edge(id_, n_rows, n_cols):
+    return (id_ < n_cols) or (id_ >= (n_rows - 1) * n_cols) \
+        or (id_ % n_cols == 0) or (id_ % n_cols == n_cols - 1)
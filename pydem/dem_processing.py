@@ -35,7 +35,7 @@ accuracy when storing the array as an integer.
 
 Usage Notes
 -------------
-This module consists of 3 classes, and 3 helper functions. General users should
+This module consists of 4 classes, and 3 helper functions. General users should
 only need to be concerned with the DEMProcessor class.
 
 It has only been tested in USGS geotiff files.
@@ -45,15 +45,14 @@ It presently only supports WGS84 coordinate systems
 Developer Notes
 -----------------
 The Edge and TileEdge classes keep track of the edge information for tiles
+The DrainageNetwork class stores the pixel connectivity used for the UCA
 
 Development Notes
 ------------------
-TODO: Replace complete file loading with partial loading from disk to RAM.
-      Presently, an entire geotiff is loaded into memory, which makes the
-      chunk calculation less useful because the memory restriction is still
-      present
-TODO: Improve general memory usage (following from previous TODO).
-TODO: Cythonize magnitude and slope calculations
+With DEMProcessor.scratch_dir set, the elevation and the full-size working
+arrays are memory-mapped files, and the chunked calculations only page in
+the chunks they are working on.
+TODO: Filling the flats still loads the entire elevation into memory.
 
 Created on Wed Jun 18 14:19:04 2014
 
@@ -67,8 +66,17 @@ import numpy as np
 
 import os
 import subprocess
+import tempfile
+import multiprocessing
+import itertools
+import collections
 import scipy.sparse as sps
+import scipy.sparse.linalg as spsl
+import scipy.sparse.csgraph as spcg
 import scipy.ndimage as spndi
+import gdal
+import gdalconst
+import osr
 
 from reader.gdal_reader import GdalReader, InputRasterDataLayer
 from reader.my_types import grid_coords_from_corners, Point
@@ -76,16 +84,26 @@ from taudem import taudem
 from test_pydem import get_test_data, make_file_names
 from utils import (mk_dx_dy_from_geotif_layer, get_fn,
                    make_slice, is_edge, grow_obj, find_centroid, get_distance,
-                   get_border_index, get_border_mask, get_adjacent_index)
+                   get_steps, get_border_index, get_border_mask)
 
 try:
     from cyfuncs import cyutils
     CYTHON = True
 except:
     CYTHON = False
-    warnings.warn("Cython functions are not compiled. UCA calculation will be,"
-                  " slow. Consider compiling cython functions using: "
-                  "python setup.py build_ext --inplace", RuntimeWarning)
+
+# Without the compiled Cython functions, the UCA drains with numba if it is
+# installed
+NUMBA = False
+if not CYTHON:
+    try:
+        from cyfuncs import nbutils
+        NUMBA = True
+    except ImportError:
+        warnings.warn("Cython functions are not compiled. UCA calculation will"
+                      " be, slow. Consider compiling cython functions using: "
+                      "python setup.py build_ext --inplace, or installing "
+                      "numba", RuntimeWarning)
 # CYTHON = False
 
 # A test aspect ration between dx and dy coordinates
@@ -442,6 +460,106 @@ class TileEdge(object):
 #            return i_b.nonzero()[0][i2][i3]
 
 
+class DrainageNetwork(object):
+    """
+    Compact, matrix-free description of the D-infinity drainage network of a
+    chunk. Every pixel i drains to at most two neighbours, j1[i] and j2[i]
+    (-1 when there is no connection), receiving the proportions p1[i] and
+    p2[i] of its area. The (rare) additional connections made when draining
+    pits or flats are kept in a side table: pixel extra_i[k] drains to
+    extra_j[k] with proportion extra_p[k]. extra_i is sorted.
+
+    This takes ~24 bytes per pixel (~16 bytes with float32 proportions),
+    instead of the ~40 bytes per pixel needed by the CSC + CSR copies of the
+    adjacency matrix.
+    """
+    shape = None
+    j1 = None
+    j2 = None
+    p1 = None
+    p2 = None
+    extra_i = None
+    extra_j = None
+    extra_p = None
+
+    def __init__(self, shape, i, j, mat_data, keep, dtype='float64'):
+        """
+        Parameters
+        -----------
+        shape : tuple
+            Shape of the chunk
+        i, j, mat_data : ndarray
+            Donor, receiver and proportion of every connection, as returned
+            by DEMProcessor._mk_connections. The first two NN entries are
+            the connections to the j1 and j2 neighbours, anything after that
+            goes to the side table.
+        keep : ndarray
+            Boolean, True for the connections that are retained
+        dtype : str, optional
+            Floating point type of the proportions. With 'float64', the UCA
+            is identical to the one of the adjacency matrix.
+        """
+        self.shape = shape
+        NN = np.prod(shape)
+        # Normalise so that each pixel drains all of its area. The sums are
+        # taken from the same (temporary) sparse matrix as in
+        # _mk_adjacency_matrix, so that they are added in the same order.
+        A = sps.csc_matrix((mat_data[keep], (j[keep], i[keep])),
+                           shape=(NN, NN))
+        normalize = np.array(A.sum(0) + 1e-16).squeeze()
+        del A
+        w = np.where(keep, mat_data, 0) * (1 / normalize)[i]
+
+        self.j1 = np.where(keep[:NN], j[:NN], -1).astype('int32')
+        self.j2 = np.where(keep[NN:2*NN], j[NN:2*NN], -1).astype('int32')
+        self.p1 = w[:NN].astype(dtype)
+        self.p2 = w[NN:2*NN].astype(dtype)
+
+        extra = np.nonzero(keep[2*NN:])[0] + 2*NN
+        extra = extra[np.argsort(i[extra], kind='mergesort')]
+        self.extra_i = i[extra].astype('int32')
+        self.extra_j = j[extra].astype('int32')
+        self.extra_p = w[extra].astype(dtype)
+
+    @property
+    def nbytes(self):
+        return sum([getattr(self, key).nbytes for key in
+                    ['j1', 'j2', 'p1', 'p2', 'extra_i', 'extra_j', 'extra_p']])
+
+    def n_donors(self):
+        """
+        Returns the number of pixels that drain into each pixel
+        """
+        NN = np.prod(self.shape)
+        n = np.bincount(self.extra_j, minlength=NN)
+        for j in [self.j1, self.j2]:
+            n += np.bincount(j[j >= 0], minlength=NN)
+        return n
+
+    def has_receivers(self):
+        """
+        Returns a boolean array, True for the pixels that drain somewhere
+        """
+        drains = (self.j1 >= 0) | (self.j2 >= 0)
+        drains[self.extra_i] = True
+        return drains
+
+    def tocsc(self):
+        """
+        Returns the equivalent adjacency matrix (see
+        DEMProcessor._mk_adjacency_matrix)
+        """
+        NN = np.prod(self.shape)
+        i12 = np.arange(NN)
+        I1 = self.j1 >= 0
+        I2 = self.j2 >= 0
+        i = np.concatenate([i12[I1], i12[I2], self.extra_i])
+        j = np.concatenate([self.j1[I1], self.j2[I2], self.extra_j])
+        mat_data = np.concatenate([self.p1[I1], self.p2[I2], self.extra_p])
+        return sps.csc_matrix((mat_data.astype('float64'), (j, i)),
+                              shape=(NN, NN))
+
+
 class DEMProcessor(object):
     """
     This class processes elevation data, and returns the magnitude of slopes,
@@ -460,6 +578,11 @@ class DEMProcessor(object):
     fill_flats_source_tol = 1
     fill_flats_peaks = True
     fill_flats_pits = True
+    # How to fill flats: 'interpolate' interpolates the elevation of every
+    # flat separately from distances to the sources and drains.
+    # 'priority_flood' gives all the flats in the tile a gradient towards
+    # lower and away from higher terrain at once (Garbrecht and Martz)
+    fill_flats_method = 'interpolate'
     
     drain_pits = True
     drain_flats = False # will be ignored if drain_pits is True
@@ -483,6 +606,9 @@ class DEMProcessor(object):
     twi = None  # topographic wetness index
     elev = None  # elevation data
     A = None  # connectivity matrix
+    # LRU cache of the chunk connectivities during a chunked calc_uca
+    _connectivity_cache = None
+    _connectivity_cache_nbytes = 0
 
     # Gives the quadrant used for determining the d_infty mag/direction
     section = None  # save for debugging purposes, not useful output otherwise
@@ -506,11 +632,50 @@ class DEMProcessor(object):
     chunk_size_slp_dir = 512  # Size of chunk (without overlaps)
     # This has to be > 1 to avoid edge effects for flats
     chunk_overlap_slp_dir = 4  # Overlap when calculating magnitude/directions
+    # Number of worker processes used for the chunked slope/direction
+    # calculation. The elevation is shared with the workers, and the chunks
+    # are stitched together in the same order as the serial calculation.
+    n_workers = 1
     chunk_size_uca = 512  # Size of chunks when calculating UCA
+    # Floating point type of the stored elevation, mag, direction, drainage
+    # proportions and twi. 'float32' halves their memory. The calculations
+    # within a chunk, and the UCA (which is accumulated), stay in float64.
+    float_dtype = 'float64'
+    # Directory for out-of-core processing. If set, the elevation and the
+    # full-size working arrays (mag, direction, flats, uca, twi and the edge
+    # bookkeeping arrays) are np.memmap's backed by temporary files in this
+    # directory, so only the chunks that are being processed are held in
+    # memory. None keeps everything in memory.
+    scratch_dir = None
     chunk_overlap_uca = 32  # Number of overlapping pixels for UCA calculation
     # Mostly deprecated, but maximum number of iterations used to try and
     # resolve circular drainage patterns (which should never occur)
     circular_ref_maxcount = 50
+    # Accumulation engine used for the UCA when the Cython functions are
+    # available. 'queue' drains the pixels in topological order through a
+    # work queue (a single pass), 'iterative' repeatedly sweeps over all the
+    # pixels. Both give identical results. Only used with uca_network =
+    # 'matrix'.
+    uca_drain_method = 'queue'
+    # Representation of the drainage network used for the UCA when the Cython
+    # functions are available. 'receivers' stores the two D-infinity
+    # receivers and proportions (in float_dtype) of every pixel (see
+    # DrainageNetwork), 'matrix' uses a scipy.sparse adjacency matrix, which
+    # needs almost twice the memory. With float_dtype = 'float64' both give
+    # the same UCA.
+    uca_network = 'receivers'
+    # Memory budget (in MB) for the drainage networks (or adjacency matrices)
+    # of the chunks in a chunked UCA calculation. The edge resolution rounds
+    # reuse the connectivity built in the first pass for the same chunk
+    # instead of rebuilding it. The least recently used chunks are evicted
+    # first. 0 disables the cache.
+    uca_connectivity_cache_mb = 512
+    # How the edge resolution rounds drain the area coming in from the edges
+    # of a chunk. 'drain' accumulates it through the drainage network like
+    # the first pass. 'solve' factorizes the (linear) accumulation once per
+    # chunk with a sparse LU, and is kept in the connectivity cache, so each
+    # round is a solve.
+    uca_update_method = 'drain'
 
     # The pixel coordinates for the different facets used to calculate the
     # D_infty magnitude and direction (from Tarboton)
@@ -539,7 +704,8 @@ class DEMProcessor(object):
 #    def __del__(self):
 #        self.elev_file = None #Close the elevation file
 
-    def __init__(self, file_name, dx_dy_from_file=True, plotflag=False):
+    def __init__(self, file_name, dx_dy_from_file=True, plotflag=False,
+                 scratch_dir=None):
         """
         Parameters
         -----------
@@ -558,9 +724,26 @@ class DEMProcessor(object):
         plotflag : bool, optional
             Default False: If True, will plot debug image. For a large
             file this is not advised.
+        scratch_dir : str, optional
+            Default None. Sets self.scratch_dir. If given, a file_name that
+            is a str is read one block at a time into memory-mapped arrays
+            in scratch_dir.
         """
         # %%
-        if isinstance(file_name, str) and os.path.exists(file_name):
+        if scratch_dir is not None:
+            self.scratch_dir = scratch_dir
+        if isinstance(file_name, str) and os.path.exists(file_name) \
+                and self.scratch_dir is not None:
+            elev_file = GdalReader(file_name=file_name)
+            elev = InputRasterDataLayer()
+            elev.grid_coordinates = elev_file.grid_coordinates
+            data = self._read_elevation_to_scratch(elev_file)
+
+            self.elev = elev
+            self.data = data
+            del elev_file  # close the file
+            self.file_name = file_name
+        elif isinstance(file_name, str) and os.path.exists(file_name):
             elev_file = GdalReader(file_name=file_name)
             elev, = elev_file.raster_layers
             data = elev.raster_data
@@ -622,6 +805,43 @@ class DEMProcessor(object):
         self.dX = dX
         self.dY = dY
 
+    def _working_array(self, fill_value=0, dtype='float64', shape=None):
+        """
+        Allocates a working array (by default the size of the tile) filled
+        with fill_value. If self.scratch_dir is set, the array is a np.memmap
+        backed by an anonymous temporary file in that directory.
+        """
+        if shape is None:
+            shape = self.data.shape
+        if self.scratch_dir is None:
+            return np.full(shape, fill_value, dtype)
+        arr = np.memmap(tempfile.TemporaryFile(dir=self.scratch_dir),
+                        dtype, 'w+', shape=shape)
+        if fill_value:  # The file starts out filled with zeros
+            for i in xrange(0, shape[0], self.chunk_size_uca):
+                arr[i:i + self.chunk_size_uca] = fill_value
+        return arr
+
+    def _read_elevation_to_scratch(self, elev_file):
+        """
+        Reads the elevation from a GdalReader one block at a time into a
+        masked array with memory-mapped data and mask.
+        """
+        gcs = elev_file.grid_coordinates
+        shape = (gcs.y_size, gcs.x_size)
+        dtype = elev_file.read_window(0, 1, 0, 1)[0].dtype
+        data = np.ma.masked_array(self._working_array(0, dtype, shape),
+                                  self._working_array(False, bool, shape))
+        for (te, be, le, re), block, _ in elev_file.iter_windows(
+                self.chunk_size_uca, shape[1]):
+            # As when reading into memory, the no-data values are replaced
+            # by FILL_VALUE (which also unmasks them)
+            mask = block.mask | np.isnan(block.data) | (block.data < -9998)
+            block.data[mask] = FILL_VALUE
+            data.data[te:be, le:re] = block.data
+        data.fill_value = block.fill_value
+        return data
+
     def get_fn(self, name=None):
         return get_fn(self.elev, name)
 
@@ -669,6 +889,11 @@ class DEMProcessor(object):
                 s_file.inpaint()
                 count -= 1
 
+            if hasattr(gdal, 'Warp'):
+                self._save_geotiff(s_file, fnl_file, as_int)
+                return
+
+            # Older GDAL versions (< 2.1): go through gdalwarp
             s_file.export_to_geotiff(tmp_file)
 
             if as_int:
@@ -683,6 +908,51 @@ class DEMProcessor(object):
         else:
             np.savez_compressed(fnl_file, array)
 
+    def _save_geotiff(self, s_file, fnl_file, as_int=True):
+        """
+        Writes the layer s_file to the tiled and compressed geotiff fnl_file,
+        in the save_projection, without a temporary file or a gdalwarp
+        process. The layer is copied to an in-memory GDAL dataset, which is
+        written directly if it is already in the save_projection, and warped
+        otherwise.
+        """
+        if as_int:
+            data_type = gdalconst.GDT_Int16
+        else:
+            data_type = gdalconst.GDT_Float32
+        dataset = s_file.grid_coordinates._as_gdal_dataset(
+            driver='MEM', file_name='', data_type=data_type)
+        rb = dataset.GetRasterBand(1)
+        rb.WriteArray(s_file.raster_data.filled())
+        nodata = float(s_file.raster_data.fill_value)
+        if not as_int or np.iinfo(np.int16).min <= nodata \
+                <= np.iinfo(np.int16).max:
+            rb.SetNoDataValue(nodata)
+        rb.SetDescription(s_file.name)
+        rb.SetUnitType(s_file.units)
+
+        options = ['BIGTIFF=YES', 'COMPRESS=LZW', 'TILED=YES']
+        src_srs = osr.SpatialReference()
+        src_srs.ImportFromWkt(dataset.GetProjection())
+        dst_srs = osr.SpatialReference()
+        dst_srs.SetFromUserInput(self.save_projection)
+        if src_srs.IsSame(dst_srs):
+            print "<<"*4, 'Writing', fnl_file, ">>"*4
+            out = gdal.GetDriverByName('GTiff').CreateCopy(fnl_file, dataset,
+                                                           options=options)
+        else:
+            print "<<"*4, 'Warping to', self.save_projection, fnl_file, ">>"*4
+            out = gdal.Warp(fnl_file, dataset, format='GTiff',
+                            dstSRS=self.save_projection, resampleAlg='near',
+                            outputType=data_type, multithread=True,
+                            warpMemoryLimit=2000, creationOptions=options,
+                            warpOptions=['OPTIMIZE_SIZE=YES'])
+        if out is None:
+            raise RuntimeError('Could not write ' + fnl_file)
+        out.FlushCache()
+        del out  # closes the file
+        del dataset
+
     def save_uca(self, rootpath, raw=False, as_int=False):
         """ Saves the upstream contributing area to a file
         """
@@ -933,6 +1203,111 @@ class DEMProcessor(object):
         #     plot_flat(roi, out, region, source, drain, dL, dH)
         #     pyplot.show()
 
+    def _fill_flats_priority_flood(self, data, flat, edge):
+        """
+        Fills all the flats of the tile at once, following Garbrecht and Martz
+        (1997), as done by Barnes et al. (2014): breadth-first searches from
+        the drains and from the (shallow) sources of the flats give every
+        flat pixel a step count towards lower terrain and away from higher
+        terrain. The combination 2 * towards + away decreases strictly towards
+        the drains, and is scaled to the elevation range between the flat and
+        its sources (like _fill_flat).
+
+        Parameters
+        -----------
+        data : np.ndarray
+            Elevation, with np.nan for missing data
+        flat : np.ndarray(dtype=bool)
+            Mask of the flat pixels (pixels without lower neighbors)
+        edge : np.ndarray(dtype=bool)
+            Mask of the tile edges
+
+        Returns
+        --------
+        filled : np.ndarray
+            Elevation, with the flats filled
+        """
+        filled = data.copy()
+        labels, n = spndi.label(flat, structure=FLATS_KERNEL3)
+        if n == 0:
+            return filled
+        index = np.arange(1, n + 1)
+
+        shp = data.shape
+        padded = np.pad(data, 1, 'constant', constant_values=np.nan)
+        padded_flat = np.pad(flat, 1, 'constant')
+        offsets = [(i, j) for i in [-1, 0, 1] for j in [-1, 0, 1]
+                   if i != 0 or j != 0]
+
+        def neighbors(arr, i, j):
+            return arr[1 + i:1 + i + shp[0], 1 + j:1 + j + shp[1]]
+
+        # Drains: flat pixels next to a non-flat pixel with the same elevation
+        # (which has a lower neighbor). Also find the lowest higher neighbor
+        # (missing data and the padding are nan, which compares False)
+        drain = np.zeros(shp, bool)
+        e_up = np.full(shp, np.inf)
+        with np.errstate(invalid='ignore'):
+            for i, j in offsets:
+                nb = neighbors(padded, i, j)
+                drain |= flat & (nb == data) & ~neighbors(padded_flat, i, j)
+                higher = flat & (nb > data)
+                e_up[higher] = np.minimum(e_up[higher], nb[higher])
+
+        e = np.r_[np.nan, spndi.minimum(data, labels, index)]
+        e_source = np.r_[np.inf, spndi.minimum(e_up, labels, index)]
+        has_drain = np.r_[False, spndi.maximum(drain, labels, index) > 0]
+        on_edge = np.r_[False, spndi.maximum(edge & flat, labels, index) > 0]
+        size = np.bincount(labels.ravel(), minlength=n + 1)
+
+        # Sources: flat pixels next to shallow higher pixels
+        source = np.zeros(shp, bool)
+        e_source_tol = (e_source + self.fill_flats_source_tol)[labels]
+        with np.errstate(invalid='ignore'):
+            for i, j in offsets:
+                nb = neighbors(padded, i, j)
+                source |= flat & (nb > data) & (nb <= e_source_tol)
+        del e_source_tol
+
+        # Flats without drains drain to their edge pixels on the tile edge, or
+        # to a center pixel for pits. These pixels keep their elevation.
+        fixed = np.zeros(shp, bool)
+        active = has_drain.copy()
+        I = ~has_drain & on_edge
+        fixed |= I[labels] & edge & flat
+        active |= I
+        pits = ~has_drain & ~on_edge
+        pits[0] = False
+        # Single pixel pits do not change
+        pits &= size > 1
+        if self.fill_flats_pits:
+            objs = spndi.find_objects(labels)
+            for k in pits.nonzero()[0]:
+                obj = objs[k - 1]
+                ci, cj = find_centroid(labels[obj] == k)
+                fixed[obj[0].start + ci, obj[1].start + cj] = True
+            active |= pits
+        # Peaks (without sources) are only filled if requested
+        has_source = np.isfinite(e_source)
+        if not self.fill_flats_peaks:
+            active &= has_source
+        eH = np.where(has_source, np.minimum(e + 1.0, e_source), e + 0.5)
+
+        towards = get_steps(flat, drain | fixed) + 1
+        away = get_steps(flat, source) + 1
+        away[~np.isfinite(away)] = 0
+        height = np.r_[0, spndi.maximum(away, labels, index)]
+        away = np.where(away > 0, height[labels] - away, 0)
+        combined = 2 * towards + away
+        del towards, away
+        combined_max = np.r_[0, spndi.maximum(combined, labels, index)]
+
+        I = active[labels] & flat & ~fixed
+        L = labels[I]
+        filled[I] = e[L] + (eH[L] - e[L]) * combined[I] \
+            / (combined_max[L] + 1)
+        return filled
+
     def calc_slopes_directions(self, plotflag=False):
         """
         Calculates the magnitude and direction of slopes and fills
@@ -953,22 +1328,43 @@ class DEMProcessor(object):
             else: sea_mask = data > 0
             flat = (spndi.minimum_filter(data, (3, 3)) >= data) & sea_mask
 
-            flats, n = spndi.label(flat, structure=FLATS_KERNEL3)
-            objs = spndi.find_objects(flats)
+            if self.fill_flats_method == 'priority_flood':
+                filled = self._fill_flats_priority_flood(data, flat, edge)
+            elif self.fill_flats_method == 'interpolate':
+                flats, n = spndi.label(flat, structure=FLATS_KERNEL3)
+                objs = spndi.find_objects(flats)
 
-            for i, _obj in enumerate(objs):
-                obj = grow_obj(_obj, data.shape)
-                self._fill_flat(data[obj], filled[obj], flats[obj]==i+1, edge[obj])
+                for i, _obj in enumerate(objs):
+                    obj = grow_obj(_obj, data.shape)
+                    self._fill_flat(data[obj], filled[obj], flats[obj]==i+1,
+                                    edge[obj])
+            else:
+                raise RuntimeError('Unknown fill_flats_method: '
+                                   + str(self.fill_flats_method))
 
-            self.data = np.ma.masked_array(filled, mask=np.isnan(filled)).astype(self.data.dtype)
+            if isinstance(np.ma.getdata(self.data), np.memmap):
+                # keep the memory-mapped arrays
+                self.data.data[:] = filled
+                self.data.mask[:] = np.isnan(filled)
+            else:
+                self.data = np.ma.masked_array(filled, mask=np.isnan(filled)).astype(self.data.dtype)
+            del data, filled
+
+        # Only floating point elevations are narrowed, never widened
+        if self.data.dtype.kind == 'f' \
+                and self.data.dtype.itemsize > np.dtype(self.float_dtype).itemsize \
+                and not isinstance(np.ma.getdata(self.data), np.memmap):
+            self.data = self.data.astype(self.float_dtype)
 
         # %% Calculate the slopes and directions based on the 8 sections from
         # Tarboton http://www.neng.usu.edu/cee/faculty/dtarb/96wr03137.pdf
         if self.data.shape[0] <= self.chunk_size_slp_dir and \
                 self.data.shape[1] <= self.chunk_size_slp_dir:
             print "starting slope/direction calculation"
-            self.mag, self.direction = self._slopes_directions(
-                self.data, self.dX, self.dY, 'tarboton')
+            self.mag, self.direction = [arr.astype(self.float_dtype, copy=False)
+                                        for arr in self._slopes_directions(
+                                            self.data, self.dX, self.dY,
+                                            'tarboton')]
             # Find the flat regions. This is mostly simple (look for mag < 0),
             # but the downstream pixel at the edge of a flat will have a
             # calcuable angle which will not be accurate. We have to also find
@@ -976,9 +1372,10 @@ class DEMProcessor(object):
 
             self.find_flats()
         else:
-            self.direction = np.full(self.data.shape, FLAT_ID_INT, 'float64')
-            self.mag = np.full(self.data.shape, FLAT_ID_INT, 'float64')
-            self.flats = np.zeros(self.data.shape, bool)
+            self.direction = self._working_array(FLAT_ID_INT,
+                                                 self.float_dtype)
+            self.mag = self._working_array(FLAT_ID_INT, self.float_dtype)
+            self.flats = self._working_array(False, bool)
             top_edge, bottom_edge = \
                 self._get_chunk_edges(self.data.shape[0],
                                       self.chunk_size_slp_dir,
@@ -988,28 +1385,20 @@ class DEMProcessor(object):
                                       self.chunk_size_slp_dir,
                                       self.chunk_overlap_slp_dir)
             ovr = self.chunk_overlap_slp_dir
-            count = 1
-            for te, be in zip(top_edge, bottom_edge):
-                for le, re in zip(left_edge, right_edge):
-                    print "starting slope/direction calculation for chunk", \
-                        count, "[%d:%d, %d:%d]" % (te, be, le, re)
-                    count += 1
-                    mag, direction = \
-                        self._slopes_directions(self.data[te:be, le:re],
-                                                self.dX[te:be-1],
-                                                self.dY[te:be-1])
-
-                    flats = self._find_flats_edges(self.data[te:be, le:re],
-                                                   mag, direction)
-
-                    direction[flats] = FLAT_ID_INT
-                    mag[flats] = FLAT_ID_INT
-                    self._assign_chunk(self.data, self.mag, mag,
-                                       te, be, le, re, ovr)
-                    self._assign_chunk(self.data, self.direction, direction,
-                                       te, be, le, re, ovr)
-                    self._assign_chunk(self.data, self.flats, flats,
-                                       te, be, le, re, ovr)
+            chunks = [(te, be, le, re)
+                      for te, be in zip(top_edge, bottom_edge)
+                      for le, re in zip(left_edge, right_edge)]
+            # The chunks are assigned in order, so the result does not depend
+            # on the number of workers
+            results = self._slopes_directions_chunks(chunks)
+            for (te, be, le, re), (mag, direction, flats) in \
+                    itertools.izip(chunks, results):
+                self._assign_chunk(self.data, self.mag, mag,
+                                   te, be, le, re, ovr)
+                self._assign_chunk(self.data, self.direction, direction,
+                                   te, be, le, re, ovr)
+                self._assign_chunk(self.data, self.flats, flats,
+                                   te, be, le, re, ovr)
 
         if plotflag:
             self._plot_debug_slopes_directions()
@@ -1017,6 +1406,75 @@ class DEMProcessor(object):
         gc.collect()  # Just in case
         return self.mag, self.direction
 
+    def _slopes_directions_chunk(self, data, dX, dY, count, te, be, le, re):
+        """
+        Calculates the magnitude, direction and flats for the chunk
+        data[te:be, le:re]
+        """
+        print "starting slope/direction calculation for chunk", \
+            count, "[%d:%d, %d:%d]" % (te, be, le, re)
+        mag, direction = self._slopes_directions(data[te:be, le:re],
+                                                 dX[te:be-1], dY[te:be-1])
+
+        flats = self._find_flats_edges(data[te:be, le:re], mag, direction)
+
+        direction[flats] = FLAT_ID_INT
+        mag[flats] = FLAT_ID_INT
+        return mag.astype(self.float_dtype, copy=False), \
+            direction.astype(self.float_dtype, copy=False), flats
+
+    def _slopes_directions_chunks(self, chunks):
+        """
+        Generator that calculates _slopes_directions_chunk for all the chunks
+        (te, be, le, re), and yields the results in the same order. If
+        n_workers > 1, the chunks are calculated by a pool of worker
+        processes, and the elevation data is placed in shared memory for
+        them. In the out-of-core mode (scratch_dir), the workers use the
+        memory-mapped elevation directly instead of a copy of it.
+        """
+        if self.n_workers <= 1 or len(chunks) <= 1:
+            for count, chunk in enumerate(chunks, 1):
+                yield self._slopes_directions_chunk(self.data, self.dX,
+                                                    self.dY, count, *chunk)
+            return
+
+        data = np.ma.getdata(self.data)
+        if isinstance(self.data, np.ma.MaskedArray):
+            mask = np.ma.getmaskarray(self.data)
+        else:
+            mask = None
+        if isinstance(data, np.memmap):
+            # The forked workers share the mapping of the scratch files
+            shared_data, shared_mask = data, mask
+        else:
+            shared_data = multiprocessing.RawArray('b', data.nbytes)
+            np.frombuffer(shared_data, data.dtype).reshape(data.shape)[:] = \
+                data
+            shared_mask = None
+            if mask is not None:
+                shared_mask = multiprocessing.RawArray('b', mask.nbytes)
+                np.frombuffer(shared_mask, bool).reshape(mask.shape)[:] = mask
+
+        # The options set on this processor (such as float_dtype), without
+        # its data
+        options = dict((key, val) for key, val in vars(self).items()
+                       if hasattr(self.__class__, key)
+                       and not key.startswith('_') and key != 'elev'
+                       and not isinstance(val, (np.ndarray, sps.spmatrix)))
+        pool = multiprocessing.Pool(
+            min(self.n_workers, len(chunks)),
+            initializer=_init_slopes_directions_worker,
+            initargs=(self.__class__, options, shared_data, shared_mask,
+                      data.dtype.str, data.shape, self.dX, self.dY))
+        try:
+            for result in pool.imap(_slopes_directions_chunk_worker,
+                                    [(count, ) + chunk for count, chunk
+                                     in enumerate(chunks, 1)]):
+                yield result
+        finally:
+            pool.terminate()
+            pool.join()
+
     def _slopes_directions(self, data, dX, dY, method='tarboton'):
         """ Wrapper to pick between various algorithms
         """
@@ -1061,21 +1519,25 @@ class DEMProcessor(object):
         these and then set them equal to a flat
         """
 
-        i12 = np.arange(data.size).reshape(data.shape)
-
         flat = mag == FLAT_ID_INT
         flats, n = spndi.label(flat, structure=FLATS_KERNEL3)
-        objs = spndi.find_objects(flats)
-
-        f = flat.ravel()
+        if n == 0:
+            return flat
+
+        # Every pixel next to a flat is marked as a flat if it has the same
+        # elevation as the (first pixel of the) flat. Pixels next to several
+        # flats use the flat with the highest label.
+        footprint = np.ones((3, 3), bool)
+        footprint[1, 1] = False
+        adjacent = spndi.maximum_filter(flats, footprint=footprint,
+                                        mode='constant', cval=0)
         d = data.ravel()
-        for i, _obj in enumerate(objs):
-            region = flats[_obj] == i+1
-            I = i12[_obj][region]
-            J = get_adjacent_index(I, data.shape, data.size)
-            f[J] = d[J] == d[I[0]]
+        labels, first = np.unique(flats.ravel(), return_index=True)
+        e_flat = np.zeros(n + 1, d.dtype)
+        e_flat[labels] = d[first]
 
-        flat = f.reshape(data.shape)
+        J = adjacent > 0
+        flat[J] = data[J] == e_flat[adjacent[J]]
         return flat
 
     def calc_uca(self, plotflag=False, edge_init_data=None, uca_init=None):
@@ -1116,9 +1578,9 @@ class DEMProcessor(object):
             self.calc_slopes_directions()
 
         # Initialize the upstream area
-        uca_edge_init = np.zeros(self.data.shape, 'float64')
-        uca_edge_done = np.zeros(self.data.shape, bool)
-        uca_edge_todo = np.zeros(self.data.shape, bool)
+        uca_edge_init = self._working_array(0)
+        uca_edge_done = self._working_array(False, bool)
+        uca_edge_todo = self._working_array(False, bool)
         edge_init_done, edge_init_todo = None, None
         if edge_init_data is not None:
             edge_init_data, edge_init_done, edge_init_todo = edge_init_data
@@ -1137,9 +1599,12 @@ class DEMProcessor(object):
                     edge_init_todo[key].reshape(uca_edge_init[val].shape)
 
         if uca_init is None:
-            self.uca = np.full(self.data.shape, FLAT_ID_INT, 'float64')
-        else:
+            self.uca = self._working_array(FLAT_ID_INT)
+        elif self.scratch_dir is None:
             self.uca = uca_init.astype('float64')
+        else:
+            self.uca = self._working_array(0)
+            self.uca[:] = uca_init
 
         if self.data.shape[0] <= self.chunk_size_uca and \
                 self.data.shape[1] <= self.chunk_size_uca:
@@ -1153,10 +1618,11 @@ class DEMProcessor(object):
                 self.edge_todo = res[1]
                 self.edge_done = res[2]
                 self.uca = res[0]
+                self._update_pits(res[5], self.data.shape)
             else:
                 print "Starting edge resolution round: ",
-                # last return value will be None: edge_
-                area, e2doi, edone, _ = \
+                # edge_todo_tile will be None
+                area, e2doi, edone, _, pits = \
                     self._calc_uca_chunk_update(self.data, self.dX, self.dY,
                                                 self.direction, self.mag,
                                                 self.flats,
@@ -1166,6 +1632,7 @@ class DEMProcessor(object):
                 self.uca += area
                 self.edge_todo = e2doi
                 self.edge_done = edone
+                self._update_pits(pits, self.data.shape)
 
         else:
             top_edge, bottom_edge = \
@@ -1177,10 +1644,13 @@ class DEMProcessor(object):
             ovr = self.chunk_overlap_uca
 
             # Initialize the edge_todo and done arrays
-            edge_todo = np.zeros(self.data.shape, bool)
-            edge_todo_tile = np.zeros(self.data.shape, bool)
-            edge_not_done_tile = np.zeros(self.data.shape, bool)
-            edge_done = np.zeros(self.data.shape, bool)
+            edge_todo = self._working_array(False, bool)
+            edge_todo_tile = self._working_array(False, bool)
+            edge_not_done_tile = self._working_array(False, bool)
+            edge_done = self._working_array(False, bool)
+
+            self._connectivity_cache = collections.OrderedDict()
+            self._connectivity_cache_nbytes = 0
 
             tile_edge = TileEdge(top_edge, bottom_edge, left_edge,
                                  right_edge, ovr,
@@ -1195,6 +1665,12 @@ class DEMProcessor(object):
             self.data.mask[0, :] = True
             self.data.mask[-1, :] = True
 
+            # The pits drained in each chunk. The mag and flats are only
+            # updated at the end. Each chunk sees the flats without the pits
+            # drained by the chunks before it (see _get_chunk_flats), so it
+            # gets the same connectivity whether it is cached or rebuilt.
+            chunk_pits = []
+
             # if 1:  # uca_init == None:
             print "Starting uca calculation for chunk: ",
             # %%
@@ -1202,16 +1678,19 @@ class DEMProcessor(object):
                 for le, re in zip(left_edge, right_edge):
                     print count, "[%d:%d, %d:%d]" % (te, be, le, re),
                     count += 1
-                    area, e2doi, edone, e2doi_no_mask, e2o_no_mask = \
+                    area, e2doi, edone, e2doi_no_mask, e2o_no_mask, pits = \
                         self._calc_uca_chunk(self.data[te:be, le:re],
                                              self.dX[te:be-1],
                                              self.dY[te:be-1],
                                              self.direction[te:be, le:re],
                                              self.mag[te:be, le:re],
-                                             self.flats[te:be, le:re],
+                                             self._get_chunk_flats(
+                                                 chunk_pits, te, be, le, re),
                                              area_edges=uca_edge_init[te:be, le:re],
                                              plotflag=plotflag,
-                                             edge_todo_i_no_mask=uca_edge_todo[te:be, le:re])
+                                             edge_todo_i_no_mask=uca_edge_todo[te:be, le:re],
+                                             key=(te, be, le, re))
+                    chunk_pits.append((pits, (be - te, re - le), (te, le)))
                     self._assign_chunk(self.data, self.uca, area,
                                        te, be, le, re, ovr)
                     edge_todo[te:be, le:re] += e2doi
@@ -1271,6 +1750,9 @@ class DEMProcessor(object):
                 self.tile_edge = tile_edge
                 self.edge_todo = edge_todo
                 self.edge_done = edge_done
+                self._connectivity_cache = None
+                for pits, shape, offset in chunk_pits:
+                    self._update_pits(pits, shape, offset)
                 return self.uca
 
             # ## RESOLVING EDGES ## #
@@ -1291,10 +1773,12 @@ class DEMProcessor(object):
                     [self.data[te:be, le:re],
                      self.dX[te:be-1], self.dY[te:be-1],
                      self.direction[te:be, le:re],
-                     self.mag[te:be, le:re], self.flats[te:be, le:re]]
-                area, e2doi, edone, e2doi_tile = self._calc_uca_chunk_update(
+                     self.mag[te:be, le:re],
+                     self._get_chunk_flats(chunk_pits[:i], te, be, le, re)]
+                area, e2doi, edone, e2doi_tile, _ = self._calc_uca_chunk_update(
                     data, dX, dY, direction, mag, flats, tile_edge, i,
-                    edge_todo=edge_not_done_tile[te:be, le:re])
+                    edge_todo=edge_not_done_tile[te:be, le:re],
+                    key=(te, be, le, re))
                 self._assign_chunk(self.data, self.uca, area,
                                    te, be, le, re, ovr, add=True)
                 self._assign_chunk(self.data, edge_done, edone,
@@ -1334,7 +1818,11 @@ class DEMProcessor(object):
                 # %%
             self.tile_edge = tile_edge
             self.edge_todo = edge_todo_tile
-            self.edge_done = ~edge_not_done_tile
+            self.edge_done = np.logical_not(
+                edge_not_done_tile, out=self._working_array(False, bool))
+            self._connectivity_cache = None
+            for pits, shape, offset in chunk_pits:
+                self._update_pits(pits, shape, offset)
         print '..Done'
 
         # Fix the very last pixel on the edges
@@ -1343,6 +1831,219 @@ class DEMProcessor(object):
         gc.collect()  # Just in case
         return self.uca
 
+    def calc_uca_transfer(self, covered, sample_ids, tol=1e-12):
+        """
+        Calculates how the UCA on the edges of the tile, as given by the
+        neighboring tiles, drains to the pixels sample_ids that the
+        neighboring tiles use in turn. This is the transfer map used by
+        ProcessManager.edge_resolution = 'transfer'.
+
+        Parameters
+        -----------
+        covered : ndarray (bool)
+            The edge pixels that get their UCA from a neighboring tile. These
+            do not receive any area from this tile.
+        sample_ids : ndarray (int)
+            Indices (into the raveled tile) of the pixels whose UCA is used
+            by the neighboring tiles
+        tol : float, optional
+            Default 1e-12. Drained fractions below tol are dropped
+
+        Returns
+        --------
+        uca0 : ndarray
+            The UCA at sample_ids without any area from the covered pixels
+        transfer : scipy.sparse.csr_matrix
+            Shape (len(sample_ids), covered.sum()). The UCA at sample_ids is
+            uca0 + transfer * v, with v the UCA of the covered pixels (in C
+            order).
+
+        Notes
+        ------
+        For edge pixels in sample_ids, the area that drains into them from
+        the tile is returned. For the covered ones, this is used instead of
+        their UCA, so tiles that overlap by a single pixel exchange what
+        drains across that pixel.
+
+        The pixels are visited once, in drainage order (see
+        _get_drainage_levels), carrying the fraction of the UCA of every
+        covered pixel that reaches them. The area drained from the tile
+        alone is carried along as one more column. The work is the number
+        of (pixel, covered pixel) pairs with a fraction above tol, which
+        grows with the width of the areas downstream of the covered pixels
+        and not with the length of their flow paths.
+        """
+        if self.direction is None:
+            self.calc_slopes_directions()
+        A = self._mk_tile_connectivity()
+        n = A.shape[0]
+        covered = covered.ravel()
+        sample_ids = np.asarray(sample_ids, 'int64')
+        sample_pos = np.full(n, -1, 'int64')
+        sample_pos[sample_ids] = np.arange(sample_ids.size)
+        level = self._get_drainage_levels(A, ~covered)
+
+        area = self.dX * self.dY
+        area = np.concatenate((area[0:1], area))[:, None]
+        area = area.repeat(self.data.shape[1], 1).ravel()
+        # The area drained from this tile alone. As in calc_uca, the edge
+        # pixels do not add their own area.
+        interior = np.zeros(self.data.shape, bool)
+        interior[1:-1, 1:-1] = True
+        area = area * interior.ravel()
+
+        # Columns 0..n_src-1 follow the covered pixels, column n_src the
+        # area of the tile. The contributions to a pixel wait in the bucket
+        # of its level until all its donors are done.
+        sources = np.nonzero(covered)[0]
+        n_src = sources.size
+        n_col = n_src + 1
+        buckets = [[] for _ in xrange(level.max() + 1)]
+        buckets[0].append((sources, np.arange(n_src), np.ones(n_src)))
+        I = np.nonzero(area)[0]
+        for lev in np.unique(level[I]):
+            J = I[level[I] == lev]
+            buckets[lev].append((J, np.full(J.size, n_src, 'int64'),
+                                 area[J]))
+
+        rows, cols, vals = [], [], []
+        for lev, bucket in enumerate(buckets):
+            if not bucket:
+                continue
+            pix, col, frac = [np.concatenate(a) for a in zip(*bucket)]
+            buckets[lev] = None
+            key, inv = np.unique(pix * n_col + col, return_inverse=True)
+            frac = np.bincount(inv, frac)
+            pix, col = key // n_col, key % n_col
+
+            # The covered pixels only record what drains into them (below)
+            I = (sample_pos[pix] >= 0) & ~covered[pix]
+            rows.append(sample_pos[pix[I]])
+            cols.append(col[I])
+            vals.append(frac[I])
+            I = (frac > tol) | (col == n_src)
+            pix, col, frac = pix[I], col[I], frac[I]
+
+            counts = A.indptr[pix + 1] - A.indptr[pix]
+            parent = np.repeat(np.arange(pix.size), counts)
+            k = np.arange(parent.size) \
+                - np.repeat(np.cumsum(counts) - counts, counts) \
+                + A.indptr[pix][parent]
+            pix, col = A.indices[k].astype('int64'), col[parent]
+            frac = frac[parent] * A.data[k]
+
+            I = covered[pix] & (sample_pos[pix] >= 0)
+            rows.append(sample_pos[pix[I]])
+            cols.append(col[I])
+            vals.append(frac[I])
+            # Drainage back into pixels that are done is circular (see
+            # _get_drainage_levels), and is dropped
+            I = ~covered[pix] & (level[pix] > lev)
+            pix, col, frac = pix[I], col[I], frac[I]
+            order = np.argsort(level[pix], kind='mergesort')
+            pix, col, frac = pix[order], col[order], frac[order]
+            levs, starts = np.unique(level[pix], return_index=True)
+            ends = np.append(starts[1:], pix.size)
+            for l, s, e in zip(levs, starts, ends):
+                buckets[l].append((pix[s:e], col[s:e], frac[s:e]))
+
+        empty = [np.zeros(0, 'int64')]
+        transfer = sps.coo_matrix(
+            (np.concatenate([np.zeros(0)] + vals),
+             (np.concatenate(empty + rows), np.concatenate(empty + cols))),
+            shape=(sample_ids.size, n_col)).tocsc()
+        uca0 = transfer[:, n_src].toarray().ravel()
+        return uca0, transfer[:, :n_src].tocsr()
+
+    def _mk_tile_connectivity(self):
+        """
+        Returns the adjacency matrix A[receiver, donor] (CSC) of the whole
+        tile. It is built chunk by chunk, with chunk_size_uca and
+        chunk_overlap_uca as in calc_uca, and every chunk gives the columns
+        of the donors in the part of the chunk that _assign_chunk assigns.
+        """
+        shape = self.data.shape
+        n = shape[0] * shape[1]
+        if shape[0] <= self.chunk_size_uca and shape[1] <= self.chunk_size_uca:
+            top_edge, bottom_edge = [0], [shape[0]]
+            left_edge, right_edge = [0], [shape[1]]
+        else:
+            top_edge, bottom_edge = \
+                self._get_chunk_edges(shape[0], self.chunk_size_uca,
+                                      self.chunk_overlap_uca)
+            left_edge, right_edge = \
+                self._get_chunk_edges(shape[1], self.chunk_size_uca,
+                                      self.chunk_overlap_uca)
+        ovr = self.chunk_overlap_uca
+
+        rows, cols, vals = [], [], []
+        for te, be in zip(top_edge, bottom_edge):
+            for le, re in zip(left_edge, right_edge):
+                A, _, _ = self._get_uca_connectivity(
+                    self.data[te:be, le:re], self.dX[te:be-1],
+                    self.dY[te:be-1], self.direction[te:be, le:re],
+                    self.mag[te:be, le:re], self.flats[te:be, le:re])
+                if isinstance(A, DrainageNetwork):
+                    A = A.tocsc()
+                A = sps.coo_matrix(A)
+                i1 = 0 if te == 0 else ovr
+                i2 = be - te if be == shape[0] else be - te - ovr
+                j1 = 0 if le == 0 else ovr
+                j2 = re - le if re == shape[1] else re - le - ovr
+                ci, cj = np.divmod(A.col, re - le)
+                I = (ci >= i1) & (ci < i2) & (cj >= j1) & (cj < j2)
+                ri, rj = np.divmod(A.row[I], re - le)
+                rows.append((ri + te) * shape[1] + rj + le)
+                cols.append((ci[I] + te) * shape[1] + cj[I] + le)
+                vals.append(A.data[I])
+        return sps.csc_matrix((np.concatenate(vals),
+                               (np.concatenate(rows), np.concatenate(cols))),
+                              shape=(n, n))
+
+    def _get_drainage_levels(self, A, receives):
+        """
+        Returns the level of every pixel in the drainage network A
+        (A[receiver, donor], CSC): each pixel is on a higher level than all
+        the pixels that drain into it. Only the pixels where receives is
+        True receive any area.
+
+        Circular drainage has no such order. When only cycles are left, the
+        highest pixel of every cycle is given the next level, and whatever
+        drains back into it from the cycle is dropped.
+        """
+        n = A.shape[0]
+        donors = np.repeat(np.arange(n), np.diff(A.indptr))
+        I = receives[A.indices] & (A.data != 0) & (A.indices != donors)
+        n_donors = np.bincount(A.indices[I], minlength=n)
+        A = sps.csc_matrix((A.data[I].astype(bool),
+                            (A.indices[I], donors[I])), shape=A.shape)
+        elev = np.ma.filled(self.data.astype('float64'), -np.inf).ravel()
+
+        level = np.full(n, -1, 'int64')
+        front = np.nonzero(n_donors == 0)[0]
+        lev = 0
+        while front.size:
+            level[front] = lev
+            lev += 1
+            counts = A.indptr[front + 1] - A.indptr[front]
+            k = np.arange(counts.sum()) \
+                - np.repeat(np.cumsum(counts) - counts, counts) \
+                + np.repeat(A.indptr[front], counts)
+            pix, counts = np.unique(A.indices[k], return_counts=True)
+            n_donors[pix] -= counts
+            front = pix[(n_donors[pix] == 0) & (level[pix] < 0)]
+            if front.size == 0 and (level < 0).any():
+                warnings.warn("Circular drainage in calc_uca_transfer")
+                left = np.nonzero(level < 0)[0]
+                _, labels = spcg.connected_components(
+                    A[left][:, left], directed=True, connection='strong')
+                order = np.lexsort((-elev[left], labels))
+                first = np.ones(left.size, bool)
+                first[1:] = labels[order][1:] != labels[order][:-1]
+                first &= np.bincount(labels)[labels[order]] > 1
+                front = left[order[first]]
+        return level
+
     def fix_edge_pixels(self, edge_init_data, edge_init_done, edge_init_todo):
         """
         This function fixes the pixels on the very edge of the tile.
@@ -1414,28 +2115,32 @@ class DEMProcessor(object):
     def _calc_uca_chunk_update(self, data, dX, dY, direction, mag, flats,
                                tile_edge=None, i=None,
                                area_edges=None, edge_todo=None, edge_done=None,
-                               plotflag=False):
+                               plotflag=False, key=None):
         """
         Calculates the upstream contributing area due to contributions from
-        the edges only.
+        the edges only. key identifies the chunk in the connectivity cache
+        (see _get_uca_connectivity). The last value returned are the pits
+        drained in the chunk (see _update_pits).
         """
         # %%
 
         sides = ['left', 'right', 'top', 'bottom']
         slices = [[slice(None), slice(0, 1)], [slice(None), slice(-1, None)],
                   [slice(0, 1), slice(None)], [slice(-1, None), slice(None)]]
-        # Figure out which section the drainage goes towards, and what
-        # proportion goes to the straight-sided (as opposed to diagonal) node.
-
-        section, proportion = self._calc_uca_section_proportion(
-            data, dX, dY, direction, flats)
 
-        # Build the drainage or adjacency matrix
-        A = self._mk_adjacency_matrix(section, proportion, flats, data, mag, dX, dY)
-        if CYTHON:
-            B = A
-            C = A.tocsr()
-        if not CYTHON:
+        # Get the drainage network or adjacency matrix
+        A, drain_funcs, pits = self._get_uca_connectivity(
+            data, dX, dY, direction, mag, flats, key)
+        # The drained pits are not flats
+        flats = flats.copy()
+        flats.ravel()[pits[0]] = False
+        solver = None
+        if self.uca_update_method == 'solve':
+            solver = self._get_uca_solver(A, data.shape, key)
+        elif self.uca_update_method != 'drain':
+            raise RuntimeError("Unknown uca_update_method '%s'"
+                               % self.uca_update_method)
+        if not (CYTHON or NUMBA):
             A = A.tocoo()
 
         ids = np.zeros(data.shape, bool)
@@ -1506,11 +2211,13 @@ class DEMProcessor(object):
 
             return arr
 
-        if CYTHON:
-            a = cyutils.drain_connections(
-                done.ravel(), ids, B.indptr, B.indices, set_to=False)
+        if CYTHON or NUMBA:
+            cy_drain_connections, cy_drain_area = drain_funcs
+        # The solve does not need to know what is done
+        if solver is None and (CYTHON or NUMBA):
+            a = cy_drain_connections(done.ravel(), ids, set_to=False)
             done = a.reshape(done.shape).astype(bool)
-        else:
+        elif solver is None:
             done = drain_pixels_done(ids, done, A.row, A.col)
 
         done[data.mask] = True  # deal with no-data values
@@ -1574,25 +2281,24 @@ class DEMProcessor(object):
     #            self._plot_connectivity(A, data=data)
             return area, done, edge_todo_tile
 
-        if CYTHON:
+        if solver is not None:
+            area, edge_todo_tile = self._solve_uca_update(
+                solver, area, ids, edge_todo_tile)
+        elif CYTHON or NUMBA:
             if edge_todo_tile is not None:
-                a, b, c, d = cyutils.drain_area(area.ravel(),
-                                                done.ravel(),
-                                                ids,
-                                                B.indptr, B.indices, B.data,
-                                                C.indptr, C.indices,
-                                                area.shape[0], area.shape[1],
-                                                edge_todo_tile.astype('float64').ravel(),
-                                                skip_edge=True)
+                a, b, c, d = cy_drain_area(area.ravel(),
+                                           done.ravel(),
+                                           ids,
+                                           area.shape[0], area.shape[1],
+                                           edge_todo_tile.astype('float64').ravel(),
+                                           skip_edge=True)
                 edge_todo_tile = c.reshape(edge_todo_tile.shape)
             else:
-                a, b, c, d = cyutils.drain_area(area.ravel(),
-                                                done.ravel(),
-                                                ids,
-                                                B.indptr, B.indices, B.data,
-                                                C.indptr, C.indices,
-                                                area.shape[0], area.shape[1],
-                                                skip_edge=True)
+                a, b, c, d = cy_drain_area(area.ravel(),
+                                           done.ravel(),
+                                           ids,
+                                           area.shape[0], area.shape[1],
+                                           skip_edge=True)
             area = a.reshape(area.shape)
             done = b.reshape(done.shape)
 
@@ -1628,10 +2334,8 @@ class DEMProcessor(object):
 #                ids = (edge_todo_old.ravel() != arr.ravel())
             return arr
         
-        if CYTHON:
-            a = cyutils.drain_connections(edge_todo.ravel(),
-                                          ids, B.indptr, B.indices,
-                                          set_to=True)
+        if CYTHON or NUMBA:
+            a = cy_drain_connections(edge_todo.ravel(), ids, set_to=True)
             edge_todo = a.reshape(edge_todo.shape).astype(bool)
         else:
             edge_todo = drain_pixels_todo(ids, edge_todo, A.row, A.col)
@@ -1639,27 +2343,32 @@ class DEMProcessor(object):
         area[flats] = np.nan
         edge_done = ~edge_todo
 
-        return area, edge_todo_i, edge_done, edge_todo_tile
+        return area, edge_todo_i, edge_done, edge_todo_tile, pits
 
     def _calc_uca_chunk(self, data, dX, dY, direction, mag, flats,
-                        area_edges, plotflag=False, edge_todo_i_no_mask=True):
+                        area_edges, plotflag=False, edge_todo_i_no_mask=True,
+                        key=None):
         """
         Calculates the upstream contributing area for the interior, and
         includes edge contributions if they are provided through area_edges.
+        key identifies the chunk in the connectivity cache (see
+        _get_uca_connectivity). The last value returned are the pits drained
+        in the chunk (see _update_pits).
         """
         # %%
-        # Figure out which section the drainage goes towards, and what
-        # proportion goes to the straight-sided (as opposed to diagonal) node.
-        section, proportion = self._calc_uca_section_proportion(
-            data, dX, dY, direction, flats)
-
-        # Build the drainage or adjacency matrix
-        A = self._mk_adjacency_matrix(section, proportion, flats, data, mag, dX, dY)
-        if CYTHON:
-            B = A.tocsr()
-
-        colsum = np.array(A.sum(1)).ravel()
-        ids = colsum == 0  # If no one drains into me
+        # Build the drainage network or adjacency matrix
+        A, drain_funcs, pits = self._get_uca_connectivity(
+            data, dX, dY, direction, mag, flats, key)
+        # The drained pits are not flats
+        flats = flats.copy()
+        flats.ravel()[pits[0]] = False
+        if isinstance(A, DrainageNetwork):
+            ids = A.n_donors() == 0  # If no one drains into me
+            drains = A.has_receivers().reshape(data.shape)
+        else:
+            colsum = np.array(A.sum(1)).ravel()
+            ids = colsum == 0  # If no one drains into me
+            drains = np.array(A.sum(0)).reshape(data.shape) > 0
 
         area = (dX * dY)
         # Record minimum area
@@ -1683,16 +2392,11 @@ class DEMProcessor(object):
 
         # Check the inlet edges
         edge_todo = np.zeros_like(done)
-        ids_ed = np.arange(data.size).reshape(data.shape)
         # left
-        edge_todo[:, 0] = (A[:, ids_ed[:, 0]].sum(0) > 0) \
-            & (area_edges[:, 0] == 0)
-        edge_todo[:, -1] = (A[:, ids_ed[:, -1]].sum(0) > 0) \
-            & (area_edges[:, -1] == 0)
-        edge_todo[0, :] = (A[:, ids_ed[0, :]].sum(0) > 0) \
-            & (area_edges[0, :] == 0)
-        edge_todo[-1, :] = (A[:, ids_ed[-1, :]].sum(0) > 0) \
-            & (area_edges[-1, :] == 0)
+        edge_todo[:, 0] = drains[:, 0] & (area_edges[:, 0] == 0)
+        edge_todo[:, -1] = drains[:, -1] & (area_edges[:, -1] == 0)
+        edge_todo[0, :] = drains[0, :] & (area_edges[0, :] == 0)
+        edge_todo[-1, :] = drains[-1, :] & (area_edges[-1, :] == 0)
 
         # Will do the tile-level doneness
         edge_todo_i_no_mask = edge_todo.copy() & edge_todo_i_no_mask
@@ -1704,20 +2408,24 @@ class DEMProcessor(object):
         # %%
         count = 1
         
-        if CYTHON:
+        if CYTHON or NUMBA:
+            _, cy_drain_area = drain_funcs
             area_ = area.ravel()
             done_ = done.ravel()
             edge_todo_ = edge_todo.astype('float64').ravel()
             edge_todo_no_mask_ = edge_todo_no_mask.astype('float64').ravel()
         data_ = data.ravel()
 
+        # The queue drain functions finish in one pass, unless there is
+        # circular drainage. Then the pixels of the cycle are never done, and
+        # this loop restarts the drain from the highest pixels left, as for
+        # the sweeping functions.
         while (np.any(~done) and count < self.circular_ref_maxcount):
             print ".",
             count += 1
-            if CYTHON:
-                area_, done_, edge_todo_, edge_todo_no_mask_ = cyutils.drain_area(area_,
+            if CYTHON or NUMBA:
+                area_, done_, edge_todo_, edge_todo_no_mask_ = cy_drain_area(area_,
                     done_, ids,
-                    A.indptr, A.indices, A.data, B.indptr, B.indices,
                     area.shape[0], area.shape[1],
                     edge_todo_, edge_todo_no_mask_)
             else:
@@ -1737,7 +2445,7 @@ class DEMProcessor(object):
             max_elev = (data_ * (~done_)).max()
             ids[((data_ * (~done_) - max_elev) / max_elev > -0.01)] = True
 
-        if CYTHON:
+        if CYTHON or NUMBA:
             area = area_.reshape(area.shape)
             done = done_.reshape(done.shape)
             edge_todo = edge_todo_.reshape(edge_todo.shape).astype(bool)
@@ -1755,10 +2463,243 @@ class DEMProcessor(object):
 
         # %%
         if plotflag:
+            if isinstance(A, DrainageNetwork):
+                A = A.tocsc()
             # TODO DTYPE
             self._plot_connectivity(A, (done.astype('float64') is False)
                                     + flats.astype('float64') * 2, [0, 3])
-        return area, edge_todo_i, edge_done, edge_todo_i_no_mask, edge_todo_no_mask
+        return area, edge_todo_i, edge_done, edge_todo_i_no_mask, \
+            edge_todo_no_mask, pits
+
+    def _get_uca_connectivity(self, data, dX, dY, direction, mag, flats,
+                              key=None):
+        """
+        Returns the connectivity of the chunk (see _mk_uca_connectivity), its
+        drain functions (see _get_drain_funcs, None without the compiled
+        functions) and the (ids, mag) of the pits it drains. Building the
+        connectivity does not modify mag or flats, see _update_pits.
+
+        During a chunked calc_uca, these are kept in an LRU cache under the
+        chunk's key, within the uca_connectivity_cache_mb budget, because
+        the direction, mag and flats of a chunk do not change between the
+        first pass and the edge resolution rounds. A chunk that was evicted
+        is rebuilt to the same connectivity.
+        """
+        entry = self._cache_get(('connectivity', key))
+        if entry is not None:
+            return entry
+
+        # Figure out which section the drainage goes towards, and what
+        # proportion goes to the straight-sided (as opposed to diagonal) node.
+        section, proportion = self._calc_uca_section_proportion(
+            data, dX, dY, direction, flats)
+
+        # Build the drainage network or adjacency matrix
+        A, pits = self._mk_uca_connectivity(section, proportion, flats,
+                                            data, mag, dX, dY)
+        drain_funcs = None
+        if CYTHON or NUMBA:
+            drain_funcs = self._get_drain_funcs(A)
+
+        if isinstance(A, DrainageNetwork):
+            nbytes = A.nbytes
+        else:  # The CSC matrix, and the CSR copy used by the drain functions
+            nbytes = 2 * (A.data.nbytes + A.indices.nbytes + A.indptr.nbytes)
+        nbytes += pits[0].nbytes + pits[1].nbytes
+        self._cache_put(('connectivity', key), (A, drain_funcs, pits), nbytes)
+        return A, drain_funcs, pits
+
+    def _get_chunk_flats(self, chunk_pits, te, be, le, re):
+        """
+        Returns the flats of the chunk [te:be, le:re], without the pits
+        drained by the chunks in chunk_pits (as (pits, shape, offset), see
+        _update_pits). Chunks are drained in order, so a pit in the overlap
+        with an earlier chunk is drained by that chunk, and it is not drained
+        again towards the border of this chunk.
+        """
+        flats = self.flats[te:be, le:re].copy()
+        for (ids, _), shape, offset in chunk_pits:
+            i, j = np.unravel_index(ids, shape)
+            i, j = i + offset[0] - te, j + offset[1] - le
+            I = (i >= 0) & (i < be - te) & (j >= 0) & (j < re - le)
+            flats[i[I], j[I]] = False
+        return flats
+
+    def _update_pits(self, pits, shape, offset=(0, 0)):
+        """
+        Sets the slope magnitude of the pits drained by
+        _mk_connectivity_pits, and removes them from the flats mask, so that
+        the TWI can be computed. pits are the (ids, mag) of a chunk of the
+        given shape, whose top-left corner is at offset. Pits that were
+        already updated (from an overlapping chunk) are left unchanged.
+        """
+        ids, pit_mag = pits
+        i, j = np.unravel_index(ids, shape)
+        i, j = i + offset[0], j + offset[1]
+        I = self.flats[i, j]
+        self.mag[i[I], j[I]] = pit_mag[I]
+        self.flats[i[I], j[I]] = False
+
+    def _get_uca_solver(self, A, shape, key=None):
+        """
+        Returns the sparse LU factorization (scipy.sparse.linalg.splu) of
+        I - A, where the rows of the adjacency matrix A that drain into the
+        edge of the chunk are zeroed. Solving with this gives the area
+        drained from the edges in _calc_uca_chunk_update
+        (uca_update_method = 'solve'). The factorization is cached like the
+        connectivity.
+
+        Returns None if the chunk has circular drainage, and the chunk is
+        drained instead. Draining stops at a circular reference, but the
+        solve would keep going around it: a cycle whose proportions multiply
+        to p < 1 multiplies its area by 1 / (1 - p), and p = 1 is singular.
+        """
+        entry = self._cache_get(('solver', key))
+        if entry is not None:
+            return entry[0]
+
+        if isinstance(A, DrainageNetwork):
+            A = A.tocsc()
+        not_edge = np.ones(shape, bool)
+        not_edge[1:-1, 1:-1] = False
+        not_edge = ~not_edge.ravel()
+        # The edges only drain, they do not receive anything
+        A = sps.csc_matrix(sps.diags(not_edge.astype('float64')) * A)
+        A.eliminate_zeros()
+        n_components = spcg.connected_components(A, directed=True,
+                                                 connection='strong')[0]
+        solver = None
+        nbytes = 0
+        if n_components == A.shape[0] and not A.diagonal().any():
+            M = sps.identity(A.shape[0], format='csc') - A
+            solver = spsl.splu(M.tocsc())
+            nbytes = 12 * (solver.L.nnz + solver.U.nnz) + 16 * A.shape[0]
+        self._cache_put(('solver', key), (solver, ), nbytes)
+        return solver
+
+    def _solve_uca_update(self, solver, area, ids, edge_todo_tile=None):
+        """
+        Drains the area (and edge_todo_tile) from the edge pixels in ids
+        using the factorization from _get_uca_solver. On an acyclic drainage
+        network this gives the same result as drain_area with skip_edge.
+
+        Returns
+        --------
+        area : ndarray
+            The area, with the edges unchanged
+        edge_todo_tile : ndarray (bool)
+            None if edge_todo_tile is None
+        """
+        interior = np.zeros(area.shape, bool)
+        interior[1:-1, 1:-1] = True
+        interior = interior.ravel()
+        area = area.copy()
+
+        # Second column: every pixel that is drained has a value > 0
+        rhs = np.column_stack([np.where(ids, np.nan_to_num(area.ravel()), 0),
+                               ids.astype('float64')])
+        x = solver.solve(rhs)
+        area.ravel()[interior] = x[interior, 0]
+        if edge_todo_tile is None:
+            return area, None
+
+        drained = x[:, 1] > 0
+        todo = edge_todo_tile.astype('float64').ravel()
+        todo[drained] = solver.solve(todo * drained)[drained]
+        return area, todo.reshape(edge_todo_tile.shape).astype(bool)
+
+    def _cache_get(self, key):
+        """
+        Returns the entry for key from the chunk connectivity cache (and
+        marks it as most recently used), or None.
+        """
+        cache = self._connectivity_cache
+        if key[1] is None or cache is None or key not in cache:
+            return None
+        entry, nbytes = cache.pop(key)
+        cache[key] = (entry, nbytes)  # Most recently used goes last
+        return entry
+
+    def _cache_put(self, key, entry, nbytes):
+        """
+        Adds entry (which takes nbytes of memory) to the chunk connectivity
+        cache, evicting the least recently used entries to stay within
+        uca_connectivity_cache_mb.
+        """
+        cache = self._connectivity_cache
+        budget = self.uca_connectivity_cache_mb * 2**20
+        if key[1] is None or cache is None or nbytes > budget:
+            return
+        while cache and self._connectivity_cache_nbytes + nbytes > budget:
+            _, (_, old_nbytes) = cache.popitem(last=False)
+            self._connectivity_cache_nbytes -= old_nbytes
+        cache[key] = (entry, nbytes)
+        self._connectivity_cache_nbytes += nbytes
+
+    def _mk_uca_connectivity(self, section, proportion, flats, elev, mag, dX,
+                             dY):
+        """
+        Returns the DrainageNetwork or the adjacency matrix (CSC) for the UCA
+        calculation, depending on uca_network, and the drained pits (see
+        _mk_connections)
+        """
+        if self.uca_network == 'receivers' and CYTHON:
+            return self._mk_drainage_network(section, proportion, flats, elev,
+                                             mag, dX, dY)
+        elif self.uca_network in ['receivers', 'matrix']:
+            return self._mk_adjacency_matrix(section, proportion, flats, elev,
+                                             mag, dX, dY)
+        raise RuntimeError("Unknown uca_network '%s'" % self.uca_network)
+
+    def _get_drain_funcs(self, A):
+        """
+        Returns the Cython drain_connections and drain_area functions for the
+        connectivity A (a DrainageNetwork, or a CSC adjacency matrix drained
+        using uca_drain_method), bound to the connectivity arrays. Without
+        the Cython functions, the numba queue versions are returned instead.
+
+        Returns
+        --------
+        drain_connections : function
+            drain_connections(arr, ids, set_to)
+        drain_area : function
+            drain_area(area, done, ids, n_rows, n_cols, edge_todo=None,
+                       edge_todo_no_mask=None, skip_edge=0)
+        """
+        if isinstance(A, DrainageNetwork):
+            def drain_connections(arr, ids, set_to=0):
+                return cyutils.drain_connections_network(
+                    arr, ids, A.j1, A.j2, A.extra_i, A.extra_j, set_to)
+
+            def drain_area(area, done, ids, *args, **kwargs):
+                return cyutils.drain_area_network(
+                    area, done, ids, A.j1, A.j2, A.p1, A.p2,
+                    A.extra_i, A.extra_j, A.extra_p, *args, **kwargs)
+            return drain_connections, drain_area
+
+        if self.uca_drain_method not in ['queue', 'iterative']:
+            raise RuntimeError("Unknown uca_drain_method '%s'"
+                               % self.uca_drain_method)
+        if not CYTHON:
+            # Both methods give identical results, so numba only implements
+            # the queue
+            cy_connections = nbutils.drain_connections_queue
+            cy_area = nbutils.drain_area_queue
+        elif self.uca_drain_method == 'queue':
+            cy_connections = cyutils.drain_connections_queue
+            cy_area = cyutils.drain_area_queue
+        else:
+            cy_connections = cyutils.drain_connections
+            cy_area = cyutils.drain_area
+        B = A.tocsr()
+
+        def drain_connections(arr, ids, set_to=0):
+            return cy_connections(arr, ids, A.indptr, A.indices, set_to)
+
+        def drain_area(area, done, ids, *args, **kwargs):
+            return cy_area(area, done, ids, A.indptr, A.indices, A.data,
+                           B.indptr, B.indices, *args, **kwargs)
+        return drain_connections, drain_area
 
     def _drain_step(self, A, ids, area, done, edge_todo):
         """
@@ -1805,52 +2746,45 @@ class DEMProcessor(object):
         d1, d2, theta = _get_d1_d2(dX, dY, 0, facets[0][1], facets[0][2], shp)
         if dX.size > 1:
             theta = np.row_stack((theta[0, :], theta, theta[-1, :]))
+        # theta is a column, which broadcasts along the rows of the chunk
+        pi2_theta = np.pi / 2 - theta
         # Which quadrant am I in?
         section = ((direction / np.pi * 2.0) // 1).astype('int8') # TODO DTYPE
         # Gets me in the quadrant
         quadrant = (direction - np.pi / 2.0 * section)
-        proportion = np.full_like(quadrant, np.nan)
+        # Each quadrant is split into two facets at the angle theta (even
+        # quadrants) or pi / 2 - theta (odd quadrants). The proportion is the
+        # position of the direction within its facet:
+        #     quadrant / lower_width                 (first facet)
+        #     (quadrant - lower_width) / upper_width (second facet)
+        odd = (section % 2) == 1
+        lower_width = np.where(odd, pi2_theta, theta)
+        upper = quadrant > lower_width  # greater than because of ties resolution b4
         # Now which section within the quadrant
-        section = section * 2 \
-            + (quadrant > theta.repeat(data.shape[1], 1)) * (section % 2 == 0) \
-            + (quadrant > (np.pi/2 - theta.repeat(data.shape[1], 1))) \
-            * (section % 2 == 1)  # greater than because of ties resolution b4
-
-        # %%    Calculate proportion
-        # As a side note, it's crazy to me how:
-        #    _get_d1_d2 needs to use indices 0, 3, 4, 7,
-        #    section uses even/odd (i.e. % 2)
-        #    proportion uses indices (0, 1, 4, 5) {ALl of them different! ARG!}
-        I1 = (section == 0) | (section == 1) | (section == 4) | (section == 5)
-    #    I1 = section % 2 == 0
-        I = I1 & (quadrant <= theta.repeat(data.shape[1], 1))
-        proportion[I] = quadrant[I] / theta.repeat(data.shape[1], 1)[I]
-        I = I1 & (quadrant > theta.repeat(data.shape[1], 1))
-        proportion[I] = (quadrant[I] - theta.repeat(data.shape[1], 1)[I]) \
-            / (np.pi / 2 - theta.repeat(data.shape[1], 1)[I])
-        I = (~I1) & (quadrant <= (np.pi / 2 - theta.repeat(data.shape[1], 1)))
-        proportion[I] = (quadrant[I]) \
-            / (np.pi / 2 - theta.repeat(data.shape[1], 1)[I])
-        I = (~I1) & (quadrant > (np.pi / 2 - theta.repeat(data.shape[1], 1)))
-        proportion[I] = (quadrant[I] - (np.pi / 2 - theta.repeat(data.shape[1], 1)[I])) \
-            / (theta.repeat(data.shape[1], 1)[I])
-        # %%Finish Proportion Calculation
+        section *= 2
+        section += upper
+        proportion = quadrant - lower_width * upper
+        proportion /= np.where(odd != upper, pi2_theta, theta)
+        del odd, upper, lower_width, quadrant
         section[flats] = FLAT_ID_INT
         proportion[flats] = FLAT_ID
 
         section[section == 8] = 0  # Fence-post error correction
-        proportion = (1 + adjust[section]) / 2.0 - adjust[section] * proportion
+        adj = adjust[section]
+        proportion *= -adj
+        proportion += (1 + adj) / 2.0
 
-        return section, proportion
+        return section, proportion.astype(self.float_dtype, copy=False)
 
-    def _mk_adjacency_matrix(self, section, proportion, flats, elev, mag, dX, dY):
+    def _mk_connections(self, section, proportion, flats, elev, mag, dX, dY):
         """
-        Calculates the adjacency of connectivity matrix. This matrix tells
-        which pixels drain to which.
-
-        For example, the pixel i, will recieve area from np.nonzero(A[i, :])
-        at the proportions given in A[i, :]. So, the row gives the pixel
-        drain to, and the columns the pixels drained from.
+        Calculates the connections between pixels. Returns the flattened
+        donor (i), receiver (j) and proportion (mat_data) arrays, and a
+        boolean array marking the connections that should be kept. The first
+        two NN entries are the j1 and j2 D-infinity neighbours of every pixel,
+        the connections for pits/flats follow. The last value returned is the
+        (ids, mag) of the pits drained by _mk_connectivity_pits (empty if
+        drain_pits is off). flats and mag are not modified.
         """
         shp = section.shape
         mat_data = np.row_stack((proportion, 1 - proportion))
@@ -1865,9 +2799,10 @@ class DEMProcessor(object):
         i = np.row_stack((i12, i12))
         
         # connectivity for flats/pits
+        pits = (np.zeros(0, 'int64'), np.zeros(0, 'float64'))
         if self.drain_pits:
-            pit_i, pit_j, pit_prop, flats, mag = \
-                self._mk_connectivity_pits(i12, flats, elev, mag, dX, dY)
+            pit_i, pit_j, pit_prop, pits = \
+                self._mk_connectivity_pits(i12, flats, elev, dX, dY)
 
             j = np.concatenate([j.ravel(), pit_j]).astype('int64')
             i = np.concatenate([i.ravel(), pit_i]).astype('int64')
@@ -1879,7 +2814,7 @@ class DEMProcessor(object):
                     i12, j1, j2, mat_data, flats, elev, mag)
 
             j = np.concatenate([j.ravel(), flat_j]).astype('int64')
-            i = np.concatenate([i.ravel(), flat_j]).astype('int64')
+            i = np.concatenate([i.ravel(), flat_i]).astype('int64')
             mat_data = np.concatenate([mat_data.ravel(), flat_prop])
 
 
@@ -1891,6 +2826,35 @@ class DEMProcessor(object):
         I = ~np.isnan(mat_data) & (j != -1) & (mat_data > 1e-8) \
             & (elev.ravel()[j] <= elev.ravel()[i])
 
+        return i.ravel(), j.ravel(), mat_data.ravel(), np.asarray(I).ravel(), \
+            pits
+
+    def _mk_drainage_network(self, section, proportion, flats, elev, mag, dX,
+                             dY):
+        """
+        Calculates the compact DrainageNetwork, which holds the same
+        information as the adjacency matrix. Also returns the drained pits
+        (see _mk_connections).
+        """
+        i, j, mat_data, I, pits = self._mk_connections(
+            section, proportion, flats, elev, mag, dX, dY)
+        return DrainageNetwork(section.shape, i, j, mat_data, I,
+                               self.float_dtype), pits
+
+    def _mk_adjacency_matrix(self, section, proportion, flats, elev, mag, dX, dY):
+        """
+        Calculates the adjacency of connectivity matrix. This matrix tells
+        which pixels drain to which.
+
+        For example, the pixel i, will recieve area from np.nonzero(A[i, :])
+        at the proportions given in A[i, :]. So, the row gives the pixel
+        drain to, and the columns the pixels drained from.
+
+        Also returns the drained pits (see _mk_connections).
+        """
+        NN = np.prod(section.shape)
+        i, j, mat_data, I, pits = self._mk_connections(
+            section, proportion, flats, elev, mag, dX, dY)
         mat_data = mat_data[I]
         j = j[I]
         i = i[I]
@@ -1905,7 +2869,7 @@ class DEMProcessor(object):
         normalize = np.array(A.sum(0) + 1e-16).squeeze()
         A = np.dot(A, sps.diags(1/normalize, 0))
 
-        return A
+        return A, pits
 
     def _mk_connectivity(self, section, i12, j1, j2):
         """
@@ -2006,96 +2970,153 @@ class DEMProcessor(object):
 
         return j1, j2
 
-    def _mk_connectivity_pits(self, i12, flats, elev, mag, dX, dY):
+    def _mk_connectivity_pits(self, i12, flats, elev, dX, dY):
         """
         Helper function for _mk_adjacency_matrix. This is a more general
         version of _mk_adjacency_flats which drains pits and flats to nearby
-        but non-adjacent pixels. The slope magnitude (and flats mask) is
-        updated for these pits and flats so that the TWI can be computed.
+        but non-adjacent pixels. The slope magnitude and flats mask are not
+        modified here: the drained pits and their slope magnitudes are
+        returned, and calc_uca updates them (see _update_pits) so that the
+        TWI can be computed.
         """
         
         e = elev.data.ravel()
 
-        pit_i = []
-        pit_j = []
-        pit_prop = []
-        warn_pits = []
-        
         pits = i12[flats & (elev > 0)]
         I = np.argsort(e[pits])
-        for pit in pits[I]:
-            # find drains
-            pit_area = np.array([pit], 'int64')
-
-            drain = None
-            epit = e[pit]
-            for it in range(self.drain_pits_max_iter):
-                border = get_border_index(pit_area, elev.shape, elev.size)
+        pits = pits[I]
+
+        # find drains
+        pit_id, drain, warn = self._find_pit_drains(pits, e, elev.shape)
+
+        # filter by drain distance in coordinate space
+        ipit, jpit = np.unravel_index(pits, elev.shape)
+        Idrain, Jdrain = np.unravel_index(drain, elev.shape)
+        if self.drain_pits_max_dist:
+            dij = np.sqrt((ipit[pit_id] - Idrain)**2
+                          + (jpit[pit_id] - Jdrain)**2)
+            b = dij <= self.drain_pits_max_dist
+            pit_id, drain, Idrain, Jdrain = \
+                pit_id[b], drain[b], Idrain[b], Jdrain[b]
+
+        # calculate real distances
+        dx = _get_dX_mean_batch(dX, ipit[pit_id], Idrain) \
+            * (jpit[pit_id] - Jdrain)
+        dy = _sum_slices_batch(dY, ipit[pit_id], Idrain)
+        dxy = np.sqrt(dx**2 + dy**2)
+
+        # filter by drain distance in real space
+        if self.drain_pits_max_dist_XY:
+            b = dxy <= self.drain_pits_max_dist_XY
+            pit_id, drain, dxy = pit_id[b], drain[b], dxy[b]
+
+        # pits without drains left
+        n_drains = np.bincount(pit_id, minlength=pits.size)
+        warn |= n_drains == 0
+
+        # calculate magnitudes
+        s = (e[pits[pit_id]] - e[drain]) / dxy
+
+        # connectivity info
+        # TODO proportion calculation (_mk_connectivity_flats used elev?)
+        pit_i = pits[pit_id]
+        pit_j = drain
+        pit_prop = s
+
+        # pit magnitude, for the drained pits
+        drained = n_drains > 0
+        pit_mag = _mean_groups_batch(s, n_drains[drained])
+
+        if warn.any():
+            warnings.warn("Warning %d pits had no place to drain to in this "
+                          "chunk" % warn.sum())
 
-                eborder = e[border]
-                emin = eborder.min()
-                if emin < epit:
-                    drain = border[eborder < epit]
-                    break
+        return (np.array(pit_i, 'int64'),
+                np.array(pit_j, 'int64'),
+                np.array(pit_prop, 'float64'),
+                (np.array(pits[drained], 'int64'),
+                 np.array(pit_mag, 'float64')))
 
-                pit_area = np.concatenate([pit_area, border[eborder == emin]])
+    def _find_pit_drains(self, pits, e, shape):
+        """
+        Helper function for _mk_connectivity_pits. The area of every pit is
+        grown by its lowest border pixels (for up to drain_pits_max_iter
+        iterations), until the border has pixels lower than the pit: these
+        are the drains.
 
-            if drain is None:
-                warn_pits.append(pit)
-                continue
-            
-            ipit, jpit = np.unravel_index(pit, elev.shape)
-            Idrain, Jdrain = np.unravel_index(drain, elev.shape)
-
-            # filter by drain distance in coordinate space
-            if self.drain_pits_max_dist:
-                dij = np.sqrt((ipit - Idrain)**2 + (jpit-Jdrain)**2)
-                b = dij <= self.drain_pits_max_dist
-                if not b.any():
-                    warn_pits.append(pit)
-                    continue
-                drain = drain[b]
-                Idrain = Idrain[b]
-                Jdrain = Jdrain[b]
-            
-            # calculate real distances
-            dx = [_get_dX_mean(dX, ipit, idrain) * (jpit - jdrain)
-                  for idrain, jdrain in zip(Idrain, Jdrain)]
-            dy = [dY[make_slice(ipit, idrain)].sum() for idrain in Idrain]
-            dxy = np.sqrt(np.array(dx)**2 + np.array(dy)**2)
-
-            # filter by drain distance in real space
-            if self.drain_pits_max_dist_XY:
-                b = dxy <= self.drain_pits_max_dist_XY
-                if not b.any():
-                    warn_pits.append(pit)
+        Returns
+        --------
+        pit_id : np.ndarray(dtype=int64)
+            Index into pits of the pit for every drain
+        drain : np.ndarray(dtype=int64)
+            The drains, sorted by pit and then by index
+        warn : np.ndarray(dtype=bool)
+            Mask of the pits that have no drain
+        """
+        m, n = shape
+        if self.drain_pits_max_iter < 1:
+            return (np.zeros(0, 'int64'), np.zeros(0, 'int64'),
+                    np.ones(pits.size, bool))
+        # Most pits have a lower neighbor, which are found all at once
+        offsets = [(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1),
+                   (1, 0), (1, 1)]  # sorted by index
+        ipit, jpit = np.unravel_index(pits, shape)
+        nbrs = np.zeros((pits.size, len(offsets)), 'int64')
+        lower = np.zeros((pits.size, len(offsets)), bool)
+        border_nan = np.zeros(pits.size, bool)
+        for k, (di, dj) in enumerate(offsets):
+            valid = (ipit + di >= 0) & (ipit + di < m) \
+                & (jpit + dj >= 0) & (jpit + dj < n)
+            nbrs[:, k] = pits + di * n + dj
+            enb = e[nbrs[valid, k]]
+            lower[valid, k] = enb < e[pits[valid]]
+            border_nan[valid] |= np.isnan(enb)
+        # The minimum of the border is nan if it has any nan
+        lower[border_nan] = False
+        first = lower.any(1)
+        pit_id = np.repeat(np.arange(pits.size), lower.sum(1))
+        drain = nbrs[lower]
+
+        # The others are grown one by one
+        grow = np.nonzero(~first & ~border_nan)[0]
+        warn = border_nan.copy()
+        if CYTHON:
+            grow_id, grow_drain, grow_warn = cyutils.pit_drains(
+                e.astype('float64'), pits[grow], m, n,
+                self.drain_pits_max_iter)
+            grow_id = grow[grow_id]
+            warn[grow[grow_warn]] = True
+        else:
+            grow_id, grow_drain = [], []
+            for i in grow:
+                pit = pits[i]
+                pit_area = np.array([pit], 'int64')
+                drain_i = None
+                epit = e[pit]
+                for it in range(self.drain_pits_max_iter):
+                    border = get_border_index(pit_area, shape, m * n)
+
+                    eborder = e[border]
+                    emin = eborder.min()
+                    if emin < epit:
+                        drain_i = border[eborder < epit]
+                        break
+
+                    pit_area = np.concatenate([pit_area,
+                                               border[eborder == emin]])
+                if drain_i is None:
+                    warn[i] = True
                     continue
-                drain = drain[b]
-                dxy = dxy[b]
-            
-            # calculate magnitudes
-            s = (e[pit]-e[drain]) / dxy
-
-            # connectivity info
-            # TODO proportion calculation (_mk_connectivity_flats used elev?)
-            pit_i += [pit for i in drain]
-            pit_j += drain.tolist()
-            pit_prop += s.tolist()
-            
-            # update pit magnitude and flats mask
-            mag[ipit, jpit] = np.mean(s)
-            flats[ipit, jpit] = False
+                grow_id += [i] * drain_i.size
+                grow_drain += drain_i.tolist()
+            grow_id = np.array(grow_id, 'int64')
+            grow_drain = np.array(grow_drain, 'int64')
 
-        if warn_pits:
-            warnings.warn("Warning %d pits had no place to drain to in this "
-                          "chunk" % len(warn_pits))
-        
-        # Note: returning flats and mag here is not strictly necessary
-        return (np.array(pit_i, 'int64'),
-                np.array(pit_j, 'int64'),
-                np.array(pit_prop, 'float64'),
-                flats,
-                mag)
+        # Back in the order of the pits
+        pit_id = np.concatenate([pit_id, grow_id])
+        drain = np.concatenate([drain, grow_drain])
+        I = np.argsort(pit_id, kind='mergesort')
+        return pit_id[I], drain[I], warn
 
     def _mk_connectivity_flats(self, i12, j1, j2, mat_data, flats, elev, mag):
         """
@@ -2108,125 +3129,137 @@ class DEMProcessor(object):
         go towards that pixel. If the border has pixels with similar elevation,
         then the area will be distributed amongst all the border pixels
         proportional to their elevation.
+
+        All the flats are handled at once: their pixels are stored
+        contiguously by region (see _get_flat_ids), and the borders, drains
+        and proportions are computed for every region with segmented
+        reductions, so only the pixels on and around the flats are visited.
         """
         nn, mm = flats.shape
         NN = np.prod(flats.shape)
         # Label the flats
         assigned, n_flats = spndi.label(flats, FLATS_KERNEL3)
+        if n_flats == 0:
+            return j1, j2, mat_data, np.array([], 'int64'), \
+                np.array([], 'int64'), np.array([], 'float64')
 
         flat_ids, flat_coords, flat_labelsf = _get_flat_ids(assigned)
-        flat_j = [None] * n_flats
-        flat_prop = [None] * n_flats
-        flat_i = [None] * n_flats
-
-        # Temporary array to find the flats
-        edges = np.zeros_like(flats)
-        # %% Calcute the flat drainage
-        warn_flats = []
-        for ii in xrange(n_flats):
-            ids_flats = flat_ids[flat_coords[ii]:flat_coords[ii+1]]
-            edges[:] = 0
-            j = ids_flats % mm
-            i = ids_flats // mm
-            for iii in [-1, 0, 1]:
-                for jjj in [-1, 0, 1]:
-                    i_2 = i + iii
-                    j_2 = j + jjj
-                    ids_tmp = (i_2 >= 0) & (j_2 >= 0) & (i_2 < nn) & (j_2 < mm)
-                    edges[i_2[ids_tmp], j_2[ids_tmp]] += \
-                        FLATS_KERNEL3[iii+1, jjj+1]
-            edges.ravel()[ids_flats] = 0
-            ids_edge = np.argwhere(edges.ravel()).squeeze()
-
-            flat_elev_loc = elev.ravel()[ids_flats]
-            # It is possble for the edges to merge 2 flats, so we need to
-            # take the lower elevation to avoid large circular regions
-            flat_elev = flat_elev_loc.min()
-
-            loc_elev = elev.ravel()[ids_edge]
-            # Filter out any elevations larger than the flat elevation
-            # TODO: Figure out if this should be <= or <
-            I_filt = loc_elev < flat_elev
-            try:
-                loc_elev = loc_elev[I_filt]
-                loc_slope = mag.ravel()[ids_edge][I_filt]
-            except: # If this is fully masked out (i.e. inside a no-data area)
-                loc_elev = np.array([])
-                loc_slope = np.array([])
-
-            loc_dx = self.dX.mean()
-
-            # Now I have to figure out if I should just use the minimum or
-            # distribute amongst many pixels on the flat boundary
-            n = len(loc_slope)
-            if n == 0:  # Flat does not have anywhere to drain
-                # Let's see if the flat goes to the edge. If yes, we'll just
-                # distribute the area along the edge.
-                ids_flat_on_edge = ((ids_flats % mag.shape[1]) == 0) | \
-                    ((ids_flats % mag.shape[1]) == (mag.shape[1] - 1)) | \
-                    (ids_flats <= mag.shape[1]) | \
-                    (ids_flats >= (mag.shape[1] * (mag.shape[0] - 1)))
-                if ids_flat_on_edge.sum() == 0:
-                    warn_flats.append(ii)
+        flat_starts = flat_coords[:-1]
+        flat_seg = np.repeat(np.arange(n_flats), np.diff(flat_coords))
+        flat_elev_loc = elev.ravel()[flat_ids]
+        # It is possble for the edges to merge 2 flats, so we need to
+        # take the lower elevation to avoid large circular regions
+        flat_elev = np.minimum.reduceat(flat_elev_loc, flat_starts)
+
+        # %% Find the border pixels of every flat, sorted by flat then by id.
+        # The flats are labeled with FLATS_KERNEL3, so a neighbor that is
+        # not part of a flat is on the border of the flat it touches.
+        i = flat_ids // mm
+        j = flat_ids % mm
+        edge_keys = []
+        for iii in [-1, 0, 1]:
+            for jjj in [-1, 0, 1]:
+                if not FLATS_KERNEL3[iii + 1, jjj + 1] or iii == jjj == 0:
                     continue
-
-                drain_ids = ids_flats[ids_flat_on_edge]
-                loc_proportions = mag.ravel()[ids_flats[ids_flat_on_edge]]
-                loc_proportions /= loc_proportions.sum()
-
-                ids_flats = ids_flats[~ids_flat_on_edge]
-                # This flat is entirely on the edge of the image
-                if len(ids_flats) == 0:
-                    # therefore, whatever drains into it is done.
-                    continue
-                flat_elev_loc = flat_elev_loc[~ids_flat_on_edge]
-            else:  # Flat has a place to drain to
-                min_edges = np.zeros(loc_slope.shape, bool)
-                min_edges[np.argmin(loc_slope)] = True
-                # Add to the min edges any edge that is within an error
-                # tolerance as small as the minimum
-                min_edges = (loc_slope + loc_slope * loc_dx / 2) \
-                    >= loc_slope[min_edges]
-
-                drain_ids = ids_edge[I_filt][min_edges]
-
-                loc_proportions = loc_slope[min_edges]
-                loc_proportions /= loc_proportions.sum()
-
-            # Now distribute the connectivity amongst the chosen elevations
-            # proportional to their slopes
-
-            # First, let all the the ids in the flats drain to 1
-            # flat id (for ease)
-            one_id = np.zeros(ids_flats.size, bool)
-            one_id[np.argmin(flat_elev_loc)] = True
-
-            j1.ravel()[ids_flats[~one_id]] = ids_flats[one_id]
-            mat_data.ravel()[ids_flats[~one_id]] = 1
-            # Negative indices will be eliminated before making the matix
-            j2.ravel()[ids_flats[~one_id]] = -1
-            mat_data.ravel()[ids_flats[~one_id] + NN] = 0
-
-            # Now drain the 1 flat to the drains
-            j1.ravel()[ids_flats[one_id]] = drain_ids[0]
-            mat_data.ravel()[ids_flats[one_id]] = loc_proportions[0]
-            if len(drain_ids) > 1:
-                j2.ravel()[ids_flats[one_id]] = drain_ids[1]
-                mat_data.ravel()[ids_flats[one_id] + NN] = loc_proportions[1]
-
-            if len(loc_proportions > 2):
-                flat_j[ii] = drain_ids[2:]
-                flat_prop[ii] = loc_proportions[2:]
-                flat_i[ii] = np.ones(drain_ids[2:].size, 'int64') * ids_flats[one_id]
-        try:
-            flat_j = np.concatenate([fj for fj in flat_j if fj is not None])
-            flat_prop = \
-                np.concatenate([fp for fp in flat_prop if fp is not None])
-            flat_i = np.concatenate([fi for fi in flat_i if fi is not None])
-        except:
-            flat_j = np.array([], 'int64')
-            flat_prop = np.array([], 'float64')
-            flat_i = np.array([], 'int64')
+                i_2 = i + iii
+                j_2 = j + jjj
+                ids_tmp = (i_2 >= 0) & (j_2 >= 0) & (i_2 < nn) & (j_2 < mm)
+                ids_tmp[ids_tmp] = \
+                    ~flats.ravel()[i_2[ids_tmp] * mm + j_2[ids_tmp]]
+                edge_keys.append(flat_seg[ids_tmp] * NN
+                                 + i_2[ids_tmp] * mm + j_2[ids_tmp])
+        edge_keys = np.unique(np.concatenate(edge_keys))
+        edge_seg = edge_keys // NN
+        edge_ids = edge_keys % NN
+        del edge_keys
+
+        # Filter out any elevations larger than the flat elevation
+        # TODO: Figure out if this should be <= or <
+        I_filt = elev.ravel()[edge_ids] < flat_elev[edge_seg]
+        edge_seg = edge_seg[I_filt]
+        edge_ids = edge_ids[I_filt]
+        loc_slope = np.asarray(mag.ravel()[edge_ids], 'float64')
+        n_edges = np.bincount(edge_seg, minlength=n_flats)
+        loc_dx = self.dX.mean()
+
+        # %% Flats with a place to drain to: use the minimum slope, and any
+        # edge that is within an error tolerance as small as the minimum
+        has_edges = n_edges > 0
+        min_slope = np.zeros(n_flats)
+        if has_edges.any():
+            min_slope[has_edges] = np.minimum.reduceat(
+                loc_slope, np.cumsum(n_edges)[has_edges] - n_edges[has_edges])
+        min_edges = (loc_slope + loc_slope * loc_dx / 2) \
+            >= min_slope[edge_seg]
+        drain_seg = [edge_seg[min_edges]]
+        drain_ids = [edge_ids[min_edges]]
+        drain_prop = [loc_slope[min_edges]]
+        # All the pixels of these flats drain through the flat
+        member = has_edges[flat_seg]
+
+        # %% Flats that do not have anywhere to drain. Let's see if the flat
+        # goes to the edge. If yes, we'll just distribute the area along the
+        # edge.
+        no_edges = ~has_edges[flat_seg]
+        ids_flat_on_edge = ((flat_ids % mm) == 0) | \
+            ((flat_ids % mm) == (mm - 1)) | \
+            (flat_ids <= mm) | \
+            (flat_ids >= (mm * (nn - 1)))
+        on_edge = no_edges & ids_flat_on_edge
+        drain_seg.append(flat_seg[on_edge])
+        drain_ids.append(flat_ids[on_edge])
+        drain_prop.append(np.asarray(mag.ravel()[flat_ids[on_edge]],
+                                     'float64'))
+        # The rest of the flat drains to the pixels on the edge. If the flat
+        # is entirely on the edge of the image, whatever drains into it is
+        # done.
+        member |= no_edges & ~ids_flat_on_edge
+        warn_flats = np.nonzero(~has_edges & (np.bincount(
+            flat_seg[on_edge], minlength=n_flats) == 0))[0]
+
+        # Collect the drains by flat, keeping their order within each flat
+        drain_seg = np.concatenate(drain_seg)
+        order = np.argsort(drain_seg, kind='mergesort')
+        drain_seg = drain_seg[order]
+        drain_ids = np.concatenate(drain_ids)[order]
+        drain_prop = np.concatenate(drain_prop)[order]
+        n_drains = np.bincount(drain_seg, minlength=n_flats)
+        drain_prop /= np.bincount(drain_seg, drain_prop,
+                                  minlength=n_flats)[drain_seg]
+        drain_rank = np.arange(drain_seg.size) \
+            - (np.cumsum(n_drains) - n_drains)[drain_seg]
+
+        # Now distribute the connectivity amongst the chosen elevations
+        # proportional to their slopes
+        member &= (n_drains > 0)[flat_seg]
+        member = np.nonzero(member)[0]
+        member_seg = flat_seg[member]
+        # First, let all the the ids in the flats drain to 1
+        # flat id (for ease), the first lowest pixel of the flat
+        order = np.lexsort((member, flat_elev_loc[member], member_seg))
+        first = np.ones(order.size, bool)
+        first[1:] = member_seg[order][1:] != member_seg[order][:-1]
+        one_id = np.full(n_flats, -1, 'int64')
+        one_id[member_seg[order][first]] = flat_ids[member[order][first]]
+        others = flat_ids[member[order][~first]]
+        j1.ravel()[others] = one_id[flat_seg[member[order][~first]]]
+        mat_data.ravel()[others] = 1
+        # Negative indices will be eliminated before making the matix
+        j2.ravel()[others] = -1
+        mat_data.ravel()[others + NN] = 0
+
+        # Now drain the 1 flat to the drains
+        keep = one_id[drain_seg] >= 0
+        I = keep & (drain_rank == 0)
+        j1.ravel()[one_id[drain_seg[I]]] = drain_ids[I]
+        mat_data.ravel()[one_id[drain_seg[I]]] = drain_prop[I]
+        I = keep & (drain_rank == 1)
+        j2.ravel()[one_id[drain_seg[I]]] = drain_ids[I]
+        mat_data.ravel()[one_id[drain_seg[I]] + NN] = drain_prop[I]
+        I = keep & (drain_rank > 1)
+        flat_j = drain_ids[I].astype('int64')
+        flat_prop = drain_prop[I]
+        flat_i = one_id[drain_seg[I]]
 
         if len(warn_flats) > 0:
             warnings.warn("Warning %d flats had no place" % len(warn_flats) +
@@ -2249,19 +3282,25 @@ class DEMProcessor(object):
             gc.collect()  # Just in case
         min_area = self.twi_min_area
         min_slope = self.twi_min_slope
-        twi = self.uca.copy()
-        if self.apply_twi_limits_on_uca:
-            twi[twi > self.uca_saturation_limit * min_area] = \
-                self.uca_saturation_limit * min_area
-        gc.collect()  # Just in case
-        twi = np.log((twi) / (self.mag + min_slope))
-        # apply the cap
-        if self.apply_twi_limits:
-            twi_sat_value = \
-                np.log(self.uca_saturation_limit * min_area / min_slope)
-            twi[twi > twi_sat_value] = twi_sat_value
-        # multiply by 10 for better integer resolution when storing
-        self.twi = twi * 10
+        twi = self._working_array(0, self.float_dtype, self.uca.shape)
+        self.twi = self._working_array(0, self.float_dtype, self.uca.shape)
+        # Calculate in strips, so that only a strip of each array has to be
+        # in memory
+        for i in xrange(0, twi.shape[0], self.chunk_size_uca):
+            rows = slice(i, i + self.chunk_size_uca)
+            twi_i = self.uca[rows].copy()
+            if self.apply_twi_limits_on_uca:
+                twi_i[twi_i > self.uca_saturation_limit * min_area] = \
+                    self.uca_saturation_limit * min_area
+            twi_i = np.log((twi_i) / (self.mag[rows] + min_slope))
+            # apply the cap
+            if self.apply_twi_limits:
+                twi_sat_value = \
+                    np.log(self.uca_saturation_limit * min_area / min_slope)
+                twi_i[twi_i > twi_sat_value] = twi_sat_value
+            twi[rows] = twi_i
+            # multiply by 10 for better integer resolution when storing
+            self.twi[rows] = twi_i * 10
 
         gc.collect()  # Just in case
         return twi
@@ -2361,6 +3400,37 @@ class DEMProcessor(object):
         del td_mag
 
 
+# State of the worker processes used by DEMProcessor._slopes_directions_chunks:
+# a DEMProcessor with the options of the calling one, and the elevation data
+# in shared memory (RawArrays, or the memory-mapped arrays of the
+# out-of-core mode)
+_slopes_directions_worker = {}
+
+
+def _init_slopes_directions_worker(cls, options, shared_data, shared_mask,
+                                   dtype, shape, dX, dY):
+    data = shared_data
+    if not isinstance(data, np.ndarray):
+        data = np.frombuffer(shared_data, dtype).reshape(shape)
+    if shared_mask is not None:
+        mask = shared_mask
+        if not isinstance(mask, np.ndarray):
+            mask = np.frombuffer(shared_mask, bool).reshape(shape)
+        data = np.ma.masked_array(data, mask)
+    processor = cls.__new__(cls)
+    processor.__dict__.update(options)
+    _slopes_directions_worker['processor'] = processor
+    _slopes_directions_worker['data'] = data
+    _slopes_directions_worker['dX'] = dX
+    _slopes_directions_worker['dY'] = dY
+
+
+def _slopes_directions_chunk_worker(args):
+    w = _slopes_directions_worker
+    return w['processor']._slopes_directions_chunk(w['data'], w['dX'],
+                                                   w['dY'], *args)
+
+
 def _get_flat_ids(assigned):
     """
     This is a helper function to recover the coordinates of regions that have
@@ -2389,7 +3459,7 @@ def _get_flat_ids(assigned):
     # MPU optimization:
     # Let's segment the regions and store in a sparse format
     # First, let's use where once to find all the information we want
-    ids_labels = np.arange(len(assigned.ravel()), 'int64')
+    ids_labels = np.arange(assigned.size, dtype='int64')
     I = ids_labels[assigned.ravel().astype(bool)]
     labels = assigned.ravel()[I]
     # Now sort these arrays by the label to figure out where to segment
@@ -2407,6 +3477,30 @@ def _tarboton_slopes_directions(data, dX, dY, facets, ang_adj):
     """
     Calculate the slopes and directions based on the 8 sections from
     Tarboton http://www.neng.usu.edu/cee/faculty/dtarb/96wr03137.pdf
+
+    Uses the single-pass compiled kernel when it is available, otherwise
+    falls back to _tarboton_slopes_directions_numpy. The kernel is not used
+    when data has masked values, because the NumPy version then operates on
+    the masked-array fill values next to them.
+    """
+    masked = isinstance(data, np.ma.MaskedArray)
+    single = data.dtype == np.float32
+    if CYTHON and min(data.shape) > 2 and np.size(dX) == data.shape[0] - 1 \
+            and not np.ma.getmaskarray(data).any() \
+            and (data.dtype.kind == 'i' or data.dtype in [np.float32,
+                                                          np.float64]):
+        data = np.ascontiguousarray(np.ma.getdata(data), 'float64')
+        facets = np.array([f[1] + f[2] for f in facets], 'int64')
+        return cyutils.tarboton_slopes_directions(
+            data, np.asarray(dX, 'float64').ravel(),
+            np.asarray(dY, 'float64').ravel(), facets,
+            np.asarray(ang_adj, 'int64'), FLAT_ID_INT, masked, single)
+    return _tarboton_slopes_directions_numpy(data, dX, dY, facets, ang_adj)
+
+
+def _tarboton_slopes_directions_numpy(data, dX, dY, facets, ang_adj):
+    """
+    NumPy version of _tarboton_slopes_directions
     """
     shp = np.array(data.shape) - 1
 
@@ -2641,4 +3735,46 @@ def _get_dX_mean(dX, i1, i2):
     if i1 == i2:
         return dX[min(i1, dX.size-1)]
     else:
-        return dX[make_slice(i1, i2)].mean()
\ No newline at end of file
+        return dX[make_slice(i1, i2)].mean()
+
+
+def _sum_slices_batch(arr, i1, i2):
+    """
+    Same as [arr[make_slice(a, b)].sum() for a, b in zip(i1, i2)]. The slices
+    with the same length are summed together, so that the results are
+    identical.
+    """
+    lo = np.minimum(i1, i2)
+    length = np.abs(i1 - i2)
+    out = np.zeros(lo.size)
+    for L in np.unique(length):
+        if L == 0:
+            continue
+        I = length == L
+        out[I] = arr[lo[I][:, None] + np.arange(L)].sum(1)
+    return out
+
+
+def _get_dX_mean_batch(dX, i1, i2):
+    """
+    Same as [_get_dX_mean(dX, a, b) for a, b in zip(i1, i2)]
+    """
+    out = _sum_slices_batch(dX, i1, i2)
+    length = np.abs(i1 - i2)
+    same = length == 0
+    out[~same] /= length[~same]
+    out[same] = dX[np.minimum(i1[same], dX.size - 1)]
+    return out
+
+
+def _mean_groups_batch(arr, counts):
+    """
+    Means of consecutive groups of counts[i] values of arr, the same as
+    np.mean for every group.
+    """
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    out = np.zeros(counts.size)
+    for L in np.unique(counts):
+        I = counts == L
+        out[I] = arr[starts[I][:, None] + np.arange(L)].sum(1) / L
+    return out
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+   Copyright 2015 Creare
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+Compares utils.get_distance with the previous implementation (repeated
+minimum filters over the whole region) on the synthetic flats of
+test_pydem.case_ring_flat and test_pydem.case_line_flat.
+
+Usage: python benchmark_get_distance.py [NN ...]
+"""
+if __name__ == "__main__":
+    import sys
+    import time
+    import numpy as np
+    import scipy.ndimage as spndi
+    from scipy.ndimage.filters import minimum_filter
+    from pydem.test_pydem import case_ring_flat, case_line_flat
+    from pydem.utils import get_distance, get_border_mask, CYTHON
+
+    _ORTH2 = np.array([[0, 1, 0], [1, 1, 1], [0, 1, 0]])
+    _SQRT2 = np.sqrt(2.0)
+
+    def get_distance_filter(region, src):
+        # The previous implementation of utils.get_distance
+        dmax = float(region.size)
+        d = np.full(region.shape, dmax)
+        d[src] = 0
+        for n in range(region.size):
+            d_orth = minimum_filter(d, footprint=_ORTH2) + 1
+            d_diag = minimum_filter(d, (3, 3)) + _SQRT2
+            d_adj = np.minimum(d_orth[region], d_diag[region])
+            d[region] = np.minimum(d_adj, d[region])
+            if (d[region] < dmax).all():
+                break
+        return d
+
+    def timeit(func, *args):
+        best = np.inf
+        for i in xrange(3):
+            t0 = time.time()
+            out = func(*args)
+            best = min(best, time.time() - t0)
+        return best, out
+
+    sizes = [int(n) for n in sys.argv[1:]] or [64, 128, 256, 512]
+    print 'Cython:', CYTHON
+    print "%-10s %6s %8s %8s %12s %12s %8s %10s" % (
+        'case', 'NN', 'region', 'src', 'filter [s]', 'new [s]', 'speedup',
+        'max diff')
+    for NN in sizes:
+        x, y = np.mgrid[-1:1:np.complex(0, NN), -1:1:np.complex(0, NN)]
+        cases = [('ring_flat', case_ring_flat(x, y, [slice(NN//2, NN//2+1),
+                                                     slice(NN//2, NN)])[0]),
+                 ('line_flat', case_line_flat(x, y, [1, 0])[0])]
+        for name, raster in cases:
+            raster = np.ma.filled(raster, np.nan)
+            # The largest flat, with its sources and drains as in _fill_flat
+            flat = spndi.minimum_filter(raster, (3, 3)) >= raster
+            labels, n = spndi.label(flat, structure=np.ones((3, 3)))
+            region = labels == np.argmax(np.bincount(labels.ravel())[1:]) + 1
+            e = raster[region][0]
+            border = get_border_mask(region)
+            for src_name, src in [('source', border & (raster > e)),
+                                  ('drain', border & (raster == e))]:
+                if not src.any():
+                    continue
+                t_old, d_old = timeit(get_distance_filter, region, src)
+                t_new, d_new = timeit(get_distance, region, src)
+                diff = np.abs(d_old - d_new)[region].max()
+                print "%-10s %6d %8d %8s %12.4g %12.4g %8.1f %10.3g" % (
+                    name, NN, region.sum(), src_name, t_old, t_new,
+                    t_old / t_new, diff)
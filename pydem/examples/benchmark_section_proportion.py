@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+   Copyright 2015 Creare
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+Compares DEMProcessor._calc_uca_section_proportion with the previous
+implementation (one full-size theta grid and boolean mask per facet case) on
+random directions, and checks that they agree.
+
+Usage: python benchmark_section_proportion.py [NN ...]
+"""
+if __name__ == "__main__":
+    import sys
+    import time
+    import numpy as np
+    from pydem.dem_processing import (DEMProcessor, FLAT_ID, FLAT_ID_INT,
+                                      _get_d1_d2)
+
+    def section_proportion_masks(data, dX, dY, direction, flats, facets,
+                                 adjust):
+        # The previous implementation of _calc_uca_section_proportion
+        shp = np.array(data.shape) - 1
+        d1, d2, theta = _get_d1_d2(dX, dY, 0, facets[0][1], facets[0][2],
+                                   shp)
+        if dX.size > 1:
+            theta = np.row_stack((theta[0, :], theta, theta[-1, :]))
+        section = ((direction / np.pi * 2.0) // 1).astype('int8')
+        quadrant = (direction - np.pi / 2.0 * section)
+        proportion = np.full_like(quadrant, np.nan)
+        section = section * 2 \
+            + (quadrant > theta.repeat(data.shape[1], 1)) \
+            * (section % 2 == 0) \
+            + (quadrant > (np.pi/2 - theta.repeat(data.shape[1], 1))) \
+            * (section % 2 == 1)
+        I1 = (section == 0) | (section == 1) | (section == 4) \
+            | (section == 5)
+        I = I1 & (quadrant <= theta.repeat(data.shape[1], 1))
+        proportion[I] = quadrant[I] / theta.repeat(data.shape[1], 1)[I]
+        I = I1 & (quadrant > theta.repeat(data.shape[1], 1))
+        proportion[I] = (quadrant[I] - theta.repeat(data.shape[1], 1)[I]) \
+            / (np.pi / 2 - theta.repeat(data.shape[1], 1)[I])
+        I = (~I1) & (quadrant <= (np.pi / 2 - theta.repeat(data.shape[1], 1)))
+        proportion[I] = (quadrant[I]) \
+            / (np.pi / 2 - theta.repeat(data.shape[1], 1)[I])
+        I = (~I1) & (quadrant > (np.pi / 2 - theta.repeat(data.shape[1], 1)))
+        proportion[I] = (quadrant[I]
+                         - (np.pi / 2 - theta.repeat(data.shape[1], 1)[I])) \
+            / (theta.repeat(data.shape[1], 1)[I])
+        section[flats] = FLAT_ID_INT
+        proportion[flats] = FLAT_ID
+        section[section == 8] = 0
+        proportion = (1 + adjust[section]) / 2.0 - adjust[section] * proportion
+        return section, proportion
+
+    def timeit(func, *args):
+        best = np.inf
+        for i in xrange(3):
+            t0 = time.time()
+            out = func(*args)
+            best = min(best, time.time() - t0)
+        return best, out
+
+    sizes = [int(n) for n in sys.argv[1:]] or [512, 4096]
+    # Only the class attributes are used, so the DEM does not need to be read
+    dem_proc = DEMProcessor.__new__(DEMProcessor)
+    facets, adjust = dem_proc.facets, dem_proc.ang_adj[:, 1]
+
+    print "%8s %12s %12s %8s %6s" % ('NN', 'masks [s]', 'new [s]',
+                                     'speedup', 'same')
+    for NN in sizes:
+        rs = np.random.RandomState(0)
+        data = np.zeros((NN, NN))
+        direction = rs.rand(NN, NN) * 2 * np.pi
+        flats = rs.rand(NN, NN) < 0.01
+        dX = np.linspace(0.9, 1.1, NN - 1)
+        dY = np.ones(NN - 1)
+
+        t_old, (s_old, p_old) = timeit(section_proportion_masks, data, dX,
+                                       dY, direction, flats, facets, adjust)
+        t_new, (s_new, p_new) = timeit(
+            dem_proc._calc_uca_section_proportion, data, dX, dY, direction,
+            flats)
+        same = np.array_equal(s_old, s_new) \
+            and np.array_equal(np.isnan(p_old), np.isnan(p_new)) \
+            and np.array_equal(p_old[~flats], p_new[~flats])
+        print "%8d %12.4g %12.4g %8.1f %6s" % (NN, t_old, t_new,
+                                               t_old / t_new, same)
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""
+   Copyright 2015 Creare
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+Compares the throughput (pixels/s) of the NumPy and the compiled (Cython)
+Tarboton slope/direction calculations, and checks that they agree.
+
+Usage: python benchmark_slopes_directions.py [NN ...]
+"""
+if __name__ == "__main__":
+    import sys
+    import time
+    import numpy as np
+    from pydem.dem_processing import (DEMProcessor, CYTHON,
+                                      _tarboton_slopes_directions,
+                                      _tarboton_slopes_directions_numpy)
+
+    if not CYTHON:
+        sys.exit("The Cython functions are not compiled, nothing to compare. "
+                 "Use: python setup.py build_ext --inplace")
+
+    sizes = [int(n) for n in sys.argv[1:]] or [256, 512, 1024, 2048]
+    facets, ang_adj = DEMProcessor.facets, DEMProcessor.ang_adj
+
+    def timeit(func, *args):
+        best = np.inf
+        for i in xrange(3):
+            t0 = time.time()
+            out = func(*args)
+            best = min(best, time.time() - t0)
+        return best, out
+
+    print "%8s %16s %16s %8s %6s" % ('NN', 'numpy [px/s]', 'cython [px/s]',
+                                     'speedup', 'same')
+    for NN in sizes:
+        # Smooth random terrain, with some flat regions
+        x = np.linspace(0, 4 * np.pi, NN)
+        elev = np.sin(x)[:, None] * np.cos(x / 2)[None, :] * 100 \
+            + np.random.RandomState(0).rand(NN, NN)
+        elev = np.round(elev)
+        dX = np.linspace(0.9, 1.1, NN - 1)
+        dY = np.ones(NN - 1)
+
+        t_np, (mag_np, dir_np) = timeit(_tarboton_slopes_directions_numpy,
+                                        elev, dX, dY, facets, ang_adj)
+        t_cy, (mag_cy, dir_cy) = timeit(_tarboton_slopes_directions,
+                                        elev, dX, dY, facets, ang_adj)
+        same = np.array_equal(mag_np, mag_cy) \
+            and np.array_equal(dir_np, dir_cy)
+        print "%8d %16.3g %16.3g %8.1f %6s" % (NN, elev.size / t_np,
+                                               elev.size / t_cy, t_np / t_cy,
+                                               same)
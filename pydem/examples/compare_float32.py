@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+   Copyright 2015 Creare
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+Accuracy report for DEMProcessor.float_dtype = 'float32'. Runs the slope,
+direction, UCA and TWI calculations on the same synthetic terrain with
+'float64' and 'float32', and prints the differences, the memory used by the
+stored arrays, and the run times.
+
+Usage: python compare_float32.py [NN ...]
+"""
+if __name__ == "__main__":
+    import os
+    import sys
+    import time
+    import numpy as np
+    from pydem.dem_processing import DEMProcessor
+
+    sizes = [int(n) for n in sys.argv[1:]] or [512, 1024, 2048]
+    names = ['data', 'mag', 'direction', 'flats', 'uca', 'twi']
+
+    def run(elev, float_dtype):
+        dem_proc = DEMProcessor(elev.copy())
+        dem_proc.float_dtype = float_dtype
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')  # Silence the progress output
+        try:
+            t0 = time.time()
+            dem_proc.calc_slopes_directions()
+            dem_proc.calc_uca()
+            dem_proc.calc_twi()
+            t = time.time() - t0
+        finally:
+            sys.stdout = stdout
+        nbytes = sum(getattr(dem_proc, name).nbytes for name in names)
+        return dem_proc, t, nbytes
+
+    for NN in sizes:
+        # Smooth random terrain
+        x = np.linspace(0, 4 * np.pi, NN)
+        elev = np.sin(x)[:, None] * np.cos(x / 2)[None, :] * 100 \
+            + np.random.RandomState(0).rand(NN, NN) * 10 + 200
+
+        dp64, t64, b64 = run(elev, 'float64')
+        dp32, t32, b32 = run(elev, 'float32')
+        print "NN = %d: float64 %.2f s, %.1f MB; float32 %.2f s, %.1f MB" \
+            % (NN, t64, b64 / 2.0**20, t32, b32 / 2.0**20)
+
+        valid = (dp64.mag >= 0) & (dp32.mag >= 0)
+        errors = []
+        errors.append(('mag [rel]', np.abs(dp32.mag - dp64.mag)[valid]
+                       / np.maximum(dp64.mag[valid], 1e-12)))
+        ddir = np.abs(dp32.direction - dp64.direction)[valid]
+        errors.append(('direction [deg]',
+                       np.degrees(np.minimum(ddir, 2 * np.pi - ddir))))
+        I = np.isfinite(dp64.uca) & np.isfinite(dp32.uca) & (dp64.uca > 0)
+        errors.append(('uca [rel]',
+                       np.abs(dp32.uca - dp64.uca)[I] / dp64.uca[I]))
+        I = np.isfinite(dp64.twi) & np.isfinite(dp32.twi)
+        errors.append(('twi [abs]', np.abs(dp32.twi - dp64.twi)[I]))
+        print "    %-16s %10s %10s %10s %10s" % ('', 'median', '99%',
+                                                 '99.99%', 'max')
+        for name, error in errors:
+            print "    %-16s %10.2g %10.2g %10.2g %10.2g" % (
+                name, np.median(error), np.percentile(error, 99),
+                np.percentile(error, 99.99), error.max())
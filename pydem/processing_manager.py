@@ -26,9 +26,11 @@ Usage Notes
 -------------
 This module depends on properly named elevation GEOTIFF files. To rename
 existing elevation files, see :py:func:`utils.rename_files`. These elevation
-tiles should have had pits removed.
+tiles should have had pits removed. The neighbors of the tiles are found from
+the bounds in their geotransforms, so the tiles do not have to be on a
+regular grid, and may overlap.
 
-This module consists of three classes and a helper function. General users
+This module consists of four classes and a helper function. General users
 should only be concerned with the ProcessManager class.
 
 This module generates a large amount of temporary storage data and additional
@@ -40,17 +42,19 @@ concurrently during the first processing stage. During the edge resolution
 stage, only one thread will presently continue to run. The other threads should
 automatically 'finish' processing, while one thread will continue.
 
+Alternatively, a single ProcessManager can run both stages on a pool of worker
+processes: ProcessManager.process(n_workers=...). The state of the tiles is then
+kept in memory, instead of in lock files. During the edge resolution stage, sets
+of non-neighboring tiles are recalculated concurrently.
+
 Developer Notes
 -----------------
 The EdgeFile and TileEdgeFile classes are similar to the Edge and TileEdge
 classes in the dem_processing module. The difference is that the data for
-these are stored on disk in temporary files.
-
-Development Notes
-------------------
-
-TODO: Improve the speed of updating the edge data -- only update edges that
-      changed (i.e. keep a timestamp of previous access)
+these are stored on disk in temporary files. The data of all the edges is kept
+in a single memory-mapped file per field by the EdgeStore class. The tiles,
+their neighbors, and the metrics of the edges are saved in a small manifest
+file (see TileEdgeFile.save_manifest), which is shared by all the processes.
 
 Created on Tue Oct 14 18:09:58 2014
 
@@ -58,141 +62,272 @@ Created on Tue Oct 14 18:09:58 2014
 """
 
 import os
+import time
+import warnings
+import threading
 import traceback
 import subprocess
+import multiprocessing
+import heapq
 import numpy as np
-import cPickle
 import scipy.interpolate as spinterp
+import scipy.sparse as sps
+import scipy.sparse.linalg as spsl
+import scipy.sparse.csgraph as spcg
 import gc
 
 from reader.gdal_reader import GdalReader
 
 from dem_processing import DEMProcessor
-from utils import parse_fn, sortrows, get_fn_from_coords
+from utils import parse_fn, get_fn_from_coords
 
 
-def find_neighbors(neighbors, coords, I, source_files, f, sides):
-    """Find the tile neighbors based on filenames
+def find_neighbors(source_files, bounds, tol):
+    """Find the tile neighbors based on the bounds of the tiles
 
     Parameters
     -----------
-    neighbors : dict
-        Dictionary that stores the neighbors. Format is
-        neighbors["source_file_name"]["side"] = "neighbor_source_file_name"
-    coords : list
-        List of coordinates determined from the filename.
-        See :py:func:`utils.parse_fn`
-    I : array
-        Sort index. Different sorting schemes will speed up when neighbors
-        are found
     source_files : list
         List of strings of source file names
-    f : callable
-        Function that determines if two tiles are neighbors based on their
-        coordinates. f(c1, c2) returns True if tiles are neighbors
-    sides : list
-        List of 2 strings that give the "side" where tiles are neighbors.
+    bounds : array
+        (n_tiles, 4) array with the [bottom, left, top, right] bounds of the
+        tiles (same order as source_files), see :py:func:`get_tile_bounds`
+    tol : array
+        (n_tiles, 2) array with the tolerance in the [y, x] direction of
+        every tile (typically half a pixel). Tiles that are closer than the
+        tolerance are neighbors.
 
     Returns
     -------
     neighbors : dict
-        Dictionary of neighbors
+        Dictionary of neighbors. Format is
+        neighbors["source_file_name"]["side"] = ["neighbor_source_file_name",
+        ...], where side is one of TileEdgeFile.neighbor_sides
 
     Notes
     -------
     For example, if Tile1 is to the left of Tile2, then
-    neighbors['Tile1']['right'] = 'Tile2'
-    neighbors['Tile2']['left'] = 'Tile1'
+    neighbors['Tile1']['right'] = ['Tile2']
+    neighbors['Tile2']['left'] = ['Tile1']
+
+    The tiles do not have to be on a regular grid, and can overlap, so a
+    side can have several neighbors. A tile that is not further to the left
+    or right (top or bottom) of another tile than the tolerance, is
+    neither. Tiles that are not on any side of a tile (for example because
+    they are contained by it) are not its neighbors.
+
+    The tiles are found through a hash of a grid with cells about the size
+    of a tile, so this scales as O(n) for tiles of similar sizes.
     """
-    for i, c1 in enumerate(coords):
-        me = source_files[I[i]]
-        # If the left neighbor has already been found...
-        if neighbors[me][sides[0]] != '':
-            continue
-        # could try coords[i:] (+ fixes) for speed if it becomes a problem
-        for j, c2 in enumerate(coords):
-            if f(c1, c2):
-                # then tiles are neighbors neighbors
-                neigh = source_files[I[j]]
-                neighbors[me][sides[0]] = neigh
-                neighbors[neigh][sides[1]] = me
-                break
+    bot, left, top, right = 0, 1, 2, 3
+    bounds = np.asarray(bounds, float)
+    tol = np.asarray(tol, float)
+    # Expand the tiles by the tolerance, so that touching tiles overlap
+    lo = bounds[:, [bot, left]] - tol
+    hi = bounds[:, [top, right]] + tol
+    cell = np.median(hi - lo, axis=0)
+    cell[cell <= 0] = 1
+    lo_cell = np.floor(lo / cell).astype(int)
+    hi_cell = np.floor(hi / cell).astype(int)
+    grid = {}
+    for i in xrange(len(source_files)):
+        for cy in xrange(lo_cell[i, 0], hi_cell[i, 0] + 1):
+            for cx in xrange(lo_cell[i, 1], hi_cell[i, 1] + 1):
+                grid.setdefault((cy, cx), []).append(i)
+
+    neighbors = {fn: {side: [] for side in TileEdgeFile.neighbor_sides}
+                 for fn in source_files}
+    for i, me in enumerate(source_files):
+        candidates = set()
+        for cy in xrange(lo_cell[i, 0], hi_cell[i, 0] + 1):
+            for cx in xrange(lo_cell[i, 1], hi_cell[i, 1] + 1):
+                candidates.update(grid[(cy, cx)])
+        candidates.discard(i)
+        for j in sorted(candidates):
+            if np.any(lo[j] > hi[i]) or np.any(hi[j] < lo[i]):
+                continue  # Not touching
+            t = np.maximum(tol[i], tol[j])
+            if bounds[j, bot] < bounds[i, bot] - t[0] \
+                    and bounds[j, top] < bounds[i, top] - t[0]:
+                side = ['bottom']
+            elif bounds[j, bot] > bounds[i, bot] + t[0] \
+                    and bounds[j, top] > bounds[i, top] + t[0]:
+                side = ['top']
+            else:
+                side = []
+            if bounds[j, left] < bounds[i, left] - t[1] \
+                    and bounds[j, right] < bounds[i, right] - t[1]:
+                side.append('left')
+            elif bounds[j, left] > bounds[i, left] + t[1] \
+                    and bounds[j, right] > bounds[i, right] + t[1]:
+                side.append('right')
+            if side:
+                neighbors[me]['-'.join(side)].append(source_files[j])
     return neighbors
 
 
+def get_tile_bounds(source_files):
+    """
+    Reads the [bottom, left, top, right] bounds of the tiles, and half of
+    their [y, x] pixel size, from the geotransforms of the files (without
+    reading the rasters).
+    """
+    bounds = []
+    half_pixel = []
+    for fn in source_files:
+        elev_file = GdalReader(file_name=fn)
+        gc = elev_file.grid_coordinates
+        del elev_file  # close file
+        gt = gc.geotransform
+        x = [gt[0], gt[0] + gt[1] * gc.x_size]
+        y = [gt[3], gt[3] + gt[5] * gc.y_size]
+        bounds.append([min(y), min(x), max(y), max(x)])
+        half_pixel.append([abs(gt[5]) / 2.0, abs(gt[1]) / 2.0])
+    return np.array(bounds), np.array(half_pixel)
+
+
+class EdgeStore(object):
+    """
+    Keeps the edge data of all the tiles together: one file per field
+    (coords, data, done and todo) for all the edges, with every edge at a
+    known offset. The files are memory-mapped, so the working set stays in
+    memory, reading or writing an edge does not open any files, and the
+    changes are written to disk by flush (or by the operating system).
+
+    The metrics of the edges (n_done, n_coulddo, percent_done) are kept in
+    memory, and saved with the manifest of the TileEdgeFile.
+    """
+    fields = {'coords': (float, 2), 'data': (float, None),
+              'done': (bool, None), 'todo': (bool, None)}
+    save_path = None
+    offsets = None
+    index = None
+    size = None
+    arrays = None
+    metrics = None
+    changed = None  # Indices of the edges with changed metrics
+    created = False  # True if any of the files had to be initialized
+    _subdir = 'edge'
+
+    def __init__(self, save_path, keys, sizes, overwrite=False):
+        """
+        Parameters
+        -----------
+        save_path : str
+            Root path where the 'edge' subdirectory is located.
+        keys : list
+            Keys of the edges, for example (filename, side)
+        sizes : list
+            Number of points on each edge
+        overwrite : bool (optional)
+            Default False. If False, the existing edge files are re-used if
+            they match the edges, otherwise they are initialized again.
+        """
+        self.save_path = save_path
+        self.offsets = {}
+        self.index = {}
+        start = 0
+        for i, (key, size) in enumerate(zip(keys, sizes)):
+            self.offsets[key] = (start, start + size)
+            self.index[key] = i
+            start += size
+        self.size = start
+        self.metrics = np.zeros((len(self.index), 3))
+        self.changed = set()
+        self.open(overwrite)
+
+    def get_fn(self, name):
+        return os.path.join(self.save_path, self._subdir,
+                            'edge_store_' + name + '.npy')
+
+    def get_shape(self, name):
+        width = self.fields[name][1]
+        if width is None:
+            return (self.size, )
+        return (self.size, width)
+
+    def open(self, overwrite=False):
+        self.arrays = {}
+        for name in self.fields.keys():
+            fn = self.get_fn(name)
+            shape = self.get_shape(name)
+            arr = None
+            if os.path.exists(fn) and not overwrite:
+                arr = np.load(fn, mmap_mode='r+')
+                if arr.shape != shape:
+                    del arr
+                    arr = None
+            if arr is None:
+                arr = np.lib.format.open_memmap(fn, mode='w+',
+                                                dtype=self.fields[name][0],
+                                                shape=shape)
+                # Initialize: nothing done, everything to do
+                arr[:] = name == 'todo'
+                self.created = True
+            self.arrays[name] = arr
+
+    def flush(self):
+        for arr in self.arrays.values():
+            arr.flush()
+
+    def get(self, key, name):
+        start, stop = self.offsets[key]
+        return np.array(self.arrays[name][start:stop])
+
+    def set(self, key, name, data):
+        start, stop = self.offsets[key]
+        self.arrays[name][start:stop] = data
+
+    def get_metrics(self, key):
+        return self.metrics[self.index[key]]
+
+    def set_metrics(self, key, metrics):
+        self.metrics[self.index[key]] = metrics
+        self.changed.add(self.index[key])
+
+    def __getstate__(self):
+        # The memory maps are re-opened when unpickling
+        state = self.__dict__.copy()
+        state['arrays'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.open()
+
+
 class EdgeFile(object):
     """
     Small helper class that keeps track of data on an edge. It doesn't care
-    if it's a top, bottom, left, or right edge. The edge data is loaded from
-    a file only when access to the data is needed. A few metrics are kept
-    in memory. The file is created when the edge object is instantiated, and it
-    is not automatically destroyed.
+    if it's a top, bottom, left, or right edge. The edge data is kept in an
+    EdgeStore, which is shared by all the edges. A few metrics are kept
+    in memory.
     """
 
     fn = None
     slice = None
-    coords = None
-    save_path = None
-    post_fn = None
-
-    fn_coords = None
-    fn_data = None
-    fn_done = None
-    fn_todo = None
+    coords = None  # [bottom, left, top, right] bounds of the tile
+    store = None
+    key = None
 
     n_done = None
     n_coulddo = None
     percent_done = None
-    _subdir = 'edge'
 
-    def __init__(self, fn, slice_, save_path, overwrite=False):
+    def __init__(self, fn, slice_, store, key, update_metrics=True,
+                 coords=None):
         self.fn = fn
-        self.coords = parse_fn(fn)
+        self.coords = coords
         self.slice = slice_
-        self.save_path = save_path
-        self.post_fn = '_' + str(slice_).replace(' ', '').replace(',', '-')
-
-        # When initialized we also have to create and initialize the files
-        # that go with this edge
-        self.fn_coords = self.get_fn('coords')
-        self.fn_data = self.get_fn('data')
-        self.fn_done = self.get_fn('done')
-        self.fn_todo = self.get_fn('todo')
-
-        # Open the elevation file and strip out the coordinates, then save init
-        # data
-        elev_file = GdalReader(file_name=fn)
-        elev, = elev_file.raster_layers
-        gc = elev.grid_coordinates
-        del elev_file  # close file
-        del elev       # make sure it's closed
-        points = np.meshgrid(gc.x_axis, gc.y_axis)
-        coordinates = np.column_stack([pts[slice_].ravel() for pts in points])
-        # flip xy coordinates for regular grid interpolator
-        coordinates = coordinates[:, ::-1]
-        init_data = np.zeros(coordinates.shape[0], float)
-        init_bool = np.zeros(coordinates.shape[0], bool)
-
-        if not os.path.exists(self.fn_coords) and not overwrite:
-            self.save_data(coordinates, 'coords')
-        if not os.path.exists(self.fn_data) and not overwrite:
-            self.save_data(init_data, 'data')
-        if not os.path.exists(self.fn_done) and not overwrite:
-            self.save_data(init_bool, 'done')
-        if not os.path.exists(self.fn_todo) and not overwrite:
-            self.save_data(~init_bool, 'todo')
-
-        self.update_metrics()
-
-    def get_fn(self, name):
-        fn = os.path.join(self.save_path, self._subdir,
-                          get_fn_from_coords(self.coords, 'edge_'
-                                             + name + self.post_fn))
-        return fn + '.npy'
+        self.store = store
+        self.key = key
+        if update_metrics:
+            self.update_metrics()
+        else:  # Use the metrics in the store
+            self.load_metrics()
 
     def save_data(self, data, name):
-        fn = self.get_fn(name)
-        np.save(fn, data)
+        self.store.set(self.key, name, data)
 
     def calc_n_done(self, coulddo, done):
         return (coulddo & done).sum()
@@ -213,10 +348,21 @@ class EdgeFile(object):
         # assumed that we are providing data on the same tile
         elif data is not None:
             newdata = data[self.slice].squeeze()
-            old_data = newdata  # Needed just for the dtype
+            self.set_values(name, newdata, keep_nan=True)
         # Assume we're providing data from a different tile
         elif interp is not None:
             newdata = interp(self.get_coordinates()).squeeze()
+            self.set_values(name, newdata)
+
+    def set_values(self, name, newdata, keep_nan=False):
+        """
+        Saves the values of the edge. Unless keep_nan is True, NaN values
+        (points that the tile supplying the data does not cover) keep their
+        old value.
+        """
+        if keep_nan:
+            old_data = newdata  # Needed just for the dtype
+        else:
             old_data = self.get(name)
             I = np.isnan(newdata)
             newdata[I] = old_data[I]
@@ -228,9 +374,7 @@ class EdgeFile(object):
         return self.get('coords')
 
     def get(self, name):
-        fn = self.get_fn(name)
-        data = np.load(fn)
-        return data
+        return self.store.get(self.key, name)
 
     def update_metrics(self):
         todo = self.get('todo')
@@ -240,25 +384,12 @@ class EdgeFile(object):
         self.n_done = self.calc_n_done(coulddo, done)
         self.n_coulddo = self.calc_n_coulddo(coulddo)
         self.percent_done = self.calc_percent_done(coulddo, done)
-        fn = os.path.join(self.save_path, self._subdir,
-                          get_fn_from_coords(self.coords,
-                                             'edge_metrics' + self.post_fn))
-        np.save(fn, np.array([self.n_done, self.n_coulddo, self.percent_done]))
-        # clean up
-        del todo
-        del done
-        del data
-        del coulddo
+        self.store.set_metrics(self.key, [self.n_done, self.n_coulddo,
+                                          self.percent_done])
 
     def load_metrics(self):
-        fn = os.path.join(self.save_path, self._subdir,
-                          get_fn_from_coords(self.coords,
-                                             'edge_metrics' + self.post_fn))
-        if os.path.exists(fn + '.npy'):
-            self.n_done, self.n_coulddo, self.percent_done = \
-                np.load(fn + '.npy')
-        else:
-            self.n_done, self.n_coulddo, self.percent_done = [None] * 3
+        self.n_done, self.n_coulddo, self.percent_done = \
+            self.store.get_metrics(self.key)
 
 
 class TileEdgeFile(object):
@@ -266,105 +397,301 @@ class TileEdgeFile(object):
     This is mostly a light-weight interface/helper to all the of the edge
     data stored on disk
     """
+    tiles = None
+    bounds = None
     neighbors = None
     edges = None
+    store = None
     save_path = None
     percent_done = None
     max_elev = None
+    # Candidate queue of (-percent_done, -max_elev, fn) entries, and the
+    # tiles whose edges changed since the queue was updated
+    _queue = None
+    _dirty = None
+
+    # Format of the manifest (see save_manifest). Manifests with a different
+    # version are ignored, and the TileEdgeFile is created again.
+    manifest_version = 2
+    _manifest_mtime = None
+    edge_sides = ['left', 'right', 'top', 'bottom']
+    neighbor_sides = ['left', 'right', 'top', 'bottom', 'top-left',
+                      'top-right', 'bottom-right', 'bottom-left']
+    slices = {'left': [slice(None), slice(0, 1)],
+              'right': [slice(None), slice(-1, None)],
+              'top': [slice(0, 1), slice(None)],
+              'bottom': [slice(-1, None), slice(None)]}
 
     def __init__(self, elev_source_files, save_path):
+        self.tiles = list(elev_source_files)
         self.neighbors = self.find_neighbors(elev_source_files)
         self.save_path = save_path
         self.initialize_edges(save_path)
-        self.fill_percent_done()
+        self.fill_percent_done(update_metrics=True)
         self.fill_max_elevations()
 
     def find_neighbors(self, elev_source_files):
-        neighbors = {fn: {'left': '', 'right': '', 'top': '', 'bottom': '',
-                          'top-left': '', 'top-right': '',
-                          'bottom-right': '', 'bottom-left': ''}
-                     for fn in elev_source_files}
-        coords = np.array([parse_fn(fn) for fn in elev_source_files])
-        # find the left neighbors (and right)
-        top = 2
-        bot = 0
-        left = 1
-        right = 3
-
-        # Sort the coordinates to find neighbors faster
-        coords1, I = sortrows(coords.copy(), index_out=True, recurse=True)
-        f_right = lambda c1, c2: c2[bot] == c1[bot] and c2[top] == c1[top] \
-            and c2[right] > c1[right] and c2[left] <= c1[right]
-        neighbors = find_neighbors(neighbors, coords1, I, elev_source_files,
-                                   f_right, ['right', 'left'])
-        # Right takes care of left on a grid (should always be true)
-
-        coords1, I = sortrows(coords.copy(), i=1, index_out=True, recurse=True)
-        f_top = lambda c1, c2: c2[left] == c1[left] and c2[right] == c1[right] \
-            and c2[top] > c1[top] and c2[bot] <= c1[top]
-        neighbors = find_neighbors(neighbors, coords1, I, elev_source_files,
-                                   f_top, ['top', 'bottom'])
-
-        # Hard part is done. now for convenience, let's find the rest of the
-        # neighbors
-        for key in neighbors.keys():
-            for tb in ['top', 'bottom']:
-                for lr in ['left', 'right']:
-                    top_neig = neighbors[key][tb]
-                    if top_neig != '':
-                        neighbors[key]['-'.join([tb, lr])] = \
-                            neighbors[top_neig][lr]
-                    if neighbors[key]['-'.join([tb, lr])] == '' and \
-                            neighbors[key][lr] != '':  # try other option
-                        neighbors[key]['-'.join([tb, lr])] = \
-                            neighbors[neighbors[key][lr]][tb]
-
-        return neighbors
+        """
+        Finds the neighbors of the tiles from the bounds in their
+        geotransforms, see :py:func:`find_neighbors`
+        """
+        self.bounds, half_pixel = get_tile_bounds(elev_source_files)
+        return find_neighbors(elev_source_files, self.bounds, half_pixel)
 
     def initialize_edges(self, save_path=None):
         if save_path is None:
             save_path = self.save_path
 
-        edges = {fn:
-            {'left': EdgeFile(fn, [slice(None), slice(0, 1)], save_path),
-             'right': EdgeFile(fn, [slice(None), slice(-1, None)], save_path),
-             'top': EdgeFile(fn, [slice(0, 1), slice(None)], save_path),
-             'bottom': EdgeFile(fn, [slice(-1, None), slice(None)], save_path)}
-            for fn in self.neighbors.keys()}
-        self.edges = edges
-        return edges
+        keys = []
+        coordinates = []
+        for fn in self.tiles:
+            # Open the elevation file and strip out the coordinates (without
+            # reading the raster)
+            elev_file = GdalReader(file_name=fn)
+            gc = elev_file.grid_coordinates
+            del elev_file  # close file
+            points = np.meshgrid(gc.x_axis, gc.y_axis)
+            for side in self.edge_sides:
+                coords = np.column_stack([pts[self.slices[side]].ravel()
+                                          for pts in points])
+                # flip xy coordinates for regular grid interpolator
+                keys.append((fn, side))
+                coordinates.append(coords[:, ::-1])
+
+        self.store = EdgeStore(save_path, keys,
+                               [coords.shape[0] for coords in coordinates])
+        for key, coords in zip(keys, coordinates):
+            self.store.set(key, 'coords', coords)
+        return self._mk_edges(update_metrics=True)
+
+    def _mk_edges(self, update_metrics):
+        self.edges = {}
+        for fn, coords in zip(self.tiles, self.bounds):
+            self.edges[fn] = {side: EdgeFile(fn, self.slices[side],
+                                             self.store, (fn, side),
+                                             update_metrics, coords)
+                              for side in self.edge_sides}
+        return self.edges
+
+    def flush(self):
+        """
+        Writes the edge data and the manifest to disk
+        """
+        self.store.flush()
+        self.save_manifest()
+
+    @staticmethod
+    def get_manifest_fn(save_path):
+        return os.path.join(save_path, EdgeStore._subdir, 'manifest.npz')
+
+    @classmethod
+    def load_or_create(cls, elev_source_files, save_path):
+        """
+        Loads the TileEdgeFile from the manifest in save_path, or creates it
+        (and the manifest) if there is no valid manifest for
+        elev_source_files. Concurrent processes wait for the one that
+        creates it (which keeps the lock fresh, see _ManifestLock).
+        """
+        fn = cls.get_manifest_fn(save_path)
+        with _ManifestLock(fn):
+            tile_edge = cls.load_manifest(elev_source_files, save_path)
+            if tile_edge is None:
+                tile_edge = cls(elev_source_files, save_path)
+                tile_edge._write_manifest()
+        return tile_edge
+
+    @classmethod
+    def load_manifest(cls, elev_source_files, save_path):
+        """
+        Creates the TileEdgeFile from the manifest in save_path, without
+        opening the elevation files or reading the edge data. Returns None
+        if there is no manifest, if it has a different version, if it is for
+        different tiles, or if the edge data is missing.
+        """
+        manifest_fn = cls.get_manifest_fn(save_path)
+        if not os.path.exists(manifest_fn):
+            return None
+        with np.load(manifest_fn) as manifest:
+            manifest = {key: manifest[key] for key in manifest.files}
+        tiles = [str(tile) for tile in manifest['tiles']]
+        if int(manifest['version']) != cls.manifest_version \
+                or sorted(tiles) != sorted(elev_source_files):
+            return None
+
+        self = cls.__new__(cls)
+        self.tiles = tiles
+        self.save_path = save_path
+        self.bounds = manifest['bounds']
+        neighbors = manifest['neighbors']
+        ptr = manifest['neighbor_ptr'].reshape(-1)
+        n_sides = len(self.neighbor_sides)
+        self.neighbors = {
+            fn: {side: [tiles[j] for j in neighbors[ptr[n_sides * i + k]:
+                                                   ptr[n_sides * i + k + 1]]]
+                 for k, side in enumerate(self.neighbor_sides)}
+            for i, fn in enumerate(tiles)}
+        self.max_elev = dict(zip(tiles, manifest['max_elev']))
+        keys = [(fn, side) for fn in tiles for side in self.edge_sides]
+        self.store = EdgeStore(save_path, keys, manifest['sizes'].ravel())
+        if self.store.created:
+            return None
+        self.store.metrics[:] = manifest['metrics']
+        self._manifest_mtime = os.path.getmtime(manifest_fn)
+        self._mk_edges(update_metrics=False)
+        self.fill_percent_done()
+        return self
+
+    def save_manifest(self):
+        """
+        Saves the manifest: the tiles, the neighbor table, the size of the
+        edges, the maximum elevations, and the metrics of the edges.
+
+        Other processes may have updated the manifest with the metrics of the
+        edges they changed. Only the metrics changed by this process replace
+        those in the manifest, and the rest are read from it. The manifest is
+        replaced atomically, and the whole update is done while holding a
+        lock, so concurrent updates are not lost.
+        """
+        fn = self.get_manifest_fn(self.save_path)
+        with _ManifestLock(fn):
+            self._read_manifest_metrics()
+            self._write_manifest()
+
+    def refresh(self):
+        """
+        Reads the metrics of the edges changed by other processes, if the
+        manifest has been updated since it was last read or written.
+        """
+        fn = self.get_manifest_fn(self.save_path)
+        if not os.path.exists(fn) \
+                or os.path.getmtime(fn) == self._manifest_mtime:
+            return
+        with _ManifestLock(fn):
+            self._read_manifest_metrics()
+
+    def _read_manifest_metrics(self):
+        fn = self.get_manifest_fn(self.save_path)
+        if not os.path.exists(fn):
+            return
+        with np.load(fn) as manifest:
+            if int(manifest['version']) != self.manifest_version \
+                    or [str(tile) for tile in manifest['tiles']] \
+                    != self.tiles:
+                return
+            metrics = manifest['metrics']
+        self._manifest_mtime = os.path.getmtime(fn)
+        mine = np.zeros(len(metrics), bool)
+        mine[list(self.store.changed)] = True
+        I = ~mine & np.any(metrics != self.store.metrics, axis=1)
+        if I.any():
+            self.store.metrics[I] = metrics[I]
+            tiles = set(self.tiles[i // len(self.edge_sides)]
+                        for i in np.nonzero(I)[0])
+            for tile in tiles:
+                for edge in self.edges[tile].values():
+                    edge.load_metrics()
+            self.mark_dirty(tiles)
+
+    def _write_manifest(self):
+        fn = self.get_manifest_fn(self.save_path)
+        # The neighbors of (tile i, side k) are
+        # neighbors[neighbor_ptr[8 * i + k]:neighbor_ptr[8 * i + k + 1]]
+        index = {tile: i for i, tile in enumerate(self.tiles)}
+        neighbors = [[index[neigh] for neigh in self.neighbors[tile][side]]
+                     for tile in self.tiles for side in self.neighbor_sides]
+        neighbor_ptr = np.cumsum([0] + [len(n) for n in neighbors])
+        neighbors = np.array([j for n in neighbors for j in n], 'int32')
+        sizes = np.array([[np.diff(self.store.offsets[(tile, side)])[0]
+                           for side in self.edge_sides]
+                          for tile in self.tiles], 'int64')
+        tmp_fn = fn + '.tmp'
+        with open(tmp_fn, 'wb') as fid:
+            np.savez(fid, version=self.manifest_version,
+                     tiles=np.array(self.tiles), bounds=self.bounds,
+                     neighbors=neighbors, neighbor_ptr=neighbor_ptr,
+                     sizes=sizes, metrics=self.store.metrics,
+                     max_elev=np.array([self.max_elev[tile]
+                                        for tile in self.tiles]))
+        try:
+            os.rename(tmp_fn, fn)
+        except OSError:  # Windows does not replace existing files
+            os.remove(fn)
+            os.rename(tmp_fn, fn)
+        self.store.changed = set()
+        self._manifest_mtime = os.path.getmtime(fn)
 
     def fill_max_elevations(self):
         max_elev = {}
         for fn in self.edges.keys():
+            # Stream through the file, one block at a time
             elev_file = GdalReader(file_name=fn)
-            elev, = elev_file.raster_layers
-            max_elev[fn] = np.nanmax(elev.raster_data)
+            max_elev[fn] = np.nanmax([np.nanmax(arr) for _, arr, _
+                                      in elev_file.iter_windows()])
             del elev_file  # close file
-            del elev
         self.max_elev = max_elev
 
-    def fill_percent_done(self):
-        percent_done = {}
-        for key, edge in self.edges.iteritems():
+    def fill_percent_done(self, fns=None, update_metrics=False):
+        """
+        Calculates the percent done of the tiles in fns (default: all tiles)
+        from the metrics of their edges. If update_metrics is True, the
+        metrics are first calculated again from the edge data.
+        """
+        if fns is None or self.percent_done is None:
+            fns = self.edges.keys()
+            self.percent_done = {}
+        percent_done = self.percent_done
+        for key in fns:
+            edge = self.edges[key]
             for key1, ed in edge.iteritems():
-                ed.update_metrics()
-                # ed.load_metrics()
+                if update_metrics:
+                    ed.update_metrics()
             percent_done[key] = np.array([edge[key2].percent_done
                                          for key2 in edge.keys()])
             percent_done[key] = percent_done[key].sum() \
                 / ((percent_done[key] > 0).sum() + 1e-16)
         self.percent_done = percent_done
 
+    def update_percent_done(self):
+        """
+        Updates the percent done and the candidate queue entries of only the
+        tiles whose edges changed since the last update. The first call fills
+        everything.
+        """
+        if self._queue is None or self._dirty is None:
+            self.fill_percent_done()
+            self._queue = [self._queue_entry(fn) for fn in self.percent_done]
+            heapq.heapify(self._queue)
+            self._dirty = set()
+            return
+        fns = self._dirty
+        self._dirty = set()
+        self.fill_percent_done(fns)
+        # Old entries of these tiles are left in the queue, and skipped when
+        # they come up. Compact the queue when it is mostly outdated.
+        if len(self._queue) + len(fns) > 4 * len(self.percent_done):
+            self._queue = [self._queue_entry(fn) for fn in self.percent_done]
+            heapq.heapify(self._queue)
+        else:
+            for fn in fns:
+                heapq.heappush(self._queue, self._queue_entry(fn))
+
+    def _queue_entry(self, fn):
+        return (-self.percent_done[fn], -self.max_elev[fn], fn)
+
+    def _is_outdated(self, entry):
+        return -entry[0] != self.percent_done[entry[2]]
+
     def visualize_neighbors(self, neighbors=None):
         if neighbors is None:
             neighbors = self.neighbors
         import matplotlib.pyplot as plt
-        coords = np.array([parse_fn(key) for key in neighbors.keys()])
-        n_coords = [np.array([parse_fn(neighbors[key][side])
-                    for key in neighbors.keys()])
-                    for side in ['left', 'right', 'top', 'bottom',
-                    'top-right', 'top-left', 'bottom-right', 'bottom-left']]
+        bounds = dict(zip(self.tiles, self.bounds))
+        coords = np.array([bounds[key] for key in neighbors.keys()])
+        pairs = [(key, neigh) for key in neighbors.keys()
+                 for side in self.neighbor_sides
+                 for neigh in neighbors[key][side]]
+        c1 = np.array([bounds[key] for key, _ in pairs]).reshape(-1, 4)
+        c2 = np.array([bounds[neigh] for _, neigh in pairs]).reshape(-1, 4)
 
         top = 2
         bot = 0
@@ -373,10 +700,11 @@ class TileEdgeFile(object):
         x = (coords[:, left] + coords[:, right]) / 2.0
         y = (coords[:, top] + coords[:, bot]) / 2.0
 
-        n_x = [(n_coord[:, left] + n_coord[:, right]) / 2.0 - x
-               for n_coord in n_coords]
-        n_y = [(n_coord[:, top] + n_coord[:, bot]) / 2.0 - y
-               for n_coord in n_coords]
+        n_x = [(c2[:, left] + c2[:, right] - c1[:, left] - c1[:, right])
+               / 2.0]
+        n_y = [(c2[:, top] + c2[:, bot] - c1[:, top] - c1[:, bot]) / 2.0]
+        x0 = [(c1[:, left] + c1[:, right]) / 2.0]
+        y0 = [(c1[:, top] + c1[:, bot]) / 2.0]
 
         self.fill_percent_done()
         colors = np.array([self.percent_done[key] for key in neighbors.keys()])
@@ -389,8 +717,8 @@ class TileEdgeFile(object):
                       coord[left], coord[left]],
                      [coord[top], coord[top], coord[bot],
                       coord[bot], coord[top]])
-        for nx, ny in zip(n_x, n_y):
-            plt.quiver(x, y, nx, ny, angles='xy', scale_units='xy',
+        for xi, yi, nx, ny in zip(x0, y0, n_x, n_y):
+            plt.quiver(xi, yi, nx, ny, angles='xy', scale_units='xy',
                        scale=1, width=0.005)
         plt.xlim(coords[:, left].min(), coords[:, right].max())
         plt.ylim(coords[:, bot].min(), coords[:, top].max())
@@ -455,21 +783,27 @@ class TileEdgeFile(object):
         From the elevation filename, we can figure out and load the data and
         done arrays.
         """
+        self.apply_edge_updates(
+            self.get_neighbor_updates(elev_fn, dem_proc, interp))
+
+    def get_neighbor_updates(self, elev_fn, dem_proc, interp=None):
+        """
+        Calculates the new data and done values of the neighbors' edges,
+        without saving them. See apply_edge_updates.
+        """
+        updates = []
         if interp is None:
             interp = self.build_interpolator(dem_proc)
         opp = {'top': 'bottom', 'left': 'right'}
-        for key in self.neighbors[elev_fn].keys():
-            tile = self.neighbors[elev_fn][key]
-            if tile == '':
-                continue
+        for key, tile in [(key, tile) for key in self.neighbor_sides
+                          for tile in self.neighbors[elev_fn][key]]:
             oppkey = key
             for me, neigh in opp.iteritems():
                 if me in key:
                     oppkey = oppkey.replace(me, neigh)
                 else:
                     oppkey = oppkey.replace(neigh, me)
-            opp_edge = self.neighbors[tile][oppkey]
-            if opp_edge == '':
+            if elev_fn not in self.neighbors[tile][oppkey]:
                 continue
 
             interp.values = dem_proc.uca[::-1, :]
@@ -477,12 +811,17 @@ class TileEdgeFile(object):
             # for the top-left tile we have to set the bottom and right edges
             # of that tile, so two edges for those tiles
             for key_ed in oppkey.split('-'):
-                self.edges[tile][key_ed].set_data('data', interp)
+                coords = self.edges[tile][key_ed].get_coordinates()
+                updates.append((tile, key_ed, 'data',
+                                interp(coords).squeeze()))
 
             interp.values = dem_proc.edge_done[::-1, :].astype(float)
 #            interp.values[:, 0] = np.ravel(dem_proc.edge_done)
             for key_ed in oppkey.split('-'):
-                self.edges[tile][key_ed].set_data('done', interp)
+                coords = self.edges[tile][key_ed].get_coordinates()
+                updates.append((tile, key_ed, 'done',
+                                interp(coords).squeeze()))
+        return updates
 
     def update_edge_todo(self, elev_fn, dem_proc):
         """
@@ -490,15 +829,54 @@ class TileEdgeFile(object):
         """
         for key in self.edges[elev_fn].keys():
             self.edges[elev_fn][key].set_data('todo', data=dem_proc.edge_todo)
+        self.mark_dirty([elev_fn])
 
     def update_edges(self, elev_fn, dem_proc):
         """
         After finishing a calculation, this will update the neighbors and the
         todo for that tile
         """
+        self.apply_edge_updates(self.get_edge_updates(elev_fn, dem_proc))
+
+    def get_edge_updates(self, elev_fn, dem_proc):
+        """
+        Calculates the edge updates done by update_edges, without saving
+        them. This only needs the (static) neighbors and edge coordinates, so
+        it can be computed in a worker process, and the updates applied later
+        with apply_edge_updates.
+
+        Returns
+        --------
+        updates : list
+            List of (elev_fn, side, name, values) tuples. NaN values in data
+            and done are not updated.
+        """
         interp = self.build_interpolator(dem_proc)
-        self.update_edge_todo(elev_fn, dem_proc)
-        self.set_neighbor_data(elev_fn, dem_proc, interp)
+        updates = [(elev_fn, key, 'todo',
+                    dem_proc.edge_todo[self.edges[elev_fn][key].slice].squeeze())
+                   for key in self.edges[elev_fn].keys()]
+        return updates + self.get_neighbor_updates(elev_fn, dem_proc, interp)
+
+    def apply_edge_updates(self, updates):
+        """
+        Saves the edge updates from get_edge_updates. The edge data is
+        flushed and the manifest saved after every call, so the metrics in
+        the manifest stay in sync with the edge data if the processing is
+        interrupted.
+        """
+        for elev_fn, side, name, values in updates:
+            self.edges[elev_fn][side].set_values(name, values,
+                                                 keep_nan=name == 'todo')
+        self.mark_dirty([update[0] for update in updates])
+        self.flush()
+
+    def mark_dirty(self, fns):
+        """
+        Marks the tiles in fns as changed, so that their percent done is
+        updated by the next find_best_candidate
+        """
+        if self._dirty is not None:
+            self._dirty.update(fns)
 
     def get_edge_init_data(self, fn, save_path=None):
         """
@@ -513,46 +891,133 @@ class TileEdgeFile(object):
                           self.edges[fn].keys()}
         return edge_init_data, edge_init_done, edge_init_todo
 
+    def get_transfer_links(self):
+        """
+        Finds, for every edge pixel of every tile, the pixel of the neighbor
+        whose UCA is used for it, as done by get_neighbor_updates (nearest
+        pixel, later neighbors take precedence). Used by
+        ProcessManager.process_edges_transfer.
+
+        Returns
+        --------
+        shapes : dict
+            Shape of every tile
+        links : dict
+            For every tile: (ids, providers, pixels). ids are the sorted
+            indices (into the raveled tile) of the edge pixels that get their
+            UCA from a neighbor, providers the index of that neighbor in
+            self.tiles, and pixels the index into the raveled neighbor.
+        """
+        axes = {}
+        for fn in self.tiles:
+            elev_file = GdalReader(file_name=fn)
+            gc = elev_file.grid_coordinates
+            axes[fn] = (np.asarray(gc.y_axis), np.asarray(gc.x_axis))
+            del elev_file  # close file
+        shapes = {fn: (y.size, x.size) for fn, (y, x) in axes.iteritems()}
+
+        opp = {'top': 'bottom', 'left': 'right'}
+        links = {}
+        for tile_i, fn in enumerate(self.tiles):
+            m, n = shapes[fn]
+            ids = np.arange(m * n).reshape(m, n)
+            providers = np.full((m, n), -1, 'int64')
+            pixels = np.full((m, n), -1, 'int64')
+            for key in self.neighbor_sides:
+                oppkey = key
+                for me, neigh in opp.iteritems():
+                    if me in key:
+                        oppkey = oppkey.replace(me, neigh)
+                    else:
+                        oppkey = oppkey.replace(neigh, me)
+                for tile in self.neighbors[fn][key]:
+                    if fn not in self.neighbors[tile][oppkey]:
+                        continue
+                    y_axis, x_axis = axes[tile]
+                    for side in key.split('-'):
+                        y, x = self.edges[fn][side].get_coordinates().T
+                        # The interpolator is built on the reversed y axis
+                        i = y_axis.size - 1 - _nearest_index(y_axis[::-1], y)
+                        j = _nearest_index(x_axis, x)
+                        valid = (i < y_axis.size) & (j >= 0)
+                        I = ids[self.slices[side]].ravel()[valid]
+                        providers.ravel()[I] = self.tiles.index(tile)
+                        pixels.ravel()[I] = i[valid] * x_axis.size + j[valid]
+            I = np.nonzero(providers.ravel() >= 0)[0]
+            links[fn] = (I, providers.ravel()[I], pixels.ravel()[I])
+        return shapes, links
+
     def find_best_candidate(self, elev_source_files=None):
         """
         Heuristically determines which tile should be recalculated based on
         updated edge information. Presently does not check if that tile is
         locked, which could lead to a parallel thread closing while one thread
         continues to process tiles.
+
+        The tiles are kept in a priority queue on (percent_done, max_elev), in
+        which only the tiles with updated edges are replaced.
         """
-        self.fill_percent_done()
-        i_b = np.argmax(self.percent_done.values())
-        if self.percent_done.values()[i_b] <= 0:
+        self.refresh()
+        self.update_percent_done()
+        queue = self._queue
+        while queue and self._is_outdated(queue[0]):
+            heapq.heappop(queue)
+        if not queue or -queue[0][0] <= 0:
             return None
+        fn = queue[0][2]
 
-        # check for ties
-        I = np.array(self.percent_done.values()) == \
-            self.percent_done.values()[i_b]
-        if I.sum() == 1:
-            pass  # no ties
-        else:
-            I2 = np.argmax(np.array(self.max_elev.values())[I])
-            i_b = I.nonzero()[0][I2]
-
-            # Make sure the apples are still apples
-            assert(np.array(self.max_elev.keys())[I][I2]
-                   == np.array(self.percent_done.keys())[I][I2])
-
-        if elev_source_files is not None:
-            fn = self.percent_done.keys()[i_b]
-            lckfn = _get_lockfile_name(fn)
-            if os.path.exists(lckfn):  # another process is working on it
-                # Find a different Candidate
-                i_alt = np.argsort(self.percent_done.values())[::-1]
-                for i in i_alt:
-                    fn = self.percent_done.keys()[i]
-                    lckfn = _get_lockfile_name(fn)
-                    if not os.path.exists(lckfn):
-                        break
-            # Get and return the index
-            i_b = elev_source_files.index(fn)
-
-        return i_b
+        if elev_source_files is None:
+            return self.percent_done.keys().index(fn)
+
+        lckfn = _get_lockfile_name(fn)
+        if os.path.exists(lckfn):  # another process is working on it
+            # Find a different Candidate
+            popped = []
+            while queue:
+                entry = heapq.heappop(queue)
+                if self._is_outdated(entry):
+                    continue
+                popped.append(entry)
+                fn = entry[2]
+                lckfn = _get_lockfile_name(fn)
+                if not os.path.exists(lckfn):
+                    break
+            for entry in popped:
+                heapq.heappush(queue, entry)
+        # Get and return the index
+        return elev_source_files.index(fn)
+
+    def find_best_candidates(self, elev_source_files, n):
+        """
+        Like find_best_candidate, but selects up to n tiles that can be
+        recalculated at the same time. No two of the selected tiles are
+        neighbors (this includes the corners), so none of them uses edge data
+        that another one of them updates.
+
+        Returns
+        --------
+        indices : list
+            Indices of the tiles in elev_source_files, best candidate first
+        """
+        self.refresh()
+        self.update_percent_done()
+        # Same order as find_best_candidate: highest percent done, and then
+        # highest elevation to break ties
+        fns = sorted([fn for fn in self.percent_done
+                      if self.percent_done[fn] > 0],
+                     key=lambda fn: (self.percent_done[fn], self.max_elev[fn]),
+                     reverse=True)
+        selected = []
+        blocked = set()
+        for fn in fns:
+            if fn in blocked:
+                continue
+            selected.append(fn)
+            for tiles in self.neighbors[fn].values():
+                blocked.update(tiles)
+            if len(selected) == n:
+                break
+        return [elev_source_files.index(fn) for fn in selected]
 
 
 class ProcessManager(object):
@@ -566,6 +1031,12 @@ class ProcessManager(object):
                          'grib2', 'grb', 'gr1']
     tile_edge = None
     _DEBUG = False
+    # How process resolves the drainage across tile edges. 'iterative'
+    # recalculates tiles until the edges no longer change. 'transfer'
+    # computes how the UCA on the edges of every tile drains to the pixels
+    # its neighbors use, solves for the UCA on all the edges at once, and
+    # then recalculates every tile once (see process_edges_transfer).
+    edge_resolution = 'iterative'
 
     def __init__(self, source_path='.', save_path='processed_data',
                  clean_tmp=True, use_cache=True, overwrite_cache=False):
@@ -611,7 +1082,8 @@ class ProcessManager(object):
             if not os.path.isdir(os.path.join(save_path,  subdir)):
                 os.makedirs(os.path.join(save_path,  subdir))
 
-    def process_twi(self, index=None, do_edges=False, skip_uca_twi=False):
+    def process_twi(self, index=None, do_edges=False, skip_uca_twi=False,
+                    n_workers=1, recalculate_uca=False, pool=None):
         """
         Processes the TWI, along with any dependencies (like the slope and UCA)
 
@@ -630,21 +1102,39 @@ class ProcessManager(object):
         skip_uca_twi : bool (optional)
             Skips the calculation of the UCA and TWI (only calculates the
             magnitude and direction)
+        n_workers : int (optional)
+            Default 1. If larger than 1, the tiles are processed by a pool of
+            n_workers processes (see :py:func:`process_twi_parallel`).
+        recalculate_uca : bool (optional)
+            Default False. If True, the UCA is calculated from scratch with
+            the edge data, instead of updating a previously computed UCA.
+        pool : multiprocessing.Pool (optional)
+            Pool of n_workers processes from :py:func:`_mk_pool`, reused
+            across calls. If None, a pool is created for this call.
         Notes
         ------
         do_edges = False for the first round of the processing, but it is True
         for the second round.
         """
+        if n_workers > 1:
+            if index is not None:
+                indices = [index]
+            else:
+                indices = range(len(self.elev_source_files))
+            return self.process_twi_parallel(indices, n_workers, do_edges,
+                                             skip_uca_twi,
+                                             recalculate_uca=recalculate_uca,
+                                             pool=pool)
         if index is not None:
             elev_source_files = [self.elev_source_files[index]]
         else:
             elev_source_files = self.elev_source_files
         for i, esfile in enumerate(elev_source_files):
             try:
-                fn, status = self.calculate_twi(esfile,
-                                                save_path=self.save_path,
-                                                do_edges=do_edges,
-                                                skip_uca_twi=skip_uca_twi)
+                fn, status = self.calculate_twi(
+                    esfile, save_path=self.save_path, do_edges=do_edges,
+                    skip_uca_twi=skip_uca_twi,
+                    recalculate_uca=recalculate_uca)
                 if index is None:
                     self.twi_status[i] = status
                 else:
@@ -661,8 +1151,104 @@ class ProcessManager(object):
                     self.twi_status[i] = "Error " + traceback.format_exc()
                 else:
                     self.twi_status[index] = "Error " + traceback.format_exc()
+        if self.tile_edge is not None:
+            self.tile_edge.flush()
 
-    def process(self, index=None):
+    def process_twi_parallel(self, indices, n_workers, do_edges=False,
+                             skip_uca_twi=False, atomic=False,
+                             recalculate_uca=False, pool=None):
+        """
+        Processes the TWI of the tiles in indices on a pool of worker
+        processes. See :py:func:`process_twi` for the other arguments.
+
+        The workers only calculate the tiles. This process hands out the
+        tiles, with the latest edge data, and saves the edge updates of the
+        finished tiles, so the edge data is never written concurrently. The
+        state of every tile is kept in self.twi_status ('Queued',
+        'Processing', and then the final status), so no lock files are used.
+        Do not combine this with other ProcessManager instances processing
+        the same tiles.
+
+        If atomic is True, the edge updates are only saved after all the
+        tiles are finished (in the order of indices), so all the tiles use
+        the edge data from before this call, independent of the order in
+        which they finish.
+
+        The tiles are calculated by pool (see :py:func:`_mk_pool`), or by a
+        pool of n_workers processes created for this call if pool is None.
+        """
+        self.load_tile_edge(self.save_path)
+        queued = list(indices)
+        for i in queued:
+            self.twi_status[i] = 'Queued'
+
+        own_pool = pool is None
+        if own_pool:
+            pool = self._mk_pool(n_workers)
+        running = {}
+        all_updates = {}
+        try:
+            while queued or running:
+                # Keep all the workers busy
+                while queued and len(running) < n_workers:
+                    i = queued.pop(0)
+                    esfile = self.elev_source_files[i]
+                    if skip_uca_twi:
+                        edge_init_data = None
+                    else:
+                        edge_init_data = \
+                            self.tile_edge.get_edge_init_data(esfile,
+                                                              self.save_path)
+                    self.twi_status[i] = 'Processing'
+                    running[i] = pool.apply_async(
+                        _process_twi_worker,
+                        ((i, do_edges, skip_uca_twi, edge_init_data,
+                          recalculate_uca), ))
+
+                finished = [i for i in running if running[i].ready()]
+                if not finished:
+                    time.sleep(0.1)
+                    continue
+                for i in finished:
+                    # _process_twi_worker reports its own errors, but the
+                    # arguments or the results may fail to be sent
+                    try:
+                        _, status, updates = running.pop(i).get()
+                    except Exception:
+                        traceback.print_exc()
+                        status = "Error " + traceback.format_exc()
+                        updates = None
+                    if atomic:
+                        all_updates[i] = updates
+                    elif updates is not None:
+                        self.tile_edge.apply_edge_updates(updates)
+                    self.twi_status[i] = status
+                    print 'Finished', self.elev_source_files[i], ':', \
+                        status.split('\n')[0]
+        finally:
+            if own_pool:
+                pool.terminate()
+                pool.join()
+
+        for i in indices:
+            if all_updates.get(i) is not None:
+                self.tile_edge.apply_edge_updates(all_updates[i])
+        self.tile_edge.flush()
+
+    def _mk_pool(self, n_workers):
+        """
+        Creates the pool of n_workers processes used by
+        :py:func:`process_twi_parallel`. The workers get a copy of this
+        manager, with its TileEdgeFile, from which they only use the options
+        and the (static) neighbors and edge coordinates. So the same pool
+        can be used for all the rounds of the processing.
+        """
+        self.load_tile_edge(self.save_path)
+        return multiprocessing.Pool(n_workers,
+                                    initializer=_init_process_worker,
+                                    initargs=(self, ))
+
+    def process(self, index=None, n_workers=1):
         """
         This will completely process a directory of elevation tiles (as
         supplied in the constructor). Both phases of the calculation, the
@@ -673,17 +1259,48 @@ class ProcessManager(object):
         index : int/slice (optional)
             Default None - processes all tiles in a directory. See
             :py:func:`process_twi` for additional options.
+        n_workers : int (optional)
+            Default 1. Number of worker processes. In the edge resolution
+            round, up to n_workers non-neighboring tiles are recalculated at
+            the same time (see :py:func:`process_edges_parallel`). The same
+            pool of processes is used for all the rounds.
         """
-        # Round 0 of twi processing, process the magnitude and directions of
-        # slopes
-        print "Starting slope calculation round"
-        self.process_twi(index, do_edges=False, skip_uca_twi=True)
-
-        # Round 1 of twi processing
-        print "Starting self-area calculation round"
-        self.process_twi(index, do_edges=False)
-
-        # Round 2 of twi processing: edge resolution
+        pool = None
+        if n_workers > 1:
+            pool = self._mk_pool(n_workers)
+        try:
+            # Round 0 of twi processing, process the magnitude and directions
+            # of slopes
+            print "Starting slope calculation round"
+            self.process_twi(index, do_edges=False, skip_uca_twi=True,
+                             n_workers=n_workers, pool=pool)
+
+            # Round 1 of twi processing
+            print "Starting self-area calculation round"
+            self.process_twi(index, do_edges=False, n_workers=n_workers,
+                             pool=pool)
+
+            # Round 2 of twi processing: edge resolution
+            if self.edge_resolution == 'transfer':
+                return self.process_edges_transfer(n_workers, pool)
+            elif self.edge_resolution != 'iterative':
+                raise RuntimeError("Unknown edge_resolution '%s'"
+                                   % self.edge_resolution)
+            return self.process_edges_iterative(n_workers, pool)
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+    def process_edges_iterative(self, n_workers=1, pool=None):
+        """
+        The edge resolution round of :py:func:`process` for edge_resolution
+        = 'iterative': the tiles are recalculated until the UCA stops
+        changing across their edges. See :py:func:`process_edges_parallel`
+        for pool.
+        """
+        if n_workers > 1:
+            return self.process_edges_parallel(n_workers, pool)
         i = self.tile_edge.find_best_candidate(self.elev_source_files)
 
         print "Starting edge resolution round: ",
@@ -708,8 +1325,146 @@ class ProcessManager(object):
         print '*'*79
         return self
 
+    def process_edges_parallel(self, n_workers, pool=None):
+        """
+        The edge resolution round of :py:func:`process`, using n_workers
+        processes. Every iteration recalculates a set of non-neighboring
+        tiles (see TileEdgeFile.find_best_candidates) in parallel, and then
+        saves all their edge updates at once. All the iterations use pool,
+        or a pool created for this round if it is None.
+        """
+        own_pool = pool is None
+        if own_pool:
+            pool = self._mk_pool(n_workers)
+        try:
+            I = self.tile_edge.find_best_candidates(self.elev_source_files,
+                                                    n_workers)
+
+            print "Starting edge resolution round: ",
+            count = 0
+            I_old = []
+            same_count = 0
+            while I and same_count < 3:
+                count += 1
+                print '*' * 10
+                print count, '(%s -- > %s) .' % (I_old, I)
+                self.process_twi_parallel(I, n_workers, do_edges=True,
+                                          atomic=True, pool=pool)
+                I_old = I
+                I = self.tile_edge.find_best_candidates(
+                    self.elev_source_files, n_workers)
+                if I_old == I:
+                    same_count += 1
+                else:
+                    same_count = 0
+        finally:
+            if own_pool:
+                pool.terminate()
+                pool.join()
+
+        print '*'*79
+        print '*******    PROCESSING COMPLETED     *******'
+        print '*'*79
+        return self
+
+    def process_edges_transfer(self, n_workers=1, pool=None):
+        """
+        The edge resolution round of :py:func:`process` for edge_resolution
+        = 'transfer'. The UCA of a tile is linear in the UCA on its edges,
+        so for every tile the map from the UCA on its edges to the UCA at the
+        pixels used by its neighbors is calculated once (see
+        DEMProcessor.calc_uca_transfer). The UCA on all the edges then
+        follows from a single sparse linear solve over the edge pixels, and
+        every tile is recalculated once with these edges. If the drainage
+        goes around in a circle across the tile edges, this falls back to
+        :py:func:`process_edges_iterative`. If n_workers > 1, the tiles are
+        recalculated by pool (see :py:func:`process_twi`).
+        """
+        tile_edge = self.load_tile_edge(self.save_path)
+        tiles = tile_edge.tiles
+        shapes, links = tile_edge.get_transfer_links()
+
+        # The pixels of every tile that its neighbors use
+        samples = [np.unique(np.concatenate(
+            [links[fn][2][links[fn][1] == k] for fn in tiles]))
+            for k in range(len(tiles))]
+
+        print "Calculating the edge transfer maps: ",
+        uca0, transfer = [], []
+        for k, fn in enumerate(tiles):
+            print k,
+            dem_proc = DEMProcessor(fn)
+            dem_proc.load_direction(dem_proc.get_full_fn('ang',
+                                                         self.save_path))
+            dem_proc.load_slope(dem_proc.get_full_fn('mag', self.save_path))
+            dem_proc.find_flats()
+            covered = np.zeros(shapes[fn], bool)
+            covered.ravel()[links[fn][0]] = True
+            u0, K = dem_proc.calc_uca_transfer(covered, samples[k])
+            uca0.append(u0)
+            transfer.append(K)
+            del dem_proc
+            gc.collect()
+        print '..Done'
+
+        # Unknowns: the UCA of the edge pixels, tile after tile. Each of these
+        # is the UCA of the neighbor's pixel it is linked to.
+        offsets = np.cumsum([0] + [links[fn][0].size for fn in tiles])
+        if offsets[-1] == 0:
+            print "No edges to resolve"
+            return self
+        rhs, blocks = [], []
+        for fn in tiles:
+            _, providers, pixels = links[fn]
+            u0 = np.zeros(pixels.size)
+            block = sps.coo_matrix((pixels.size, offsets[-1]))
+            for k in np.unique(providers):
+                I = np.nonzero(providers == k)[0]
+                r = np.searchsorted(samples[k], pixels[I])
+                u0[I] = uca0[k][r]
+                K = transfer[k][r].tocoo()
+                block = block + sps.coo_matrix(
+                    (K.data, (I[K.row], K.col + offsets[k])),
+                    shape=block.shape)
+            rhs.append(u0)
+            blocks.append(block)
+        G = sps.vstack(blocks).tocsc()
+        G.eliminate_zeros()
+        # Without circular drainage across the edges, I - G is a permuted
+        # triangular matrix with a unit diagonal, so it is not singular. With
+        # it, the solve would keep accumulating area around the cycle (or
+        # fail, if all of the area goes around), so the edges are resolved
+        # iteratively instead.
+        n_comp, _ = spcg.connected_components(G, directed=True,
+                                              connection='strong')
+        if n_comp < G.shape[0] or G.diagonal().any():
+            warnings.warn("Circular drainage across the tile edges, "
+                          "resolving the edges iteratively instead")
+            return self.process_edges_iterative(n_workers, pool)
+        uca_edges = spsl.spsolve(
+            sps.identity(offsets[-1], format='csc') - G, np.concatenate(rhs))
+
+        updates = []
+        for i, fn in enumerate(tiles):
+            values = np.full(shapes[fn], np.nan)
+            values.ravel()[links[fn][0]] = uca_edges[offsets[i]:offsets[i + 1]]
+            for side in tile_edge.edge_sides:
+                data = values[tile_edge.slices[side]].ravel()
+                done = np.where(np.isnan(data), np.nan, 1.0)
+                updates += [(fn, side, 'data', data), (fn, side, 'done', done)]
+        tile_edge.apply_edge_updates(updates)
+
+        print "Recalculating the tiles with the resolved edges"
+        self.process_twi(do_edges=True, n_workers=n_workers,
+                         recalculate_uca=True, pool=pool)
+
+        print '*'*79
+        print '*******    PROCESSING COMPLETED     *******'
+        print '*'*79
+        return self
+
     def calculate_twi(self, esfile, save_path, use_cache=True, do_edges=False,
-                      skip_uca_twi=False):
+                      skip_uca_twi=False, recalculate_uca=False):
         """
         Calculates twi for supplied elevation file
 
@@ -729,28 +1484,15 @@ class ProcessManager(object):
         skip_uca_twi : bool (optional)
             Skips the calculation of the UCA and TWI (only calculates the
             magnitude and direction)
+        recalculate_uca : bool (optional)
+            See :py:func:`process_twi` for details on this argument.
         """
-        if os.path.exists(os.path.join(save_path, 'tile_edge.pkl')) and \
-                self.tile_edge is None:
-            with open(os.path.join(save_path, 'tile_edge.pkl'), 'r') as fid:
-                self.tile_edge = cPickle.load(fid)
-        elif self.tile_edge is None:
-            self.tile_edge = TileEdgeFile(self.elev_source_files, save_path)
-            with open(os.path.join(save_path, 'tile_edge.pkl'), 'wb') as fid:
-                cPickle.dump(self.tile_edge, fid)
+        self.load_tile_edge(save_path)
 
-
-        status = 'Success'  # optimism
         # Check if file is locked
         lckfn = _get_lockfile_name(esfile)
         coords = parse_fn(esfile)
         fn = get_fn_from_coords(coords, 'twi')
-        print '*'*79
-        if skip_uca_twi:
-            print '*'*10, fn, 'Slope Calculation starting...:', '*'*10
-        else:
-            print '*'*10, fn, 'TWI Calculation starting...:', '*'*10
-        print '*'*79
         if os.path.exists(lckfn):  # another process is working on it
             print fn, 'is locked'
             return fn, "Locked"
@@ -758,6 +1500,68 @@ class ProcessManager(object):
             fid = file(lckfn, 'w')
             fid.close()
 
+        try:
+            if skip_uca_twi:
+                edge_init_data = None
+            else:
+                edge_init_data = self.tile_edge.get_edge_init_data(esfile,
+                                                                   save_path)
+            fn, status, dem_proc = self._calculate_twi(
+                esfile, save_path, do_edges, skip_uca_twi, edge_init_data,
+                recalculate_uca)
+            if dem_proc is not None:
+                # Saving Edge Data, and updating edges
+                self.tile_edge.update_edges(esfile, dem_proc)
+        finally:
+            # remove lock file
+            os.remove(lckfn)
+        return fn, status
+
+    def load_tile_edge(self, save_path):
+        """
+        Loads the TileEdgeFile from the manifest in save_path, or creates it
+        if it does not exist yet
+        """
+        if self.tile_edge is None:
+            self.tile_edge = TileEdgeFile.load_or_create(
+                self.elev_source_files, save_path)
+        return self.tile_edge
+
+    def _calculate_twi(self, esfile, save_path, do_edges, skip_uca_twi,
+                       edge_init_data, recalculate_uca=False):
+        """
+        Does the work for :py:func:`calculate_twi`, without touching the lock
+        files or the edge data.
+
+        Parameters
+        -----------
+        edge_init_data : list
+            [edge_init_data, edge_init_done, edge_init_todo] as returned by
+            TileEdgeFile.get_edge_init_data. Not used if skip_uca_twi.
+        recalculate_uca : bool (optional)
+            If True, a previously computed UCA is not used, and the UCA
+            (calculated from scratch) is saved as the edge corrected UCA.
+
+        Returns
+        --------
+        fn : str
+            Name of the TWI file
+        status : str
+            Status of the calculation
+        dem_proc : DEMProcessor
+            The DEMProcessor if the UCA was calculated, in which case the
+            edges need to be updated, otherwise None
+        """
+        status = 'Success'  # optimism
+        coords = parse_fn(esfile)
+        fn = get_fn_from_coords(coords, 'twi')
+        print '*'*79
+        if skip_uca_twi:
+            print '*'*10, fn, 'Slope Calculation starting...:', '*'*10
+        else:
+            print '*'*10, fn, 'TWI Calculation starting...:', '*'*10
+        print '*'*79
+
         dem_proc = DEMProcessor(esfile)
         # check if the slope already exists for the file. If yes, we should
         # move on to the next tile without doing anything else
@@ -768,17 +1572,13 @@ class ProcessManager(object):
                                    + '.npz'):
             print dem_proc.get_full_fn('mag', save_path) + '.npz', 'already exists'
             print dem_proc.get_full_fn('ang', save_path) + '.npz', 'already exists'
-            # remove lock file
-            os.remove(lckfn)
-            return fn, 'Cached: Slope'
+            return fn, 'Cached: Slope', None
         # check if the twi already exists for the file. If not in the edge
         # resolution round, we should move on to the next tile
         if os.path.exists(dem_proc.get_full_fn('twi', save_path)) \
                 and (do_edges is False):
             print dem_proc.get_full_fn('twi', save_path), 'already exists'
-            # remove lock file
-            os.remove(lckfn)
-            return fn, 'Cached'
+            return fn, 'Cached', None
 
         # only calculate the slopes and direction if they do not exist in cache
         fn_ang = dem_proc.get_full_fn('ang', save_path)
@@ -801,34 +1601,32 @@ class ProcessManager(object):
             dem_proc.save_direction(save_path, as_int=False)
 
         if skip_uca_twi:
-            # remove lock file
-            os.remove(lckfn)
-            return fn, status + ":mag-dir-only"
+            return fn, status + ":mag-dir-only", None
 
         fn_uca = dem_proc.get_full_fn('uca', save_path)
         fn_uca_ec = dem_proc.get_full_fn('uca_edge_corrected', save_path)
         fn_twi = dem_proc.get_full_fn('twi', save_path)
 
         # check if edge structure exists for this tile and initialize
-        edge_init_data, edge_init_done, edge_init_todo = \
-            self.tile_edge.get_edge_init_data(esfile, save_path)
+        edge_init_data, edge_init_done, edge_init_todo = edge_init_data
 
         # Check if uca data exists (if yes, we are in the
         # edge-resolution round)
         uca_init = None
-        if os.path.exists(fn_uca + '.npz'):
+        if os.path.exists(fn_uca + '.npz') and not recalculate_uca:
             if os.path.exists(fn_uca_ec + '.npz'):
                 dem_proc.load_uca(fn_uca_ec)
             else:
                 dem_proc.load_uca(fn_uca)
             uca_init = dem_proc.uca
 
+        edges_changed = False
         if do_edges or uca_init is None:
             dem_proc.calc_uca(uca_init=uca_init,
                               edge_init_data=[edge_init_data, edge_init_done,
                                               edge_init_todo])
 
-            if uca_init is None:
+            if uca_init is None and not recalculate_uca:
                 dem_proc.save_uca(save_path, raw=True)
                 if self._DEBUG:
                     # Also save a geotiff for debugging
@@ -841,8 +1639,7 @@ class ProcessManager(object):
                 if self._DEBUG:
                     dem_proc.save_array(dem_proc.uca, None, 'uca_edge_corrected',
                                         save_path, as_int=False)
-            # Saving Edge Data, and updating edges
-            self.tile_edge.update_edges(esfile, dem_proc)
+            edges_changed = True
 
         dem_proc.calc_twi()
         if os.path.exists(fn_twi):
@@ -852,12 +1649,12 @@ class ProcessManager(object):
         # clean up for in case
         gc.collect()
 
-        # remove lock file
-        os.remove(lckfn)
         # Save last-used dem_proc for debugging purposes
         if self._DEBUG:
             self.dem_proc = dem_proc
-        return fn, status
+        if edges_changed:
+            return fn, status, dem_proc
+        return fn, status, None
 
     def process_hillshade(self, index=None):
         def command(esfile, fn):
@@ -931,6 +1728,119 @@ class ProcessManager(object):
                 else:
                     self.custom_status[index] = "Error " + traceback.format_exc()
 
+def _nearest_index(axis, values):
+    """
+    Index of the nearest point in the increasing axis for every value, with
+    the same tie-breaking as scipy's RegularGridInterpolator. Values outside
+    of the axis give -1.
+    """
+    i = np.clip(np.searchsorted(axis, values) - 1, 0, max(axis.size - 2, 0))
+    step = axis[np.minimum(i + 1, axis.size - 1)] - axis[i]
+    t = (values - axis[i]) / np.where(step == 0, 1, step)
+    index = np.where(t <= 0.5, i, i + 1)
+    index[(values < axis[0]) | (values > axis[-1])] = -1
+    return index
+
+
 def _get_lockfile_name(esfile):
     lckfn = esfile + '.lck'
     return lckfn
+
+
+class _ManifestLock(object):
+    """
+    Lock file around reading and writing the manifest of a TileEdgeFile.
+    While the lock is held, a thread touches the lock file every timeout / 4
+    seconds, so a lock file that has not been modified for timeout seconds
+    is left over from a crashed process, however long the lock is held. The
+    lock file contains the PID of the process holding it.
+    """
+    def __init__(self, fn, timeout=60):
+        self.lckfn = _get_lockfile_name(fn)
+        self.timeout = timeout
+        self.owner = str(os.getpid())
+        self._released = None
+        self._thread = None
+
+    def __enter__(self):
+        while True:
+            try:
+                fid = os.open(self.lckfn,
+                              os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except OSError:
+                self._remove_stale()
+                time.sleep(0.01)
+                continue
+            os.write(fid, self.owner)
+            os.close(fid)
+            break
+        self._released = threading.Event()
+        self._thread = threading.Thread(target=self._touch,
+                                        args=(self._released, ))
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def _touch(self, released):
+        while not released.wait(self.timeout / 4.0):
+            try:
+                os.utime(self.lckfn, None)
+            except OSError:
+                return
+
+    def _remove_stale(self):
+        try:
+            age = time.time() - os.path.getmtime(self.lckfn)
+        except OSError:  # released in the meantime
+            return
+        if age > self.timeout:
+            warnings.warn('Removing stale lock ' + self.lckfn)
+            try:
+                os.remove(self.lckfn)
+            except OSError:
+                pass
+
+    def __exit__(self, *args):
+        self._released.set()
+        self._thread.join()
+        # The lock may have been removed as stale (and taken by another
+        # process) while this process was stalled
+        try:
+            with open(self.lckfn) as fid:
+                owner = fid.read()
+            if owner == self.owner:
+                os.remove(self.lckfn)
+        except (IOError, OSError):
+            pass
+
+
+# The ProcessManager used by the worker processes of
+# ProcessManager.process_twi_parallel
+_process_worker = {}
+
+
+def _init_process_worker(manager):
+    _process_worker['manager'] = manager
+
+
+def _process_twi_worker(args):
+    """
+    Calculates a single tile for ProcessManager.process_twi_parallel.
+    Returns the index of the tile, the status, and the edge updates (or None).
+    Errors are reported in the status, so that they do not stop the other
+    tiles.
+    """
+    i, do_edges, skip_uca_twi, edge_init_data, recalculate_uca = args
+    manager = _process_worker['manager']
+    esfile = manager.elev_source_files[i]
+    try:
+        fn, status, dem_proc = manager._calculate_twi(
+            esfile, manager.save_path, do_edges, skip_uca_twi, edge_init_data,
+            recalculate_uca)
+        updates = None
+        if dem_proc is not None:
+            updates = manager.tile_edge.get_edge_updates(esfile, dem_proc)
+        return i, status, updates
+    except:
+        traceback.print_exc()
+        return i, "Error " + traceback.format_exc(), None
@@ -158,17 +158,17 @@ class GdalReader(DiskReader):
 
         # Read array data.
         if arr is None:
-            arr = raster_band.ReadAsArray().copy()
-            arr = np.ma.masked_array(arr, np.logical_not(raster_band.GetMaskBand().ReadAsArray()))
-            # NAN's:
-            # -9999 and 9999 are NaN's... if we eventually get masked data,
-            # we'll want to take care of it here.
-            if raster_band.GetNoDataValue() is None:
-                for nan_value in [-9999, 9999, np.nan]:
-                    try:
-                        arr = np.ma.masked_equal(arr, nan_value)
-                    except:
-                        pass
+            # Read in strips into a single array, so that no full-size
+            # temporaries are created
+            y_size, x_size = raster_band.YSize, raster_band.XSize
+            dtype = raster_band.ReadAsArray(0, 0, 1, 1).dtype
+            arr = np.ma.masked_array(np.empty((y_size, x_size), dtype),
+                                     np.zeros((y_size, x_size), bool))
+            for (te, be, le, re), block in self._iter_band_windows(
+                    raster_band, 256, x_size):
+                arr.data[te:be, le:re] = block.data
+                arr.mask[te:be, le:re] = block.mask
+            self._set_fill_value(arr, raster_band)
         else:
             arr = np.ma.masked_invalid(arr)
 #         if raster_band.GetNoDataValue() is not None:
@@ -187,6 +187,126 @@ class GdalReader(DiskReader):
         # layer.print_traits()
         return layer
 
+    @property
+    def block_size(self):
+        """
+        The native (rows, columns) block size of the first raster band.
+        Windows aligned to this size are read without decoding the same
+        blocks more than once.
+        """
+        x_block, y_block = self._gdal_dataset.GetRasterBand(1).GetBlockSize()
+        return y_block, x_block
+
+    def read_window(self, te, be, le, re, halo=0, band=1):
+        """
+        Reads the window [te:be, le:re] of a raster band, without reading
+        the rest of the raster.
+
+        Parameters
+        -----------
+        te, be, le, re : int
+            Top, bottom, left and right edges of the window (in pixels)
+        halo : int, optional
+            Default 0. Number of extra pixels read on each side of the
+            window. The halo is clipped at the edges of the raster.
+        band : int, optional
+            Default 1. The (1-based) raster band to read.
+
+        Returns
+        --------
+        arr : np.ma.MaskedArray
+            The data in the window (including the halo), with no-data
+            values masked as for raster_layers.
+        bounds : tuple
+            The (te, be, le, re) edges of arr in the raster, which differ
+            from the requested window by the halo.
+        """
+        raster_band = self._gdal_dataset.GetRasterBand(band)
+        bounds = self._clip_window(raster_band, te - halo, be + halo,
+                                   le - halo, re + halo)
+        arr = self._read_band_window(raster_band, *bounds)
+        self._set_fill_value(arr, raster_band)
+        return arr, bounds
+
+    def iter_windows(self, rows=None, cols=None, halo=0, band=1):
+        """
+        Generator that reads a raster band one window at a time, so only a
+        window (and not the whole raster) is ever held in memory.
+
+        Parameters
+        -----------
+        rows, cols : int, optional
+            Nominal size of the windows. They are rounded up to a multiple
+            of the native block size of the file (which is the default).
+        halo : int, optional
+            Default 0. Number of extra pixels read on each side of the
+            windows (clipped at the edges of the raster). Neighbouring
+            windows overlap by 2 * halo.
+        band : int, optional
+            Default 1. The (1-based) raster band to read.
+
+        Yields
+        -------
+        window : tuple
+            The (te, be, le, re) edges of the window without the halo. The
+            windows tile the raster exactly.
+        arr : np.ma.MaskedArray
+            The data in the window including the halo
+        bounds : tuple
+            The (te, be, le, re) edges of arr in the raster
+        """
+        raster_band = self._gdal_dataset.GetRasterBand(band)
+        for window, arr in self._iter_band_windows(raster_band, rows, cols,
+                                                   halo):
+            self._set_fill_value(arr, raster_band)
+            yield window, arr, self._clip_window(
+                raster_band, window[0] - halo, window[1] + halo,
+                window[2] - halo, window[3] + halo)
+
+    def _iter_band_windows(self, raster_band, rows=None, cols=None, halo=0):
+        x_block, y_block = raster_band.GetBlockSize()
+        rows = y_block * max(1, -(-(rows or y_block) // y_block))
+        cols = x_block * max(1, -(-(cols or x_block) // x_block))
+        y_size, x_size = raster_band.YSize, raster_band.XSize
+        for te in xrange(0, y_size, rows):
+            be = min(te + rows, y_size)
+            for le in xrange(0, x_size, cols):
+                re = min(le + cols, x_size)
+                bounds = self._clip_window(raster_band, te - halo, be + halo,
+                                           le - halo, re + halo)
+                yield (te, be, le, re), \
+                    self._read_band_window(raster_band, *bounds)
+
+    @staticmethod
+    def _clip_window(raster_band, te, be, le, re):
+        return (max(te, 0), min(be, raster_band.YSize),
+                max(le, 0), min(re, raster_band.XSize))
+
+    @staticmethod
+    def _read_band_window(raster_band, te, be, le, re):
+        """
+        Reads and masks [te:be, le:re] of raster_band in a single pass.
+        """
+        arr = raster_band.ReadAsArray(le, te, re - le, be - te)
+        mask = raster_band.GetMaskBand().ReadAsArray(le, te, re - le, be - te)
+        mask = mask == 0
+        # NAN's:
+        # -9999 and 9999 are NaN's... if we eventually get masked data,
+        # we'll want to take care of it here.
+        if raster_band.GetNoDataValue() is None:
+            mask |= (arr == -9999) | (arr == 9999)
+        return np.ma.masked_array(arr, mask)
+
+    @staticmethod
+    def _set_fill_value(arr, raster_band):
+        # Same fill value as masking the no-data values one at a time
+        if raster_band.GetNoDataValue() is None:
+            for nan_value in [-9999, 9999, np.nan]:
+                try:
+                    arr.fill_value = nan_value
+                except:
+                    pass
+
     @cached_property
     def _get_raster_layers(self):
         raster_bands = [self._gdal_dataset.GetRasterBand(i)
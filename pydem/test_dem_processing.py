@@ -0,0 +1,544 @@
+# -*- coding: utf-8 -*-
+"""
+   Copyright 2015 Creare
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+Regression tests for DEMProcessor, run on the synthetic elevations of
+test_pydem. Usage: python -m pytest pydem
+"""
+import warnings
+import pytest
+import numpy as np
+import scipy.sparse as sps
+import scipy.ndimage as spndi
+from scipy.ndimage.filters import gaussian_filter
+
+import dem_processing
+from dem_processing import (DEMProcessor, CYTHON, FLAT_ID_INT, FLATS_KERNEL3,
+                            _get_flat_ids, _tarboton_slopes_directions,
+                            _tarboton_slopes_directions_numpy)
+from utils import get_adjacent_index
+from test_pydem import (case_cone, case_line, case_top_flat, case_ring_flat,
+                        spiral)
+
+NN = 48
+
+
+def mk_cases(NN=NN):
+    """
+    A few of the test_pydem elevations, as in make_test_files
+    """
+    x, y = np.mgrid[-1:1:np.complex(0, NN), -1:1:np.complex(0, NN)]
+    return {'cone': case_cone(x, y)[0],
+            'line': case_line(x, y, [-1, 1])[0],
+            'top_flat': case_top_flat(x, y, [slice(NN//2, NN//2+1),
+                                             slice(0, NN//2)])[0],
+            'ring_flat': case_ring_flat(x, y, [slice(NN//2, NN//2+1),
+                                               slice(NN//2, NN)])[0],
+            'spiral': spiral(x, y)[0]}
+
+
+def mk_rand(NN=NN, seed=0):
+    """
+    Smooth random terrain with many pits, which drain across chunk edges
+    """
+    raster = gaussian_filter(np.random.RandomState(seed).rand(NN, NN), 3) \
+        * 100 + 10
+    return np.ma.masked_array(raster, mask=np.zeros(raster.shape, bool))
+
+
+def mk_dem_proc(raster, **options):
+    """
+    DEMProcessor for the raster with the options set and the slopes and
+    directions calculated
+    """
+    raster = np.ma.masked_array(np.ma.getdata(raster).astype('float64'),
+                                mask=np.ma.getmaskarray(raster).copy())
+    dem_proc = DEMProcessor(raster)
+    for key, val in options.items():
+        setattr(dem_proc, key, val)
+    dem_proc.calc_slopes_directions()
+    return dem_proc
+
+
+def calc_uca(raster, **options):
+    dem_proc = mk_dem_proc(raster, **options)
+    dem_proc.calc_uca()
+    return dem_proc
+
+
+def assert_same_uca(dem_proc1, dem_proc2, rtol=1e-10):
+    np.testing.assert_allclose(np.nan_to_num(dem_proc1.uca),
+                               np.nan_to_num(dem_proc2.uca), rtol=rtol,
+                               atol=0)
+
+
+def test_fill_flats_priority_flood():
+    # No flats are left after filling (pits would also be flat)
+    for name in ['top_flat', 'ring_flat']:
+        raster = mk_cases()[name]
+        dem_proc = mk_dem_proc(raster, fill_flats_method='priority_flood')
+        data = dem_proc.data.filled(np.nan)
+        flat = spndi.minimum_filter(data, (3, 3)) >= data
+        assert not flat[1:-1, 1:-1].any()
+
+        # Missing data is not compared
+        data = np.ma.filled(raster.astype('float64'), np.nan)
+        data[5:9, 5:9] = np.nan
+        edge = np.ones(data.shape, bool)
+        edge[1:-1, 1:-1] = False
+        with np.errstate(invalid='ignore'):
+            flat = spndi.minimum_filter(data, (3, 3)) >= data
+        with np.errstate(invalid='raise'):
+            dem_proc._fill_flats_priority_flood(data, flat, edge)
+
+
+def test_fill_flat_non_convex():
+    # A flat around a wall, draining at the top left corner. The exact
+    # within-flat distances of get_distance go around the wall, which changes
+    # the bottom row (the previous distances gave 5.983229 at [7, 3], with
+    # direction pi)
+    raster = np.full((9, 6), 10.0)
+    raster[1:-1, 1:-1] = 5.0
+    raster[4:7, 2:4] = 10.0
+    raster[0, 0] = 4.0
+    dem_proc = mk_dem_proc(np.ma.masked_array(raster,
+                                              mask=np.zeros((9, 6), bool)))
+    data = [[5.000000, 5.500000, 5.800000, 5.900000],
+            [5.500000, 5.333333, 5.593017, 5.920991],
+            [5.800000, 5.853553, 5.888889, 5.936130],
+            [5.900000, 10.00000, 10.00000, 5.947368],
+            [5.941176, 10.00000, 10.00000, 5.964894],
+            [5.961538, 10.00000, 10.00000, 5.974982],
+            [5.972973, 5.976271, 5.982133, 5.981293]]
+    direction = [[2.553590, 3.141593, 4.015837, 3.729595],
+                 [1.570796, 2.553590, 3.141593, 3.141593],
+                 [1.216091, 1.570796, 2.100208, 2.553590],
+                 [1.570796, 1.579406, 1.576526, 2.553590],
+                 [1.570796, 3.126376, 0.006515, 1.570796],
+                 [1.570796, 4.711843, 4.711416, 1.570796],
+                 [1.570796, 2.553590, 0.588003, 1.570796]]
+    mag = [[4.992302, 3.000000, 2.428554, 1.532550],
+           [4.500000, 1.664101, 1.558104, 1.967845],
+           [2.879236, 4.681981, 3.085195, 1.712923],
+           [0.900000, 37.31940, 37.00061, 0.291947],
+           [0.370588, 24.35576, 24.21115, 0.157732],
+           [0.183258, 36.21357, 36.16082, 0.090787],
+           [0.102911, 0.073548, 0.035704, 0.056802]]
+    np.testing.assert_allclose(dem_proc.data.data[1:-1, 1:-1], data,
+                               atol=1e-5)
+    np.testing.assert_allclose(dem_proc.direction[1:-1, 1:-1], direction,
+                               atol=1e-5)
+    np.testing.assert_allclose(dem_proc.mag[1:-1, 1:-1], mag, atol=1e-4)
+
+
+@pytest.mark.skipif(not CYTHON, reason='needs the compiled Cython functions')
+def test_tarboton_kernel():
+    # The compiled kernel gives the slopes and directions of the NumPy code
+    cases = mk_cases()
+    cases['rand'] = mk_rand()
+    cases['steps'] = np.round(np.random.RandomState(0).rand(25, 30) * 3)
+    for name, raster in sorted(cases.items()):
+        n = raster.shape[0]
+        for dX, dY in [(np.ones(n - 1) / n, np.ones(n - 1) / n),
+                       (np.linspace(.8, 1.2, n - 1),
+                        np.linspace(1.1, .9, n - 1))]:
+            args = (raster.astype('float64'), dX, dY, DEMProcessor.facets,
+                    DEMProcessor.ang_adj)
+            for arr1, arr2 in zip(_tarboton_slopes_directions(*args),
+                                  _tarboton_slopes_directions_numpy(*args)):
+                np.testing.assert_array_equal(arr1, arr2)
+
+
+def find_flats_edges_loop(data, mag):
+    """
+    The previous _find_flats_edges, which goes through the flats one by one
+    """
+    flat = mag == FLAT_ID_INT
+    flats, n = spndi.label(flat, structure=FLATS_KERNEL3)
+    i12 = np.arange(data.size).reshape(data.shape)
+    d = data.ravel()
+    f = flat.ravel()
+    for i, _obj in enumerate(spndi.find_objects(flats)):
+        I = i12[_obj][flats[_obj] == i + 1]
+        J = get_adjacent_index(I, data.shape, data.size)
+        f[J] = d[J] == d[I[0]]
+    return f.reshape(data.shape)
+
+
+def test_find_flats_edges():
+    cases = mk_cases()
+    cases['rand'] = mk_rand()
+    # Many small flats next to each other
+    cases['steps'] = np.round(np.random.RandomState(0).rand(25, 30) * 3)
+    for name, raster in sorted(cases.items()):
+        dem_proc = DEMProcessor(np.ma.masked_array(raster.astype('float64')))
+        data = dem_proc.data
+        mag, direction = dem_proc._slopes_directions(
+            data, dem_proc.dX, dem_proc.dY)
+        np.testing.assert_array_equal(
+            dem_proc._find_flats_edges(data, mag, direction),
+            find_flats_edges_loop(data, mag))
+
+
+def mk_connectivity_flats_loop(dem_proc, flats, elev, mag):
+    """
+    The previous _mk_connectivity_flats, which goes through the flats one by
+    one. Returns the connectivity as a sparse matrix.
+    """
+    nn, mm = flats.shape
+    NN = flats.size
+    i12 = np.arange(NN).reshape(flats.shape)
+    j1 = - np.ones_like(i12)
+    j2 = - np.ones_like(i12)
+    mat_data = np.zeros((2, nn, mm))
+    flat_i = [np.zeros(0, 'int64')]
+    flat_j = [np.zeros(0, 'int64')]
+    flat_prop = [np.zeros(0)]
+    assigned, n_flats = spndi.label(flats, FLATS_KERNEL3)
+    flat_ids, flat_coords, _ = _get_flat_ids(assigned)
+    for ii in range(n_flats):
+        ids_flats = flat_ids[flat_coords[ii]:flat_coords[ii + 1]]
+        edges = spndi.binary_dilation(assigned == ii + 1, FLATS_KERNEL3)
+        edges.ravel()[ids_flats] = False
+        ids_edge = np.nonzero(edges.ravel())[0]
+        flat_elev_loc = elev.ravel()[ids_flats]
+        I_filt = elev.ravel()[ids_edge] < flat_elev_loc.min()
+        loc_slope = mag.ravel()[ids_edge][I_filt].astype('float64')
+        if loc_slope.size == 0:
+            on_edge = ((ids_flats % mm) == 0) | ((ids_flats % mm) == mm - 1) \
+                | (ids_flats <= mm) | (ids_flats >= mm * (nn - 1))
+            if not on_edge.any():
+                continue
+            drain_ids = ids_flats[on_edge]
+            props = mag.ravel()[drain_ids].astype('float64')
+            ids_flats = ids_flats[~on_edge]
+            if ids_flats.size == 0:
+                continue
+            flat_elev_loc = flat_elev_loc[~on_edge]
+        else:
+            min_edges = (loc_slope + loc_slope * dem_proc.dX.mean() / 2) \
+                >= loc_slope.min()
+            drain_ids = ids_edge[I_filt][min_edges]
+            props = loc_slope[min_edges]
+        props /= props.sum()
+        # The area collects at the first lowest pixel of the flat
+        one_id = ids_flats[np.argmin(flat_elev_loc)]
+        others = ids_flats[ids_flats != one_id]
+        j1.ravel()[others] = one_id
+        mat_data.ravel()[others] = 1
+        j1.ravel()[one_id] = drain_ids[0]
+        mat_data.ravel()[one_id] = props[0]
+        if drain_ids.size > 1:
+            j2.ravel()[one_id] = drain_ids[1]
+            mat_data.ravel()[one_id + NN] = props[1]
+        flat_i.append(np.full(drain_ids[2:].size, one_id, 'int64'))
+        flat_j.append(drain_ids[2:])
+        flat_prop.append(props[2:])
+    return mk_flats_matrix(NN, j1, j2, mat_data, np.concatenate(flat_i),
+                           np.concatenate(flat_j), np.concatenate(flat_prop))
+
+
+def mk_flats_matrix(NN, j1, j2, mat_data, flat_i, flat_j, flat_prop):
+    i = np.concatenate([np.arange(NN), np.arange(NN), flat_i])
+    j = np.concatenate([j1.ravel(), j2.ravel(), flat_j])
+    data = np.concatenate([mat_data.ravel(), flat_prop])
+    I = (j >= 0) & (data != 0)
+    return sps.csr_matrix((data[I], (i[I], j[I])), shape=(NN, NN))
+
+
+def test_mk_connectivity_flats():
+    cases = mk_cases()
+    cases['rand'] = mk_rand()
+    # Terraces, with a flat along the edge of the image that has nowhere
+    # else to drain
+    cases['terraces'] = np.round(mk_rand(seed=1) / 5) * 5
+    cases['terraces'][:3] = cases['terraces'].min()
+    n_flats = 0
+    for name, raster in sorted(cases.items()):
+        dem_proc = mk_dem_proc(raster, fill_flats=False)
+        elev = dem_proc.data
+        mag = dem_proc.mag
+        flats = dem_proc._find_flats_edges(elev, mag, dem_proc.direction)
+        n_flats += spndi.label(flats, FLATS_KERNEL3)[1]
+        shape = flats.shape
+        i12 = np.arange(flats.size).reshape(shape)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            j1, j2, mat_data, flat_i, flat_j, flat_prop = \
+                dem_proc._mk_connectivity_flats(
+                    i12, - np.ones_like(i12), - np.ones_like(i12),
+                    np.zeros((2, ) + shape), flats, elev, mag)
+            A_ref = mk_connectivity_flats_loop(dem_proc, flats, elev, mag)
+        A = mk_flats_matrix(flats.size, j1, j2, mat_data, flat_i, flat_j,
+                            flat_prop)
+        # The proportions are normalized in a different order
+        assert ((A != 0) != (A_ref != 0)).nnz == 0, name
+        assert abs(A - A_ref).max() < 1e-12, name
+        # Every flat pixel that drains hands on all of its area
+        rows = np.asarray(A.sum(1)).ravel()
+        np.testing.assert_allclose(rows[rows > 0], 1)
+    assert n_flats > 0
+
+
+def test_slopes_directions_parallel():
+    # The worker processes use the options of the DEMProcessor
+    dem_proc = mk_dem_proc(mk_rand(), float_dtype='float32')
+    chunks = [(0, 28, 0, 48), (20, 48, 0, 28), (20, 48, 20, 48)]
+    results = []
+    for n_workers in [1, 2]:
+        dem_proc.n_workers = n_workers
+        results.append(list(dem_proc._slopes_directions_chunks(chunks)))
+    for serial, parallel in zip(*results):
+        for arr1, arr2 in zip(serial, parallel):
+            assert arr1.dtype == arr2.dtype
+            np.testing.assert_array_equal(arr1, arr2)
+        assert parallel[0].dtype == np.float32
+
+
+def test_slopes_directions_parallel_memmap(tmpdir, monkeypatch):
+    # The workers use the memory-mapped elevation of the out-of-core mode
+    # without copying it to shared memory
+    dem_proc = mk_dem_proc(mk_rand(), scratch_dir=str(tmpdir))
+    raster = dem_proc.data
+    dem_proc.data = np.ma.masked_array(
+        dem_proc._working_array(0, raster.dtype),
+        dem_proc._working_array(False, bool))
+    dem_proc.data.data[:] = raster.data
+    dem_proc.data.mask[:] = np.ma.getmaskarray(raster)
+    chunks = [(0, 28, 0, 48), (20, 48, 0, 28), (20, 48, 20, 48)]
+    serial = list(dem_proc._slopes_directions_chunks(chunks))
+
+    def raw_array(*args):
+        raise AssertionError('the elevation is copied to shared memory')
+    monkeypatch.setattr(dem_processing.multiprocessing, 'RawArray', raw_array)
+    dem_proc.n_workers = 2
+    parallel = list(dem_proc._slopes_directions_chunks(chunks))
+    for res1, res2 in zip(serial, parallel):
+        for arr1, arr2 in zip(res1, res2):
+            np.testing.assert_array_equal(arr1, arr2)
+
+
+def test_numba_drain_functions():
+    # The numba queue functions give the same results as the Cython ones
+    try:
+        from cyfuncs import cyutils, nbutils
+    except ImportError:
+        pytest.skip('needs numba and the compiled Cython functions')
+    dem_proc = mk_dem_proc(mk_rand(), uca_network='matrix')
+    A, _, _ = dem_proc._get_uca_connectivity(
+        dem_proc.data, dem_proc.dX, dem_proc.dY, dem_proc.direction,
+        dem_proc.mag, dem_proc.flats)
+    B = A.tocsr()
+    shape = dem_proc.data.shape
+    edge = np.ones(shape, bool)
+    edge[1:-1, 1:-1] = False
+    edge = edge.ravel()
+
+    results = []
+    for module in [cyutils, nbutils]:
+        arr = module.drain_connections_queue(
+            np.ones(edge.size, bool), edge.copy(), A.indptr, A.indices, 0)
+        ids = np.asarray(A.sum(1)).ravel() == 0
+        area, done, edge_todo, edge_todo_no_mask = module.drain_area_queue(
+            np.ones(edge.size), np.zeros(edge.size, bool), ids, A.indptr,
+            A.indices, A.data, B.indptr, B.indices, shape[0], shape[1],
+            edge.astype(float), edge.astype(float))
+        results.append([arr, area, done, edge_todo, edge_todo_no_mask])
+    for cy_arr, nb_arr in zip(*results):
+        np.testing.assert_allclose(cy_arr, nb_arr, rtol=1e-12)
+
+
+@pytest.mark.skipif(not CYTHON, reason='needs the compiled Cython functions')
+def test_uca_drain_queue():
+    # Draining in topological order gives the same UCA as the sweeps
+    cases = mk_cases()
+    cases['rand'] = mk_rand()
+    for name, raster in sorted(cases.items()):
+        for chunk_size in [512, 20]:
+            dem_procs = [calc_uca(raster, uca_network='matrix',
+                                  uca_drain_method=method,
+                                  chunk_size_uca=chunk_size,
+                                  chunk_overlap_uca=4)
+                         for method in ['queue', 'iterative']]
+            assert_same_uca(*dem_procs, rtol=0)
+
+
+@pytest.mark.skipif(not CYTHON, reason='needs the compiled Cython functions')
+def test_uca_network_receivers():
+    # The receiver arrays give the UCA of the adjacency matrix, up to the
+    # precision of their proportions
+    cases = mk_cases()
+    cases['rand'] = mk_rand()
+    for name, raster in sorted(cases.items()):
+        for chunk_size in [512, 20]:
+            for float_dtype, rtol in [('float64', 0), ('float32', 1e-6)]:
+                dem_procs = [calc_uca(raster, uca_network=network,
+                                      float_dtype=float_dtype,
+                                      chunk_size_uca=chunk_size,
+                                      chunk_overlap_uca=4)
+                             for network in ['receivers', 'matrix']]
+                assert_same_uca(*dem_procs, rtol=rtol)
+                np.testing.assert_array_equal(dem_procs[0].edge_done,
+                                              dem_procs[1].edge_done)
+
+
+def test_pit_drains(monkeypatch):
+    # A pit that is only drained after growing its area over the lowest
+    # pixel of its border
+    dem_proc = DEMProcessor(np.ma.zeros((5, 5)))
+    elev = np.full((5, 5), 3.0)
+    elev[2, 2:5] = [1, 2, 0]
+    flats = np.zeros((5, 5), bool)
+    flats[2, 2] = True
+    pit_i, pit_j, pit_prop, (ids, pit_mag) = dem_proc._mk_connectivity_pits(
+        np.arange(25).reshape(5, 5), flats, np.ma.masked_array(elev),
+        np.ones(4), np.ones(4))
+    np.testing.assert_array_equal(pit_i, [12])
+    np.testing.assert_array_equal(pit_j, [14])
+    np.testing.assert_allclose(pit_prop, [0.5])
+    np.testing.assert_array_equal(ids, [12])
+    np.testing.assert_allclose(pit_mag, [0.5])
+    dem_proc.drain_pits_max_iter = 1
+    # Python 2 does not repeat a warning that is in the registry, even
+    # with the 'always' filter
+    monkeypatch.setattr(dem_processing, '__warningregistry__', {},
+                        raising=False)
+    with warnings.catch_warnings(record=True) as w:
+        warnings.simplefilter('always')
+        pits = dem_proc._mk_connectivity_pits(
+            np.arange(25).reshape(5, 5), flats, np.ma.masked_array(elev),
+            np.ones(4), np.ones(4))[3]
+    assert len(w) == 1 and pits[0].size == 0
+
+    # The compiled search finds the drains of the Python one
+    for seed in range(3):
+        dem_proc = mk_dem_proc(mk_rand(seed=seed))
+        e = dem_proc.data.filled(np.nan).ravel()
+        pits = np.nonzero(dem_proc.flats.ravel())[0]
+        pits = pits[np.argsort(e[pits])]
+        results = []
+        for cython in [CYTHON, False]:
+            monkeypatch.setattr(dem_processing, 'CYTHON', cython)
+            results.append(dem_proc._find_pit_drains(pits, e,
+                                                     dem_proc.data.shape))
+        monkeypatch.undo()
+        for arr1, arr2 in zip(*results):
+            np.testing.assert_array_equal(arr1, arr2)
+
+
+def test_uca_connectivity_cache():
+    # The chunked UCA must not depend on which chunks stay in the cache
+    for network in ['matrix', 'receivers']:
+        dem_procs = [calc_uca(mk_rand(), chunk_size_uca=20,
+                              chunk_overlap_uca=4, uca_network=network,
+                              uca_connectivity_cache_mb=cache_mb)
+                     for cache_mb in [0, 512]]
+        assert_same_uca(*dem_procs, rtol=0)
+        np.testing.assert_array_equal(dem_procs[0].flats, dem_procs[1].flats)
+        np.testing.assert_array_equal(dem_procs[0].mag, dem_procs[1].mag)
+
+
+def test_uca_chunked_pits():
+    # A pit in the overlap of two chunks is drained by the first of them,
+    # and it is not drained again towards the border of the second one. The
+    # error of the chunked UCA stays at the level of the unchunked pits.
+    for seed in [1, 2]:
+        raster = np.round(mk_rand(96, seed=seed))
+        uca = calc_uca(raster).uca
+        uca_chunked = calc_uca(raster, chunk_size_uca=32,
+                               chunk_overlap_uca=4).uca
+        I = np.zeros(uca.shape, bool)
+        I[1:-1, 1:-1] = True
+        I[I] = uca[I] > 0
+        err = np.abs(np.nan_to_num(uca_chunked[I]) - uca[I]) / uca[I]
+        assert err.mean() < 0.025
+        assert err.max() < 50
+
+
+def test_uca_update_solve():
+    # Without circular drainage, solving the edge updates gives the
+    # unchunked UCA on these cases (draining does not, on the spiral)
+    for name, raster in sorted(mk_cases().items()):
+        dem_proc = calc_uca(raster)
+        dem_proc_solve = calc_uca(raster, chunk_size_uca=20,
+                                  chunk_overlap_uca=4,
+                                  uca_update_method='solve')
+        dem_proc.uca[0, :] = dem_proc.uca[-1, :] = 0
+        dem_proc.uca[:, 0] = dem_proc.uca[:, -1] = 0
+        dem_proc_solve.uca[0, :] = dem_proc_solve.uca[-1, :] = 0
+        dem_proc_solve.uca[:, 0] = dem_proc_solve.uca[:, -1] = 0
+        assert_same_uca(dem_proc, dem_proc_solve, rtol=1e-9)
+
+
+def test_uca_solver_circular():
+    dem_proc = DEMProcessor(np.ma.zeros((4, 4)))
+    # 5 drains into 6, which drains into 9: no circular drainage
+    A = sps.csc_matrix(([1.0, 1.0], ([6, 9], [5, 6])), shape=(16, 16))
+    solver = dem_proc._get_uca_solver(A, (4, 4))
+    assert solver is not None
+    area = np.zeros((4, 4))
+    area[1, 1] = 1
+    ids = np.zeros(16, bool)
+    ids[5] = True
+    area, _ = dem_proc._solve_uca_update(solver, area, ids)
+    np.testing.assert_allclose(area[1:3, 1:3], [[1, 1], [1, 0]])
+    # 6 also drains half of its area back into 5: this chunk is drained
+    A = sps.csc_matrix(([1.0, 0.5, 0.5], ([6, 9, 5], [5, 6, 6])),
+                       shape=(16, 16))
+    assert dem_proc._get_uca_solver(A, (4, 4)) is None
+
+
+def test_uca_transfer():
+    # The UCA with given edges is the transfer map applied to those edges
+    slices = {'left': [slice(None), slice(0, 1)],
+              'right': [slice(None), slice(-1, None)],
+              'top': [slice(0, 1), slice(None)],
+              'bottom': [slice(-1, None), slice(None)]}
+    rand = np.random.RandomState(1)
+    for name, raster in sorted(mk_cases(24).items()):
+        dem_proc = mk_dem_proc(raster)
+        covered = np.zeros(raster.shape, bool)
+        covered[0, :] = covered[-1, :] = covered[:, 0] = covered[:, -1] = True
+        edges = np.zeros(raster.shape)
+        edges[covered] = rand.rand(covered.sum()) + 0.01
+        sample_ids = np.arange(raster.size)
+        uca0, transfer = dem_proc.calc_uca_transfer(covered, sample_ids)
+        uca = (uca0 + transfer * edges[covered]).reshape(raster.shape)
+
+        data = dict((side, edges[slc].ravel())
+                    for side, slc in slices.items())
+        done = dict((side, np.ones(edges[slc].size, bool))
+                    for side, slc in slices.items())
+        dem_proc.calc_uca(edge_init_data=[data, done, done])
+        I = np.isfinite(dem_proc.uca)
+        I[0, :] = I[-1, :] = I[:, 0] = I[:, -1] = False
+        np.testing.assert_allclose(uca[I], dem_proc.uca[I], rtol=1e-9)
+
+
+def test_drainage_levels_circular():
+    dem_proc = DEMProcessor(np.ma.zeros((4, 4)))
+    receives = np.ones(16, bool)
+    # 5 drains into 6, which drains into 9
+    A = sps.csc_matrix(([1.0, 1.0], ([6, 9], [5, 6])), shape=(16, 16))
+    level = dem_proc._get_drainage_levels(A, receives)
+    assert level[5] < level[6] < level[9]
+    # 6 also drains half of its area back into 5
+    A = sps.csc_matrix(([1.0, 0.5, 0.5], ([6, 9, 5], [5, 6, 6])),
+                       shape=(16, 16))
+    with warnings.catch_warnings(record=True) as w:
+        warnings.simplefilter('always')
+        level = dem_proc._get_drainage_levels(A, receives)
+    assert len(w) == 1
+    assert (level >= 0).all() and level[6] < level[9]
@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+"""
+   Copyright 2015 Creare
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+Tests for the tile bookkeeping of the processing_manager, which do not need
+any elevation files. Usage: python -m pytest pydem
+"""
+import os
+import time
+import warnings
+import multiprocessing
+import multiprocessing.pool
+
+import numpy as np
+
+import processing_manager
+from processing_manager import ProcessManager, TileEdgeFile, _ManifestLock, \
+    find_neighbors
+from utils import parse_fn, get_fn_from_coords
+
+
+def neighbor_sides(neighbors):
+    """
+    The neighbors as {(tile, neighbor): side}
+    """
+    return dict(((fn, neigh), side) for fn in neighbors
+                for side in neighbors[fn] for neigh in neighbors[fn][side])
+
+
+def test_find_neighbors_regular():
+    # 3 x 3 grid of 1 degree tiles, named by the [row, column] from the top
+    # left
+    tiles = ['%d%d' % (i, j) for i in range(3) for j in range(3)]
+    bounds = [[2 - i, j, 3 - i, j + 1] for i in range(3) for j in range(3)]
+    tol = [[0.0005, 0.0005]] * 9
+    sides = neighbor_sides(find_neighbors(tiles, bounds, tol))
+    assert len(sides) == 2 * (2 * 6 + 2 * 4)
+    assert sides[('11', '01')] == 'top'
+    assert sides[('11', '21')] == 'bottom'
+    assert sides[('11', '10')] == 'left'
+    assert sides[('11', '12')] == 'right'
+    assert sides[('11', '00')] == 'top-left'
+    assert sides[('11', '02')] == 'top-right'
+    assert sides[('11', '22')] == 'bottom-right'
+    assert sides[('11', '20')] == 'bottom-left'
+    assert ('00', '22') not in sides
+
+
+def test_find_neighbors_overlapping():
+    # Tiles overlapping by a tenth of a tile, and a tile inside another one
+    tiles = ['a', 'b', 'c', 'inner']
+    bounds = [[0, 0, 1.1, 1.1], [0, 1, 1.1, 2.1], [1, 0, 2.1, 1.1],
+              [0.2, 0.2, 0.8, 0.8]]
+    tol = [[0.0005, 0.0005]] * 4
+    sides = neighbor_sides(find_neighbors(tiles, bounds, tol))
+    assert sides == {('a', 'b'): 'right', ('b', 'a'): 'left',
+                     ('a', 'c'): 'top', ('c', 'a'): 'bottom',
+                     ('b', 'c'): 'top-left', ('c', 'b'): 'bottom-right'}
+
+
+def test_find_neighbors_irregular():
+    # A large tile, with two small tiles on its right, and a small tile on
+    # its top-right corner. The tolerances differ between the tiles.
+    tiles = ['large', 'lower', 'upper', 'corner']
+    bounds = [[0, 0, 2, 2], [0, 2, 1, 3], [1, 2, 2, 3], [2, 2, 3, 3]]
+    tol = [[0.001, 0.001], [0.0005, 0.0005], [0.0005, 0.0005],
+           [0.0005, 0.0005]]
+    neighbors = find_neighbors(tiles, bounds, tol)
+    assert sorted(neighbors['large']['right']) == ['lower', 'upper']
+    assert neighbors['large']['top-right'] == ['corner']
+    assert neighbors['lower']['left'] == ['large']
+    assert neighbors['lower']['top'] == ['upper']
+    assert neighbors['upper']['top-left'] == []
+    assert neighbors['upper']['left'] == ['large']
+    assert neighbors['upper']['top'] == ['corner']
+    assert neighbors['corner']['bottom-left'] == ['large']
+    assert neighbors['corner']['bottom'] == ['upper']
+    assert ('corner', 'lower') not in neighbor_sides(neighbors)
+
+
+def test_manifest_lock_stale(tmpdir):
+    fn = str(tmpdir.join('manifest.npz'))
+    lock = _ManifestLock(fn, timeout=60)
+    # Left over from a crashed process
+    open(lock.lckfn, 'w').close()
+    os.utime(lock.lckfn, (time.time() - 120, time.time() - 120))
+    with warnings.catch_warnings(record=True) as w:
+        warnings.simplefilter('always')
+        with lock:
+            assert open(lock.lckfn).read() == str(os.getpid())
+    assert len(w) == 1
+    assert not os.path.exists(lock.lckfn)
+
+
+def test_manifest_lock_held(tmpdir):
+    # A lock held for longer than the timeout is kept fresh, so it is not
+    # taken as stale
+    fn = str(tmpdir.join('manifest.npz'))
+    lock = _ManifestLock(fn, timeout=0.2)
+    with lock:
+        time.sleep(0.5)
+        _ManifestLock(fn, timeout=0.2)._remove_stale()
+        assert os.path.exists(lock.lckfn)
+
+
+def test_manifest_lock_gone(tmpdir):
+    fn = str(tmpdir.join('manifest.npz'))
+    lock = _ManifestLock(fn)
+    with lock:
+        os.remove(lock.lckfn)
+    # Removed as stale, and then taken by another process
+    with lock:
+        with open(lock.lckfn, 'w') as fid:
+            fid.write('-1')
+    assert open(lock.lckfn).read() == '-1'
+
+
+class _TileEdge(object):
+    def __init__(self):
+        # The tiles returned by find_best_candidates, one call after the
+        # other
+        self.candidates = [[0, 2], [1]]
+
+    def get_edge_updates(self, esfile, dem_proc):
+        # Edge updates that cannot be sent back from the worker
+        return [lambda: None]
+
+    def get_edge_init_data(self, esfile, save_path):
+        return None
+
+    def apply_edge_updates(self, updates):
+        pass
+
+    def flush(self):
+        pass
+
+    def find_best_candidates(self, elev_source_files, n):
+        if self.candidates:
+            return self.candidates.pop(0)
+        return []
+
+
+class _Manager(ProcessManager):
+    def __init__(self):
+        self.elev_source_files = ['a', 'b', 'c']
+        self.twi_status = [None] * 3
+        self.save_path = '.'
+        self.tile_edge = _TileEdge()
+
+    def _calculate_twi(self, esfile, *args):
+        return esfile, 'Success', object() if esfile == 'b' else None
+
+
+def test_process_twi_parallel_error():
+    # A tile whose result cannot be sent back is an error, instead of
+    # waiting for it forever
+    manager = _Manager()
+    manager.process_twi_parallel([0, 1, 2], 2, skip_uca_twi=True)
+    assert manager.twi_status[0] == manager.twi_status[2] == 'Success'
+    assert manager.twi_status[1].startswith('Error')
+
+
+def test_process_pool(monkeypatch):
+    # All the rounds of the processing use the same pool of workers
+    pools = []
+
+    def pool(*args, **kwargs):
+        pools.append(multiprocessing.pool.Pool(*args, **kwargs))
+        return pools[-1]
+    monkeypatch.setattr(processing_manager.multiprocessing, 'Pool', pool)
+    manager = _Manager()
+    manager.process(n_workers=2)
+    assert len(pools) == 1
+    assert manager.twi_status[0] == manager.twi_status[2] == 'Success'
+    assert not manager.tile_edge.candidates
+
+
+class _GridCoordinates(object):
+    def __init__(self, fn, n):
+        lat0, lon0, lat1, lon1 = parse_fn(fn)[:4]
+        dx = (lon1 - lon0) / (n - 1.)
+        self.x_size = self.y_size = n
+        self.geotransform = [lon0 - dx / 2, dx, 0, lat1 + dx / 2, 0, -dx]
+        self.x_axis = np.linspace(lon0, lon1, n)
+        self.y_axis = np.linspace(lat1, lat0, n)
+
+
+class _Reader(object):
+    # Reads a constant elevation from the tile coordinates, without any file
+    n = 10
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.grid_coordinates = _GridCoordinates(file_name, self.n)
+
+    def iter_windows(self):
+        yield None, np.ma.masked_array([float(parse_fn(self.file_name)[0])]), \
+            None
+
+
+class _DEMProc(object):
+    pass
+
+
+class _CrashingManager(ProcessManager):
+    """
+    Calculates the first tile, and then the process dies (without flushing
+    the edge data or saving the manifest at the end of process_twi)
+    """
+    def __init__(self, tiles, save_path):
+        self.elev_source_files = tiles
+        self.twi_status = [None] * len(tiles)
+        self.save_path = save_path
+        self.tile_edge = None
+
+    def _calculate_twi(self, esfile, *args):
+        if esfile != self.elev_source_files[0]:
+            os._exit(1)
+        dem_proc = _DEMProc()
+        dem_proc.elev = _Reader(esfile)
+        n = _Reader.n
+        dem_proc.data = np.ones((n, n))
+        dem_proc.uca = np.arange(n * n, dtype=float).reshape(n, n)
+        dem_proc.edge_done = np.ones((n, n), bool)
+        dem_proc.edge_todo = np.zeros((n, n), bool)
+        return esfile, 'Success', dem_proc
+
+
+def test_manifest_interrupted(tmpdir, monkeypatch):
+    # The metrics in the manifest match the edge data after a tile is done,
+    # even if the processing is interrupted before it finishes
+    monkeypatch.setattr(processing_manager, 'GdalReader', _Reader)
+    tiles = [str(tmpdir.join(get_fn_from_coords([i, j, i + 1, j + 1])))
+             for i in range(2) for j in range(2)]
+    save_path = str(tmpdir.join('processed_data'))
+    os.makedirs(os.path.join(save_path, 'edge'))
+    TileEdgeFile.load_or_create(tiles, save_path)
+    process = multiprocessing.Process(
+        target=_CrashingManager(tiles, save_path).process_twi)
+    process.start()
+    process.join()
+    assert process.exitcode == 1
+
+    tile_edge = TileEdgeFile.load_manifest(tiles, save_path)
+    percent_done = dict(tile_edge.percent_done)
+    assert any(percent_done.values())
+    tile_edge.fill_percent_done(update_metrics=True)
+    assert percent_done == tile_edge.percent_done
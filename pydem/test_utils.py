@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+   Copyright 2015 Creare
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+Regression tests for the utils, run on the synthetic elevations of
+test_pydem. Usage: python -m pytest pydem
+"""
+import numpy as np
+import scipy.ndimage as spndi
+
+import utils
+from utils import get_distance, get_border_mask
+from test_pydem import case_ring_flat, case_line_flat
+
+_ORTH2 = np.array([[0, 1, 0], [1, 1, 1], [0, 1, 0]])
+
+
+def get_distance_filter(region, src):
+    """
+    The minimum filters of the previous get_distance, repeated until the
+    distances no longer change (so they are exact on non-convex regions)
+    """
+    d = np.full(region.shape, float(region.size))
+    d[src] = 0
+    while True:
+        d_orth = spndi.minimum_filter(d, footprint=_ORTH2) + 1
+        d_diag = spndi.minimum_filter(d, (3, 3)) + np.sqrt(2.0)
+        d_new = d.copy()
+        d_new[region] = np.minimum(np.minimum(d_orth, d_diag), d)[region]
+        if (d_new == d).all():
+            return d
+        d = d_new
+
+
+def mk_flats(NN=48):
+    """
+    The largest flat of case_ring_flat and case_line_flat, with its
+    sources and drains as in DEMProcessor._fill_flat
+    """
+    x, y = np.mgrid[-1:1:np.complex(0, NN), -1:1:np.complex(0, NN)]
+    flats = []
+    for raster in [case_ring_flat(x, y, [slice(NN//2, NN//2+1),
+                                         slice(NN//2, NN)])[0],
+                   case_line_flat(x, y, [1, 0])[0]]:
+        raster = np.ma.filled(raster, np.nan)
+        flat = spndi.minimum_filter(raster, (3, 3)) >= raster
+        labels, n = spndi.label(flat, structure=np.ones((3, 3)))
+        region = labels == np.argmax(np.bincount(labels.ravel())[1:]) + 1
+        e = raster[region][0]
+        border = get_border_mask(region)
+        flats.append((region, border & (raster > e)))
+        flats.append((region, border & (raster == e)))
+    return flats
+
+
+def test_get_distance(monkeypatch):
+    for region, src in mk_flats():
+        d = get_distance_filter(region, src)
+        np.testing.assert_allclose(get_distance(region, src)[region],
+                                   d[region], rtol=1e-12)
+        # The Python version, without the compiled functions
+        monkeypatch.setattr(utils, 'CYTHON', False)
+        np.testing.assert_allclose(get_distance(region, src)[region],
+                                   d[region], rtol=1e-12)
+        monkeypatch.undo()
+
+
+def test_get_distance_unreachable():
+    region = np.zeros((5, 7), bool)
+    region[1:4, 1:3] = True
+    region[1:4, 4:6] = True
+    src = np.zeros(region.shape, bool)
+    src[2, 0] = True
+    d = get_distance(region, src)
+    np.testing.assert_allclose(d[2, 1:3], [1, 2])
+    assert (d[region] == region.size).sum() == 6
@@ -32,17 +32,23 @@ Created on Tue Oct 14 17:25:50 2014
 
 @author: mpu
 """
-from geopy.distance import distance
 import os
 import gdal
 import osr
 import re
 from reader.gdal_reader import GdalReader
 
+import heapq
 import numpy as np
 from scipy.ndimage.filters import minimum_filter
 from scipy.ndimage.measurements import center_of_mass
 
+try:
+    from cyfuncs import cyutils
+    CYTHON = True
+except:
+    CYTHON = False
+
 def rename_files(files, name=None):
     """
     Given a list of file paths for elevation files, this function will rename
@@ -65,10 +71,8 @@ def rename_files(files, name=None):
     """
     for fil in files:
         elev_file = GdalReader(file_name=fil)
-        elev, = elev_file.raster_layers
-        fn = get_fn(elev, name)
+        fn = get_fn(elev_file, name)
         del elev_file
-        del elev
         fn = os.path.join(os.path.split(fil)[0], fn)
         os.rename(fil, fn)
         print "Renamed", fil, "to", fn
@@ -142,23 +146,112 @@ def get_fn_from_coords(coords, name=None):
     return new_name.replace('.', 'o') + '.tif'
 
 
+# Cache for mk_dx_dy_from_geotif_layer. All the tiles in a latitude band
+# have the same dX and dY.
+_DX_DY_CACHE = {}
+
+
 def mk_dx_dy_from_geotif_layer(geotif):
     """
-    Extracts the change in x and y coordinates from the geotiff file. Presently
-    only supports WGS-84 files.
+    Extracts the change in x and y coordinates from the geotiff file. For
+    geographic coordinate systems, the distances are calculated on the
+    ellipsoid of the file (see :py:func:`ellipsoid_distance`). For projected
+    coordinate systems, the pixel size is used.
+    """
+    gc = geotif.grid_coordinates
+    gt = gc.geotransform
+    srs = osr.SpatialReference()
+    srs.ImportFromWkt(gc.wkt_)
+    if srs.IsProjected():
+        units = srs.GetLinearUnits()  # m
+        dX = np.ones((gc.y_size - 1)) * np.abs(gt[1]) * units
+        dY = np.ones((gc.y_size - 1)) * np.abs(gt[5]) * units
+        return dX, dY
+
+    a, inv_f = srs.GetSemiMajor(), srs.GetInvFlattening()
+    key = (gt[1], gt[3], gt[5], gc.y_size, a, inv_f)
+    if key not in _DX_DY_CACHE:
+        dx = gc.x_axis
+        dy = gc.y_axis
+        dX = ellipsoid_distance(dy[1:], dx[1], dy[1:], dx[0], a, inv_f)
+        dY = ellipsoid_distance(dy[:-1], 0, dy[1:], 0, a, inv_f)
+        _DX_DY_CACHE[key] = (dX, dY)
+    dX, dY = _DX_DY_CACHE[key]
+    return dX.copy(), dY.copy()
+
+
+def ellipsoid_distance(lat1, lon1, lat2, lon2, a=6378137.0,
+                       inv_f=298.257223563, tol=1e-12, max_iter=200):
+    """
+    Calculates the distances between points on an ellipsoid, using
+    Vincenty's inverse formula. The calculation is vectorized over the
+    coordinates, which can be arrays or scalars.
+
+    Parameters
+    -----------
+    lat1, lon1, lat2, lon2 : array
+        Coordinates of the start and end points, in degrees
+    a : float (optional)
+        Default WGS-84. Semi-major axis of the ellipsoid, in m
+    inv_f : float (optional)
+        Default WGS-84. Inverse flattening of the ellipsoid
+    tol : float (optional)
+        Default 1e-12. Convergence tolerance on the longitude on the
+        auxiliary sphere, in radians
+    max_iter : int (optional)
+        Default 200. Maximum number of iterations
+
+    Returns
+    --------
+    s : array
+        The distances, in m
+
+    Notes
+    ------
+    Does not converge for nearly antipodal points, which is not a problem for
+    the pixel sizes this is used for.
     """
-    ELLIPSOID_MAP = {'WGS84': 'WGS-84'}
-    ellipsoid = ELLIPSOID_MAP[geotif.grid_coordinates.wkt]
-    d = distance(ellipsoid=ellipsoid)
-    dx = geotif.grid_coordinates.x_axis
-    dy = geotif.grid_coordinates.y_axis
-    dX = np.zeros((dy.shape[0]-1))
-    for j in xrange(len(dX)):
-        dX[j] = d.measure((dy[j+1], dx[1]), (dy[j+1], dx[0])) * 1000  # km2m
-    dY = np.zeros((dy.shape[0]-1))
-    for i in xrange(len(dY)):
-        dY[i] = d.measure((dy[i], 0), (dy[i+1], 0)) * 1000  # km2m
-    return dX, dY
+    f = 1.0 / inv_f
+    b = a * (1 - f)
+    lat1, lon1, lat2, lon2 = np.broadcast_arrays(
+        *[np.radians(np.asarray(x, float)) for x in [lat1, lon1, lat2, lon2]])
+    L = lon2 - lon1
+    U1 = np.arctan((1 - f) * np.tan(lat1))
+    U2 = np.arctan((1 - f) * np.tan(lat2))
+    sinU1, cosU1 = np.sin(U1), np.cos(U1)
+    sinU2, cosU2 = np.sin(U2), np.cos(U2)
+
+    lam = L
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for i in xrange(max_iter):
+            sinlam, coslam = np.sin(lam), np.cos(lam)
+            sinsig = np.sqrt((cosU2 * sinlam) ** 2
+                             + (cosU1 * sinU2 - sinU1 * cosU2 * coslam) ** 2)
+            cossig = sinU1 * sinU2 + cosU1 * cosU2 * coslam
+            sig = np.arctan2(sinsig, cossig)
+            # Coincident points have sinsig == 0
+            sinalpha = np.where(sinsig == 0, 0,
+                                cosU1 * cosU2 * sinlam / sinsig)
+            cos2alpha = 1 - sinalpha ** 2
+            # Points on the equator have cos2alpha == 0
+            cos2sigm = np.where(cos2alpha == 0, 0,
+                                cossig - 2 * sinU1 * sinU2 / cos2alpha)
+            C = f / 16 * cos2alpha * (4 + f * (4 - 3 * cos2alpha))
+            lam_old = lam
+            lam = L + (1 - C) * f * sinalpha \
+                * (sig + C * sinsig
+                   * (cos2sigm + C * cossig * (-1 + 2 * cos2sigm ** 2)))
+            if np.all(np.abs(lam - lam_old) <= tol):
+                break
+
+    u2 = cos2alpha * (a ** 2 - b ** 2) / b ** 2
+    A = 1 + u2 / 16384 * (4096 + u2 * (-768 + u2 * (320 - 175 * u2)))
+    B = u2 / 1024 * (256 + u2 * (-128 + u2 * (74 - 47 * u2)))
+    dsig = B * sinsig * (cos2sigm + B / 4
+                         * (cossig * (-1 + 2 * cos2sigm ** 2)
+                            - B / 6 * cos2sigm * (-3 + 4 * sinsig ** 2)
+                            * (-3 + 4 * cos2sigm ** 2)))
+    return b * A * (sig - dsig)
 
 
 def mk_geotiff_obj(raster, fn, bands=1, gdal_data_type=gdal.GDT_Float32,
@@ -359,7 +452,6 @@ def get_border_mask(region):
 
     return border
 
-_ORTH2 = np.array([[0, 1, 0], [1, 1, 1], [0, 1, 0]])
 _SQRT2 = np.sqrt(2.0)
 def get_distance(region, src):
     """
@@ -375,21 +467,83 @@ def get_distance(region, src):
     Returns
     -------
     d : np.ndarray(shape=(m, n), dtype=float)
-        approximate within-region distance from the nearest src pixel;
-        (distances outside of the region are arbitrary).
+        within-region distance from the nearest src pixel, with steps of 1 to
+        the orthogonal and sqrt(2) to the diagonal neighbors; region.size
+        for pixels that cannot be reached (distances outside of the region
+        are arbitrary).
+
+    Notes
+    ------
+    Uses Dijkstra's algorithm (compiled, if the Cython functions are
+    available), so every pixel is visited once.
     """
 
     dmax = float(region.size)
-    d = np.full(region.shape, dmax)
-    d[src] = 0
-    for n in range(region.size):
-        d_orth = minimum_filter(d, footprint=_ORTH2) + 1
-        d_diag = minimum_filter(d, (3, 3)) + _SQRT2
-        d_adj = np.minimum(d_orth[region], d_diag[region])
-        d[region] = np.minimum(d_adj, d[region])
-        if (d[region] < dmax).all():
-            break
-    return d
+    if CYTHON:
+        return cyutils.region_distance(region, src, dmax)
+
+    m, n = region.shape
+    d = np.full(region.size, dmax)
+    region = region.ravel()
+    queue = [(0.0, k) for k in np.nonzero(src.ravel())[0]]
+    d[[k for _, k in queue]] = 0
+    heapq.heapify(queue)
+    steps = [(di * n + dj, di, dj, [1, _SQRT2][di != 0 and dj != 0])
+             for di in [-1, 0, 1] for dj in [-1, 0, 1] if di != 0 or dj != 0]
+    while queue:
+        dist, k = heapq.heappop(queue)
+        if dist > d[k]:
+            continue  # Outdated entry
+        i, j = divmod(k, n)
+        for dk, di, dj, step in steps:
+            if not (0 <= i + di < m and 0 <= j + dj < n):
+                continue
+            kk = k + dk
+            if region[kk] and dist + step < d[kk]:
+                d[kk] = dist + step
+                heapq.heappush(queue, (d[kk], kk))
+    return d.reshape((m, n))
+
+
+def get_steps(region, src):
+    """
+    Compute the number of steps (to any of the 8 neighbors) within the region
+    from the nearest src pixel, using a breadth-first search over the whole
+    array. Every pixel is visited once, so this is O(region.sum()).
+
+    Parameters
+    ----------
+    region : np.ndarray(shape=(m, n), dtype=bool)
+        mask of the region
+    src : np.ndarray(shape=(m, n), dtype=bool)
+        mask of the source pixels (within the region) to count steps from.
+
+    Returns
+    -------
+    d : np.ndarray(shape=(m, n), dtype=float)
+        number of steps from the nearest src pixel. np.inf outside the region
+        and for pixels that cannot be reached.
+    """
+    m, n = region.shape
+    d = np.full(region.size, np.inf)
+    todo = region.ravel().copy()
+    front = np.nonzero((src & region).ravel())[0]
+    step = 0
+    while front.size:
+        d[front] = step
+        todo[front] = False
+        step += 1
+        i, j = np.divmod(front, n)
+        nxt = []
+        for di, dj in [(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1),
+                       (1, 0), (1, 1)]:
+            valid = (i + di >= 0) & (i + di < m) & (j + dj >= 0) \
+                & (j + dj < n)
+            nb = front[valid] + (di * n + dj)
+            nxt.append(nb[todo[nb]])
+        front = np.unique(np.concatenate(nxt))
+    return d.reshape(region.shape)
+
 
 def make_slice(a, b):
     if a < b:
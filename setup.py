@@ -96,10 +96,15 @@ setup(
         #'gdal',
         'numpy',
         'scipy',
-        'geopy',
         'traits',
         ],
 
+    # The numba versions of the drain functions, used when the Cython
+    # functions are not compiled
+    extras_require={
+        'numba': ['numba'],
+        },
+
     entry_points = {
         'console_scripts' : ['TWIDinf=pydem.commandline_utils:TWIDinf',
                              'AreaDinf=pydem.commandline_utils:AreaDinf',